@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from feature_store import open_feature_store, save_array, save_json
+from vector_index import block_scores, check_metric, output_score, pairwise_distances
+
+MANIFEST_FILE = 'manifest.json'
+DEFAULT_NPROBE = 8
+
+
+def kmeans(vectors, k, iterations=20, seed=0, sample_size=None):
+    """Lloyd's k-means on (a sample of) vectors; returns float32 centroids."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if sample_size is not None and len(vectors) > sample_size:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(vectors, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # empty clusters restart from random points
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def nearest(vectors, centroids, block_size=65536):
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        out[start:start + block_size] = pairwise_distances(vectors[start:start + block_size], centroids).argmin(axis=1)
+    return out
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index.
+
+    A k-means coarse quantizer splits the vectors into n_lists cells and a
+    query only scans the nprobe closest cells. With pq_m > 0 each vector is
+    stored as pq_m one-byte product-quantization codes of its residual from
+    the cell centroid (IVFADC), so memory per vector is pq_m bytes; the best
+    `candidates` approximate hits are then re-scored exactly from the full
+    vectors when a rerank source is given. Cosine indexes normalize vectors
+    so the euclidean cells order them by angle.
+    """
+
+    def __init__(self, n_lists=256, metric='euclidean', pq_m=0, seed=0):
+        if check_metric(metric) == 'dot':
+            raise ValueError("IVFIndex supports the euclidean and cosine metrics")
+        self.n_lists = n_lists
+        self.metric = metric
+        self.pq_m = pq_m
+        self.seed = seed
+        self.centroids = None
+        self.codebooks = None
+        self.codebook_norms = None
+        self._lock = threading.Lock()
+        # CSR inverted lists: offsets per cell, then ids and codes (or raw
+        # vectors without PQ) grouped by cell; plus sorted ids for membership
+        self._state = None
+
+    def __len__(self):
+        return 0 if self._state is None else len(self._state[1])
+
+    def __contains__(self, track_id):
+        if self._state is None:
+            return False
+        sorted_ids = self._state[3]
+        i = int(np.searchsorted(sorted_ids, track_id))
+        return i < len(sorted_ids) and sorted_ids[i] == track_id
+
+    @property
+    def dim(self):
+        return None if self.centroids is None else self.centroids.shape[1]
+
+    def _prepare(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            vectors = np.where(norms > 0, vectors / np.where(norms > 0, norms, 1), vectors)
+        return vectors
+
+    def train(self, vectors, iterations=20, sample_size=100000):
+        vectors = self._prepare(vectors)
+        self.centroids = kmeans(vectors, self.n_lists, iterations, self.seed, sample_size)
+        self.n_lists = len(self.centroids)
+        if self.pq_m:
+            dim = vectors.shape[1]
+            if dim % self.pq_m:
+                raise ValueError("pq_m={} must divide the vector dimension {}".format(self.pq_m, dim))
+            residuals = vectors - self.centroids[nearest(vectors, self.centroids)]
+            sub = dim // self.pq_m
+            self.codebooks = np.stack([kmeans(residuals[:, j * sub:(j + 1) * sub], 256, iterations, self.seed + j,
+                sample_size) for j in range(self.pq_m)]) if len(residuals) >= 256 else None
+            if self.codebooks is None:
+                raise ValueError("product quantization needs at least 256 training vectors")
+            self.codebook_norms = np.einsum('mks,mks->mk', self.codebooks, self.codebooks)
+        return self
+
+    def _encode(self, vectors, cells):
+        residuals = vectors - self.centroids[cells]
+        sub = residuals.shape[1] // self.pq_m
+        codes = np.empty((len(vectors), self.pq_m), dtype=np.uint8)
+        for j in range(self.pq_m):
+            codes[:, j] = nearest(residuals[:, j * sub:(j + 1) * sub], self.codebooks[j])
+        return codes
+
+    def add(self, track_ids, vectors):
+        """Insert or replace vectors; the index must be trained first."""
+        if self.centroids is None:
+            raise ValueError("IVFIndex.add called before train")
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        if not len(track_ids):
+            return 0
+        vectors = self._prepare(vectors)
+        cells = nearest(vectors, self.centroids)
+        payload = self._encode(vectors, cells) if self.pq_m else vectors
+        with self._lock:
+            if self._state is not None:
+                offsets, ids, data, _ = self._state
+                old_cells = np.repeat(np.arange(self.n_lists), np.diff(offsets))
+                keep = ~np.isin(ids, track_ids)
+                cells = np.concatenate([old_cells[keep], cells])
+                track_ids = np.concatenate([ids[keep], track_ids])
+                payload = np.concatenate([data[keep], payload])
+            order = np.argsort(cells, kind='stable')
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=self.n_lists))])
+            ids = track_ids[order]
+            self._state = (offsets, ids, np.ascontiguousarray(payload[order]), np.sort(ids))
+        return len(order)
+
+    def build(self, track_ids, vectors, **train_kwargs):
+        self.train(vectors, **train_kwargs)
+        self.add(track_ids, vectors)
+        return self
+
+    def search(self, query, k, nprobe=DEFAULT_NPROBE, candidates=None, exclude=(), rerank=None):
+        """Returns [(track_id, score)] ordered best first.
+
+        rerank, if given, maps an id array to their full vectors and the
+        best `candidates` (default 4 * k) hits are re-scored exactly.
+        """
+        if self._state is None or k <= 0:
+            return []
+        offsets, ids, data, _ = self._state
+        raw_query = np.asarray(query, dtype=np.float32)
+        query = self._prepare(raw_query)
+        nprobe = max(1, min(nprobe or DEFAULT_NPROBE, self.n_lists))
+        cell_dists = ((self.centroids - query) ** 2).sum(axis=1)
+        probe = np.argpartition(cell_dists, nprobe - 1)[:nprobe] if nprobe < self.n_lists else \
+            np.arange(self.n_lists)
+
+        # gather the probed cells' rows in one index array
+        lengths = offsets[probe + 1] - offsets[probe]
+        if not lengths.sum():
+            return []
+        rows = np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in probe[lengths > 0]])
+        found_ids = np.asarray(ids[rows])
+        if self.pq_m:
+            # one distance table per probed cell: (cell, subquantizer, code)
+            sub = query.shape[0] // self.pq_m
+            residuals = (query - self.centroids[probe]).reshape(len(probe), self.pq_m, sub)
+            tables = (self.codebook_norms[None] - 2.0 * np.einsum('pms,mks->pmk', residuals, self.codebooks)
+                + np.einsum('pms,pms->pm', residuals, residuals)[:, :, None])
+            cell_of_row = np.repeat(np.arange(len(probe)), lengths)
+            codes = np.asarray(data[rows])
+            scores = tables[cell_of_row[:, None], np.arange(self.pq_m), codes].sum(axis=1)
+        else:
+            diff = np.asarray(data[rows]) - query
+            scores = np.einsum('ij,ij->i', diff, diff)
+        if len(exclude):
+            keep = ~np.isin(found_ids, np.asarray(list(exclude), dtype=np.int64))
+            found_ids, scores = found_ids[keep], scores[keep]
+
+        n = min(len(found_ids), max(k, candidates or 4 * k) if rerank is not None else k)
+        if n == 0:
+            return []
+        top = np.argpartition(scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+        found_ids, scores = found_ids[top], scores[top]
+        if rerank is not None:
+            vectors = np.asarray(rerank(found_ids), dtype=np.float32)
+            scores = block_scores(vectors, np.linalg.norm(vectors, axis=1), raw_query,
+                np.float32(np.linalg.norm(raw_query)), self.metric)
+            # ids the rerank source no longer knows come back as NaN rows
+            keep = np.isfinite(scores)
+            found_ids, scores = found_ids[keep], scores[keep]
+        elif self.metric == 'cosine':
+            # squared distance between unit vectors is twice the cosine distance
+            scores = scores / 2.0
+        order = np.lexsort((found_ids, scores))[:k]
+        return [(int(found_ids[r]), output_score(scores[r], self.metric)) for r in order]
+
+    def save(self, directory):
+        if self._state is None:
+            raise ValueError("cannot save an empty IVFIndex")
+        offsets, ids, data, _ = self._state
+        os.makedirs(directory, exist_ok=True)
+        save_array(directory, 'centroids.npy', self.centroids)
+        save_array(directory, 'offsets.npy', offsets)
+        save_array(directory, 'ids.npy', ids)
+        save_array(directory, 'data.npy', data)
+        if self.pq_m:
+            save_array(directory, 'codebooks.npy', self.codebooks)
+        manifest = {'n_lists': self.n_lists, 'metric': self.metric, 'pq_m': self.pq_m, 'seed': self.seed,
+            'vectors': int(len(ids)), 'dim': int(self.centroids.shape[1])}
+        save_json(directory, MANIFEST_FILE, manifest)
+        return manifest
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        index = cls(manifest['n_lists'], manifest['metric'], manifest['pq_m'], manifest['seed'])
+        mmap_mode = 'r' if mmap else None
+        index.centroids = np.load(os.path.join(directory, 'centroids.npy'))
+        if index.pq_m:
+            index.codebooks = np.load(os.path.join(directory, 'codebooks.npy'))
+            index.codebook_norms = np.einsum('mks,mks->mk', index.codebooks, index.codebooks)
+        ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode=mmap_mode)
+        index._state = (np.load(os.path.join(directory, 'offsets.npy')), ids,
+            np.load(os.path.join(directory, 'data.npy'), mmap_mode=mmap_mode), np.sort(ids))
+        return index
+
+
+def open_ann_index(directory):
+    """IVFIndex saved in directory, or None when nothing has been saved there."""
+    if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        return None
+    return IVFIndex.load(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an IVF approximate nearest-neighbour index over the feature store.")
+    parser.add_argument('--feature-store', default='feature_store/')
+    parser.add_argument('--out', default='ann_index/')
+    parser.add_argument('--lists', type=int, default=None, help="number of k-means cells, default 4 * sqrt(n)")
+    parser.add_argument('--pq', type=int, default=0, help="product-quantization subvectors (bytes per vector), 0 to keep raw vectors")
+    parser.add_argument('--metric', choices=['euclidean', 'cosine'], default='euclidean')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    store = open_feature_store(args.feature_store)
+    if store is None:
+        parser.error("no feature store in {}, run ingest.py first".format(args.feature_store))
+    n_lists = args.lists or max(1, int(4 * np.sqrt(len(store))))
+    t0 = time.perf_counter()
+    index = IVFIndex(n_lists, args.metric, args.pq, args.seed).build(store.ids, store.vectors,
+        iterations=args.iterations)
+    manifest = index.save(args.out)
+    print("Built {} cells over {} vectors in {:.1f}s -> {}".format(manifest['n_lists'], manifest['vectors'],
+        time.perf_counter() - t0, args.out))
+
+
+if __name__ == '__main__':
+    main()
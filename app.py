@@ -1,12 +1,155 @@
 from audiolib_server import *
 from graph_server import *
+import functools
 import json
+import os
 import sys
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
+from audio_preview import PreviewCache
+from ann_index import open_ann_index
+from feature_store import open_feature_store
+from item_cf import blend
+import metrics
+from snapshot import Warmup
 
 app = Flask(__name__)
-fma_db = MusicDB()
-graph_db = SocialDB("bolt://localhost:7687", "neo4j", "password")
+# /recommend searches the memory-mapped feature store written by ingest.py
+# when there is one, and the track table's feature columns otherwise
+fma_db = MusicDB(cursor_factory=metrics.InstrumentedCursor,
+    feature_store=open_feature_store(os.environ.get('MUSICLIB_FEATURE_STORE', 'feature_store/')),
+    ann_index=open_ann_index(os.environ.get('MUSICLIB_ANN_INDEX', 'ann_index/')))
+# MUSICLIB_WRITE_BEHIND=flush|enqueue groups concurrent PUT /like writes into
+# shared transactions, acknowledging each after its batch commits or once queued
+write_behind_ack = os.environ.get('MUSICLIB_WRITE_BEHIND')
+graph_db = SocialDB("bolt://localhost:7687", "neo4j", "password", cache_likes=True, likes_snapshot_ttl=30,
+    instrument=True, track_popularity=True, popularity_ttl=30, item_cf=True, item_cf_ttl=600,
+    write_behind=bool(write_behind_ack), write_behind_ack=write_behind_ack or 'flush')
+previews = PreviewCache()
+
+# queries slower than this many milliseconds are logged with their label
+metrics.set_slow_query_threshold(float(os.environ.get('MUSICLIB_SLOW_QUERY_MS', '100')) / 1000.0)
+metrics.register_cache('tracks', lambda: fma_db.track_cache.stats())
+
+# the vector index, likes snapshot and popularity counters are restored from
+# MUSICLIB_SNAPSHOT in the background when they still match the databases,
+# and written back there after a cold load; /healthz reports the progress
+warmup = Warmup(fma_db, graph_db, os.environ.get('MUSICLIB_SNAPSHOT', 'snapshot/'),
+    float(os.environ.get('MUSICLIB_SNAPSHOT_MAX_AGE', '86400')))
+
+
+HYDRATE_BATCH_SIZE = 500
+
+
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    return default if value is None else int(value)
+
+
+def stream_requested():
+    return request.args.get('stream', '0') == '1'
+
+
+def ndjson_response(rows):
+    def generate():
+        for row in rows:
+            yield json.dumps(row) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def track_list_response(rows):
+    if stream_requested():
+        return ndjson_response(rows)
+    return jsonify(list(rows))
+
+
+def batch_pairs(body, field):
+    # body[field] as a list of [<user>, <value>] lists; ValueError otherwise
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    entries = body.get(field) or []
+    if not isinstance(entries, list) or \
+            any(not isinstance(e, list) or len(e) != 2 or not isinstance(e[0], str) for e in entries):
+        raise ValueError("expected {} as a list of [name, value] lists".format(field))
+    return entries
+
+
+def batch_likes(body):
+    # {"name": <user>, "track_ids": [...]} for one user, e.g. a playlist import,
+    # or {"likes": [[<user>, <track id>], ...]}
+    if isinstance(body, dict) and body.get('name') is not None:
+        track_ids = body.get('track_ids') or []
+        if not isinstance(body['name'], str) or not isinstance(track_ids, list):
+            raise ValueError("expected name as a string and track_ids as a list")
+        return [(body['name'], int(t)) for t in track_ids]
+    return [(name, int(t)) for name, t in batch_pairs(body, 'likes')]
+
+
+def batch_friendships(body):
+    # {"pairs": [[<user>, <user>], ...]}
+    pairs = batch_pairs(body, 'pairs')
+    if any(not isinstance(b, str) for _, b in pairs):
+        raise ValueError("expected pairs as [name, name] lists")
+    return [(a, b) for a, b in pairs]
+
+
+def batch_search_args(body):
+    # nprobe, candidates and exact of a JSON body, given as numbers or strings
+    nprobe, candidates = body.get('nprobe'), body.get('candidates')
+    return (None if nprobe is None else int(nprobe), None if candidates is None else int(candidates),
+        str(body.get('exact', False)).lower() in ('1', 'true'))
+
+
+def hydrate_tracks(track_ids):
+    track_ids = list(track_ids)
+    track_infos = fma_db.get_track_infos(track_ids)
+    track_genres = fma_db.get_genres_many(track_ids)
+    out = {}
+    for track, track_info in track_infos.items():
+        out[track] = {'track_id': track_info[0], 
+            'track_name': track_info[1],
+            'artist': track_info[2],
+            'listens': track_info[3],
+            'date_created': track_info[4],
+            'track_duration': track_info[5],
+            'genres': track_genres.get(track, [])
+        }
+    return out
+
+
+@app.before_request
+def start_warmup():
+    if warmup is not None:
+        warmup.start()
+
+
+@app.before_request
+def start_request_metrics():
+    request.metrics_started = metrics.begin_request()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(request, 'metrics_started', None)
+    if started is not None:
+        finish = functools.partial(metrics.end_request, request.method,
+            request.url_rule.rule if request.url_rule else 'unmatched', response.status_code, started)
+        if response.is_streamed:
+            # an NDJSON body queries the database as it streams, after this hook
+            response.call_on_close(finish)
+        else:
+            finish()
+    return response
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    report = warmup.report() if warmup is not None else {'ready': True}
+    return jsonify(report), 200 if report['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/user', methods=['PUT'])
@@ -27,19 +170,8 @@ def delete_user():
 def get_likes():
     user_name = request.args.get('name')
     tracks_liked = graph_db.get_liked_songs(user_name)
-    likes_arr = []
-    for track in tracks_liked:
-        track_info = fma_db.get_track_info(track)
-        track_genres = fma_db.get_genres(track)
-        info_dict = {'track_id': track_info[0], 
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'genres': track_genres
-        }
-        likes_arr.append(info_dict)
+    hydrated = hydrate_tracks(tracks_liked)
+    likes_arr = [hydrated[track] for track in tracks_liked if track in hydrated]
     return jsonify(likes_arr)
 
 
@@ -50,17 +182,10 @@ def like():
     print(user_name, file=sys.stdout)
     print(track_id, file=sys.stdout)
     graph_db.log_like(user_name, track_id)
-    track_info = fma_db.get_track_info(track_id)
-    track_genres = fma_db.get_genres(track_id)
-    like_info = {'track_id': track_info[0], 
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'genres': track_genres,
-            'person': user_name
-    }
+    like_info = hydrate_tracks([track_id]).get(track_id)
+    if like_info is None:
+        return jsonify({'error': 'track {} not found'.format(track_id)}), 404
+    like_info['person'] = user_name
     return jsonify(like_info)
 
 @app.route('/like', methods=['DELETE'])
@@ -70,19 +195,21 @@ def remove_like():
     print(user_name, file=sys.stdout)
     print(track_id, file=sys.stdout)
     graph_db.remove_like(user_name, track_id)
-    track_info = fma_db.get_track_info(track_id)
-    track_genres = fma_db.get_genres(track_id)
-    like_info = {'track_id': track_info[0], 
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'genres': track_genres,
-            'person': user_name
-    }
+    like_info = hydrate_tracks([track_id]).get(track_id)
+    if like_info is None:
+        return jsonify({'error': 'track {} not found'.format(track_id)}), 404
+    like_info['person'] = user_name
     return jsonify(like_info)
 
+@app.route('/like/batch', methods=['POST'])
+def like_batch():
+    try:
+        likes = batch_likes(request.get_json(force=True, silent=True) or {})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'expected name and track_ids, or likes as [name, trackid] pairs'}), 400
+    created = graph_db.log_likes(likes)
+    return jsonify({'likes': len(likes), 'created': len(created)})
+
 
 @app.route('/friend', methods=['GET'])
 def get_friends():
@@ -104,43 +231,57 @@ def remove_friend():
     graph_db.remove_friendship(user1, user2)
     return jsonify({'user1': user1, 'user2': user2})
 
+@app.route('/friend/batch', methods=['POST'])
+def friend_batch():
+    try:
+        pairs = batch_friendships(request.get_json(force=True, silent=True) or {})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'expected pairs as [name, name] lists'}), 400
+    created = graph_db.create_friendships(pairs)
+    return jsonify({'pairs': len(pairs), 'created': created})
+
 @app.route('/elikes', methods=['GET'])
 def get_friends_likes():
     user_name = request.args.get('name')
-    friends_likes = [*set(graph_db.get_friends_liked_songs(user_name))]
-    likes_arr = []
-    for track in friends_likes:
-        track_info = fma_db.get_track_info(track)
-        track_genres = fma_db.get_genres(track)
-        info_dict = {'track_id': track_info[0], 
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'genres': track_genres
-        }
-        likes_arr.append(info_dict)
-    return jsonify(likes_arr)
+    depth = int(request.args.get('depth', 1))
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if depth not in (1, 2, 3):
+        return jsonify({'error': 'depth must be between 1 and 3'}), 400
+    network_likes = graph_db.get_network_liked_songs(user_name, depth, limit, after_id)
+
+    def generate():
+        for start in range(0, len(network_likes), HYDRATE_BATCH_SIZE):
+            batch = network_likes[start:start + HYDRATE_BATCH_SIZE]
+            hydrated = hydrate_tracks([track for track, _, _ in batch])
+            for track, num_likes, hops in batch:
+                if track not in hydrated:
+                    continue
+                info_dict = hydrated[track]
+                info_dict['num_likes'] = num_likes
+                info_dict['hops'] = hops
+                yield info_dict
+
+    if stream_requested():
+        return ndjson_response(generate())
+    return jsonify(list(generate()))
         
 
 @app.route('/popular', methods=['GET'])
 def get_most_popular():
     k = int(request.args.get('k'))
-    most_popular = graph_db.most_popular_songs(k)
+    window = int_arg('window')
+    if window is None:
+        most_popular = graph_db.most_popular_songs(k)
+    else:
+        most_popular = graph_db.trending_songs(k, window)
+    hydrated = hydrate_tracks([track for track, _ in most_popular])
     popular_arr = []
     for track, followers in most_popular:
-        track_info = fma_db.get_track_info(track)
-        track_genres = fma_db.get_genres(track)
-        info_dict = {'track_id': track_info[0], 
-            'num_listeners': followers,
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'genres': track_genres
-        }
+        if track not in hydrated:
+            continue
+        info_dict = hydrated[track]
+        info_dict['num_listeners'] = followers
         popular_arr.append(info_dict)
     return jsonify(popular_arr)
 
@@ -148,20 +289,78 @@ def get_most_popular():
 def recommend_songs():
     k = int(request.args.get('k'))
     track_id = int(request.args.get('trackid'))
-    most_similar_tracks = fma_db.most_similar_search(track_id, k)
+    metric = request.args.get('metric')
+    try:
+        # genre, e.g. "Jazz AND NOT Pop", restricts the neighbours searched
+        most_similar_tracks = fma_db.most_similar_search(track_id, k, metric, nprobe=int_arg('nprobe'),
+            candidates=int_arg('candidates'), exact=request.args.get('exact', '0') == '1',
+            genre=request.args.get('genre'))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    hydrated = hydrate_tracks([id for id, _, _ in most_similar_tracks])
     out = []
     for id, title, similarity in most_similar_tracks:
-        track_info = fma_db.get_track_info(id)
-        track_genres = fma_db.get_genres(id)
-        info_dict = {'track_id': track_info[0], 
-            'track_name': track_info[1],
-            'artist': track_info[2],
-            'listens': track_info[3],
-            'date_created': track_info[4],
-            'track_duration': track_info[5],
-            'similarity': similarity,
-            'genres': track_genres
-        }
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['similarity'] = similarity
+        out.append(info_dict)
+    return jsonify(out)
+
+
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_songs_batch():
+    # body: {"track_ids": [...]} or {"name": <user>} to seed with their likes,
+    # plus optional k, mode (union or centroid), metric, nprobe, candidates, exact
+    body = request.get_json(force=True, silent=True) or {}
+    if not isinstance(body, dict) or not isinstance(body.get('track_ids') or [], list):
+        return jsonify({'error': 'expected a JSON object with track_ids as a list'}), 400
+    track_ids = body.get('track_ids')
+    if track_ids is None and body.get('name') is not None:
+        # a user with more likes than a batch takes is seeded with some of them
+        track_ids = graph_db.get_liked_songs(body['name'])[:MAX_BATCH_SEEDS]
+    if not track_ids:
+        return jsonify({'error': 'track_ids or name with liked songs required'}), 400
+    try:
+        most_similar_tracks = fma_db.most_similar_search_many([int(t) for t in track_ids], int(body.get('k', 10)),
+            body.get('mode', 'union'), body.get('metric'), *batch_search_args(body))
+    except (TypeError, ValueError) as error:
+        return jsonify({'error': str(error)}), 400
+    hydrated = hydrate_tracks([id for id, _, _, _ in most_similar_tracks])
+    out = []
+    for id, title, similarity, seed in most_similar_tracks:
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['similarity'] = similarity
+        info_dict['seed_track_id'] = seed
+        out.append(info_dict)
+    return jsonify(out)
+
+
+@app.route('/recommend/blend', methods=['GET'])
+def recommend_songs_blend():
+    # mixes audio neighbours with songs liked by the same people; alpha is the
+    # weight of the co-like side
+    k = int(request.args.get('k'))
+    track_id = int(request.args.get('trackid'))
+    alpha = float(request.args.get('alpha', 0.5))
+    metric = request.args.get('metric')
+    try:
+        audio_hits = fma_db.most_similar_search(track_id, 4 * k, metric)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    cf_hits = graph_db.co_liked_songs(track_id, 4 * k)
+    blended = blend([(id, score) for id, _, score in audio_hits], cf_hits, k, alpha, metric or 'euclidean')
+    hydrated = hydrate_tracks([id for id, _, _, _ in blended])
+    out = []
+    for id, score, audio_score, co_like_score in blended:
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['score'] = score
+        info_dict['audio_similarity'] = audio_score
+        info_dict['co_like_similarity'] = co_like_score
         out.append(info_dict)
     return jsonify(out)
 
@@ -183,36 +382,63 @@ def recommend_friends():
 @app.route('/search', methods=['GET'])
 def search_songs():
     keyword = request.args.get('keyword')
-    similar = fma_db.get_songs_like(keyword)
-    out = []
-    for id, title in similar:
-        info_dict = {'track_id': id, 
-            'track_name': title
-        }
-        out.append(info_dict)
-    return jsonify(out)
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if stream_requested():
+        similar = fma_db.iter_songs_like(keyword, after_id, limit)
+    elif after_id is not None:
+        similar = fma_db.iter_songs_like(keyword, after_id, min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+    else:
+        similar = fma_db.get_songs_like(keyword, limit or DEFAULT_SEARCH_LIMIT, int_arg('offset', 0))
+    return track_list_response({'track_id': id, 'track_name': title} for id, title in similar)
 
 
 @app.route('/artist', methods=['GET'])
 def get_artist_songs():
     artist_name = request.args.get('name')
-    tracks = fma_db.get_artist_songs(artist_name)
-    out = []
-    for id, title in tracks:
-        info_dict = {'track_id': id, 
-            'track_name': title
-        }
-        out.append(info_dict)
-    return jsonify(out)
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if stream_requested():
+        tracks = fma_db.iter_artist_songs(artist_name, after_id, limit)
+    elif after_id is not None:
+        tracks = fma_db.iter_artist_songs(artist_name, after_id, min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+    else:
+        tracks = fma_db.get_artist_songs(artist_name, limit or DEFAULT_SEARCH_LIMIT, int_arg('offset', 0))
+    return track_list_response({'track_id': id, 'track_name': title} for id, title in tracks)
+
+
+@app.route('/genre', methods=['GET'])
+def get_genre_songs():
+    # query is a genre or a set expression such as "Jazz AND NOT Pop",
+    # answered from the in-memory genre index
+    limit = min(int_arg('limit', DEFAULT_SEARCH_LIMIT), MAX_SEARCH_LIMIT)
+    offset = int_arg('offset', 0)
+    try:
+        track_ids = fma_db.genre_tracks(request.args.get('query'))[offset:offset + limit].tolist()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    track_infos = fma_db.get_track_infos(track_ids)
+    return jsonify([{'track_id': id, 'track_name': track_infos[id][1]} for id in track_ids if id in track_infos])
 
 @app.route('/play', methods=['GET'])
 def play_song():
     track_id = int(request.args.get('trackid'))
-    track_info = fma_db.get_track_info(track_id)
-    fma_db.play_song(track_info[1])
-    return '', 200
+    full = request.args.get('full', '0') == '1'
+    audio_path = fma_db.get_audio_path(track_id)
+    if audio_path is None or not os.path.exists(audio_path):
+        return jsonify({'error': 'no audio for track {}'.format(track_id)}), 404
+    if not full:
+        try:
+            audio_path = previews.preview_path(track_id, audio_path)
+        except Exception as error:
+            # fall back to range-streaming the original file
+            print(error)
+    # conditional=True answers Range requests with 206 partial content and
+    # lets the WSGI server use sendfile through wsgi.file_wrapper
+    return send_file(audio_path, mimetype='audio/mpeg', conditional=True, max_age=86400)
 
 if __name__ == '__main__':
+    warmup.start()
     app.run()
 
 
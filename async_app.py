@@ -0,0 +1,477 @@
+import asyncio
+import contextlib
+import functools
+import json
+import os
+
+from quart import Quart, Response, jsonify, request, send_file
+
+from async_db import AsyncMusicDB, AsyncSocialDB
+from audio_preview import PreviewCache
+from audiolib_server import DEFAULT_SEARCH_LIMIT, MAX_BATCH_SEEDS, MAX_SEARCH_LIMIT
+from ann_index import open_ann_index
+from feature_store import open_feature_store
+from item_cf import blend
+import metrics
+from snapshot import DEFAULT_MAX_AGE, WarmupStatus, open_snapshot, usable
+
+# ASGI serving mode: same routes and responses as app.py, with independent
+# database calls issued concurrently. Run with `hypercorn async_app:app`.
+app = Quart(__name__)
+fma_db = AsyncMusicDB(instrument=True, feature_store=open_feature_store(os.environ.get('MUSICLIB_FEATURE_STORE', 'feature_store/')),
+    ann_index=open_ann_index(os.environ.get('MUSICLIB_ANN_INDEX', 'ann_index/')))
+write_behind_ack = os.environ.get('MUSICLIB_WRITE_BEHIND')
+graph_db = AsyncSocialDB("bolt://localhost:7687", "neo4j", "password", write_behind=bool(write_behind_ack),
+    write_behind_ack=write_behind_ack or 'flush', instrument=True)
+previews = PreviewCache()
+DB_TIMEOUT = float(os.environ.get('MUSICLIB_DB_TIMEOUT', '5'))
+SNAPSHOT_DIR = os.environ.get('MUSICLIB_SNAPSHOT', 'snapshot/')
+SNAPSHOT_MAX_AGE = float(os.environ.get('MUSICLIB_SNAPSHOT_MAX_AGE', DEFAULT_MAX_AGE))
+warmup = WarmupStatus(('snapshot', 'vector_index'))
+HYDRATE_BATCH_SIZE = 500
+
+metrics.set_slow_query_threshold(float(os.environ.get('MUSICLIB_SLOW_QUERY_MS', '100')) / 1000.0)
+metrics.register_cache('tracks', lambda: fma_db.track_cache.stats())
+
+
+async def call(coro):
+    return await asyncio.wait_for(coro, DB_TIMEOUT)
+
+
+async def warm_up():
+    # only the vector index is held in memory here; it is restored from the
+    # snapshot app.py writes when that still matches the track table
+    warmup.begin('snapshot')
+    try:
+        marker = await call(fma_db.track_marker())
+    except Exception as error:
+        print(error)
+        marker = None
+    snapshot = open_snapshot(SNAPSHOT_DIR)
+    source = 'none'
+    if snapshot is not None:
+        warmup.snapshot, source = snapshot.generation, 'stale'
+        if fma_db.feature_store is None and usable(snapshot, 'vectors', marker, SNAPSHOT_MAX_AGE):
+            fma_db.restore_vector_index(*snapshot.vectors())
+            source = 'vectors'
+    warmup.done('snapshot', source)
+    while True:
+        warmup.begin('vector_index')
+        try:
+            if fma_db.feature_store is not None:
+                source = 'feature store'
+            else:
+                source = 'snapshot' if fma_db._vector_index_loaded else 'database'
+                await call(fma_db.load_vector_index())
+            warmup.done('vector_index', source)
+            return
+        except Exception as error:
+            print(error)
+            warmup.failed('vector_index', error)
+            await asyncio.sleep(5)
+
+
+@app.before_serving
+async def open_pools():
+    await fma_db.open()
+    app.add_background_task(warm_up)
+
+
+@app.after_serving
+async def close_pools():
+    await fma_db.close()
+    await graph_db.close()
+
+
+@app.before_request
+async def start_request_metrics():
+    request.metrics_started = metrics.begin_request()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    started = getattr(request, 'metrics_started', None)
+    if started is not None:
+        finish = functools.partial(metrics.end_request, request.method,
+            request.url_rule.rule if request.url_rule else 'unmatched', response.status_code, started)
+        on_close = getattr(response, 'on_close', None)
+        if on_close is not None:
+            on_close.append(finish)
+        else:
+            finish()
+    return response
+
+
+@app.route('/healthz', methods=['GET'])
+async def healthz():
+    report = warmup.report()
+    return jsonify(report), 200 if report['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.errorhandler(asyncio.TimeoutError)
+async def database_timeout(error):
+    return jsonify({'error': 'database call timed out'}), 504
+
+
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    return default if value is None else int(value)
+
+
+def stream_requested():
+    return request.args.get('stream', '0') == '1'
+
+
+async def collect(rows):
+    async with contextlib.aclosing(rows):
+        return [row async for row in rows]
+
+
+def ndjson_response(rows):
+    # Quart has no call_on_close, so the request metrics hook appends to
+    # on_close and the body runs it once the last row is sent
+    on_close = []
+
+    async def generate():
+        try:
+            async with contextlib.aclosing(rows):
+                async for row in rows:
+                    yield json.dumps(row) + '\n'
+        finally:
+            for callback in on_close:
+                callback()
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.on_close = on_close
+    return response
+
+
+async def track_rows(tracks):
+    async with contextlib.aclosing(tracks):
+        async for id, title in tracks:
+            yield {'track_id': id, 'track_name': title}
+
+
+def batch_pairs(body, field):
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    entries = body.get(field) or []
+    if not isinstance(entries, list) or \
+            any(not isinstance(e, list) or len(e) != 2 or not isinstance(e[0], str) for e in entries):
+        raise ValueError("expected {} as a list of [name, value] lists".format(field))
+    return entries
+
+
+def batch_likes(body):
+    if isinstance(body, dict) and body.get('name') is not None:
+        track_ids = body.get('track_ids') or []
+        if not isinstance(body['name'], str) or not isinstance(track_ids, list):
+            raise ValueError("expected name as a string and track_ids as a list")
+        return [(body['name'], int(t)) for t in track_ids]
+    return [(name, int(t)) for name, t in batch_pairs(body, 'likes')]
+
+
+def batch_friendships(body):
+    pairs = batch_pairs(body, 'pairs')
+    if any(not isinstance(b, str) for _, b in pairs):
+        raise ValueError("expected pairs as [name, name] lists")
+    return [(a, b) for a, b in pairs]
+
+
+def batch_search_args(body):
+    nprobe, candidates = body.get('nprobe'), body.get('candidates')
+    return (None if nprobe is None else int(nprobe), None if candidates is None else int(candidates),
+        str(body.get('exact', False)).lower() in ('1', 'true'))
+
+
+async def hydrate_tracks(track_ids):
+    track_ids = list(track_ids)
+    track_infos, track_genres = await asyncio.gather(call(fma_db.get_track_infos(track_ids)),
+        call(fma_db.get_genres_many(track_ids)))
+    out = {}
+    for track, track_info in track_infos.items():
+        out[track] = {'track_id': track_info[0],
+            'track_name': track_info[1],
+            'artist': track_info[2],
+            'listens': track_info[3],
+            'date_created': track_info[4],
+            'track_duration': track_info[5],
+            'genres': track_genres.get(track, [])
+        }
+    return out
+
+
+@app.route('/user', methods=['PUT'])
+async def create_user():
+    user_name = request.args['name']
+    await call(graph_db.create_person(user_name))
+    return jsonify({'name': user_name})
+
+
+@app.route('/user', methods=['DELETE'])
+async def delete_user():
+    user_name = request.args.get('name')
+    await call(graph_db.delete_person(user_name))
+    return jsonify({'name': user_name})
+
+@app.route('/like', methods=['GET'])
+async def get_likes():
+    user_name = request.args.get('name')
+    tracks_liked = await call(graph_db.get_liked_songs(user_name))
+    hydrated = await hydrate_tracks(tracks_liked)
+    likes_arr = [hydrated[track] for track in tracks_liked if track in hydrated]
+    return jsonify(likes_arr)
+
+
+async def update_like(write, user_name, track_id):
+    # the graph write and the relational hydration are independent
+    _, hydrated = await asyncio.gather(call(write(user_name, track_id)), hydrate_tracks([track_id]))
+    like_info = hydrated.get(track_id)
+    if like_info is None:
+        return jsonify({'error': 'track {} not found'.format(track_id)}), 404
+    like_info['person'] = user_name
+    return jsonify(like_info)
+
+
+@app.route('/like', methods=['PUT'])
+async def like():
+    return await update_like(graph_db.log_like, request.args.get('name'), int(request.args.get('trackid')))
+
+@app.route('/like', methods=['DELETE'])
+async def remove_like():
+    return await update_like(graph_db.remove_like, request.args.get('name'), int(request.args.get('trackid')))
+
+@app.route('/like/batch', methods=['POST'])
+async def like_batch():
+    try:
+        likes = batch_likes(await request.get_json(force=True, silent=True) or {})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'expected name and track_ids, or likes as [name, trackid] pairs'}), 400
+    created = await call(graph_db.log_likes(likes))
+    return jsonify({'likes': len(likes), 'created': len(created)})
+
+
+@app.route('/friend', methods=['GET'])
+async def get_friends():
+    user_name = request.args.get('name')
+    friends = await call(graph_db.get_friends(user_name))
+    return jsonify(friends)
+
+@app.route('/friend', methods=['PUT'])
+async def friend():
+    user1 = request.args.get('f1')
+    user2 = request.args.get('f2')
+    await call(graph_db.create_friendship(user1, user2))
+    return jsonify({'user1': user1, 'user2': user2})
+
+@app.route('/friend', methods=['DELETE'])
+async def remove_friend():
+    user1 = request.args.get('f1')
+    user2 = request.args.get('f2')
+    await call(graph_db.remove_friendship(user1, user2))
+    return jsonify({'user1': user1, 'user2': user2})
+
+@app.route('/friend/batch', methods=['POST'])
+async def friend_batch():
+    try:
+        pairs = batch_friendships(await request.get_json(force=True, silent=True) or {})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'expected pairs as [name, name] lists'}), 400
+    created = await call(graph_db.create_friendships(pairs))
+    return jsonify({'pairs': len(pairs), 'created': created})
+
+@app.route('/elikes', methods=['GET'])
+async def get_friends_likes():
+    user_name = request.args.get('name')
+    depth = int(request.args.get('depth', 1))
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if depth not in (1, 2, 3):
+        return jsonify({'error': 'depth must be between 1 and 3'}), 400
+    network_likes = await call(graph_db.get_network_liked_songs(user_name, depth, limit, after_id))
+
+    async def generate():
+        for start in range(0, len(network_likes), HYDRATE_BATCH_SIZE):
+            batch = network_likes[start:start + HYDRATE_BATCH_SIZE]
+            hydrated = await hydrate_tracks([track for track, _, _ in batch])
+            for track, num_likes, hops in batch:
+                if track not in hydrated:
+                    continue
+                info_dict = hydrated[track]
+                info_dict['num_likes'] = num_likes
+                info_dict['hops'] = hops
+                yield info_dict
+
+    if stream_requested():
+        return ndjson_response(generate())
+    return jsonify(await collect(generate()))
+
+
+@app.route('/popular', methods=['GET'])
+async def get_most_popular():
+    k = int(request.args.get('k'))
+    window = request.args.get('window')
+    if window is None:
+        most_popular = await call(graph_db.most_popular_songs(k))
+    else:
+        most_popular = await call(graph_db.trending_songs(k, int(window)))
+    hydrated = await hydrate_tracks([track for track, _ in most_popular])
+    popular_arr = []
+    for track, followers in most_popular:
+        if track not in hydrated:
+            continue
+        info_dict = hydrated[track]
+        info_dict['num_listeners'] = followers
+        popular_arr.append(info_dict)
+    return jsonify(popular_arr)
+
+@app.route('/recommend', methods=['GET'])
+async def recommend_songs():
+    k = int(request.args.get('k'))
+    track_id = int(request.args.get('trackid'))
+    metric = request.args.get('metric')
+    nprobe, candidates = request.args.get('nprobe'), request.args.get('candidates')
+    try:
+        most_similar_tracks = await call(fma_db.most_similar_search(track_id, k, metric,
+            nprobe=None if nprobe is None else int(nprobe), candidates=None if candidates is None else int(candidates),
+            exact=request.args.get('exact', '0') == '1', genre=request.args.get('genre')))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    hydrated = await hydrate_tracks([id for id, _, _ in most_similar_tracks])
+    out = []
+    for id, title, similarity in most_similar_tracks:
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['similarity'] = similarity
+        out.append(info_dict)
+    return jsonify(out)
+
+
+@app.route('/recommend/batch', methods=['POST'])
+async def recommend_songs_batch():
+    body = await request.get_json(force=True, silent=True) or {}
+    if not isinstance(body, dict) or not isinstance(body.get('track_ids') or [], list):
+        return jsonify({'error': 'expected a JSON object with track_ids as a list'}), 400
+    track_ids = body.get('track_ids')
+    if track_ids is None and body.get('name') is not None:
+        track_ids = (await call(graph_db.get_liked_songs(body['name'])))[:MAX_BATCH_SEEDS]
+    if not track_ids:
+        return jsonify({'error': 'track_ids or name with liked songs required'}), 400
+    try:
+        most_similar_tracks = await call(fma_db.most_similar_search_many([int(t) for t in track_ids],
+            int(body.get('k', 10)), body.get('mode', 'union'), body.get('metric'), *batch_search_args(body)))
+    except (TypeError, ValueError) as error:
+        return jsonify({'error': str(error)}), 400
+    hydrated = await hydrate_tracks([id for id, _, _, _ in most_similar_tracks])
+    out = []
+    for id, title, similarity, seed in most_similar_tracks:
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['similarity'] = similarity
+        info_dict['seed_track_id'] = seed
+        out.append(info_dict)
+    return jsonify(out)
+
+
+@app.route('/recommend/blend', methods=['GET'])
+async def recommend_songs_blend():
+    k = int(request.args.get('k'))
+    track_id = int(request.args.get('trackid'))
+    alpha = float(request.args.get('alpha', 0.5))
+    metric = request.args.get('metric')
+    try:
+        audio_hits, cf_hits = await asyncio.gather(call(fma_db.most_similar_search(track_id, 4 * k, metric)),
+            call(graph_db.co_liked_songs(track_id, 4 * k)))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    blended = blend([(id, score) for id, _, score in audio_hits], cf_hits, k, alpha, metric or 'euclidean')
+    hydrated = await hydrate_tracks([id for id, _, _, _ in blended])
+    out = []
+    for id, score, audio_score, co_like_score in blended:
+        if id not in hydrated:
+            continue
+        info_dict = hydrated[id]
+        info_dict['score'] = score
+        info_dict['audio_similarity'] = audio_score
+        info_dict['co_like_similarity'] = co_like_score
+        out.append(info_dict)
+    return jsonify(out)
+
+
+@app.route('/recommend_friends', methods=['GET'])
+async def recommend_friends():
+    name = request.args.get('name')
+    k = int(request.args.get('k'))
+    graph_data = await call(graph_db.retrieve_all_likes_data())
+    recommendations = await call(fma_db.recommend_friends(name, graph_data, k))
+    out = []
+    for rec in recommendations:
+        out.append({
+            'friend': rec[1],
+            'similarity': rec[0]
+        })
+    return jsonify(out)
+
+@app.route('/search', methods=['GET'])
+async def search_songs():
+    keyword = request.args.get('keyword')
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if stream_requested():
+        return ndjson_response(track_rows(fma_db.iter_songs_like(keyword, after_id, limit)))
+    if after_id is not None:
+        similar = await call(collect(fma_db.iter_songs_like(keyword, after_id,
+            min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))))
+    else:
+        similar = await call(fma_db.get_songs_like(keyword, limit or DEFAULT_SEARCH_LIMIT, int_arg('offset', 0)))
+    return jsonify([{'track_id': id, 'track_name': title} for id, title in similar])
+
+
+@app.route('/artist', methods=['GET'])
+async def get_artist_songs():
+    artist_name = request.args.get('name')
+    limit = int_arg('limit')
+    after_id = int_arg('after_id')
+    if stream_requested():
+        return ndjson_response(track_rows(fma_db.iter_artist_songs(artist_name, after_id, limit)))
+    if after_id is not None:
+        tracks = await call(collect(fma_db.iter_artist_songs(artist_name, after_id,
+            min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))))
+    else:
+        tracks = await call(fma_db.get_artist_songs(artist_name, limit or DEFAULT_SEARCH_LIMIT, int_arg('offset', 0)))
+    return jsonify([{'track_id': id, 'track_name': title} for id, title in tracks])
+
+
+@app.route('/genre', methods=['GET'])
+async def get_genre_songs():
+    limit = min(int(request.args.get('limit', DEFAULT_SEARCH_LIMIT)), MAX_SEARCH_LIMIT)
+    offset = int(request.args.get('offset', 0))
+    try:
+        track_ids = (await call(fma_db.genre_tracks(request.args.get('query'))))[offset:offset + limit].tolist()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    track_infos = await call(fma_db.get_track_infos(track_ids))
+    return jsonify([{'track_id': id, 'track_name': track_infos[id][1]} for id in track_ids if id in track_infos])
+
+@app.route('/play', methods=['GET'])
+async def play_song():
+    track_id = int(request.args.get('trackid'))
+    full = request.args.get('full', '0') == '1'
+    audio_path = await call(fma_db.get_audio_path(track_id))
+    if audio_path is None or not os.path.exists(audio_path):
+        return jsonify({'error': 'no audio for track {}'.format(track_id)}), 404
+    if not full:
+        try:
+            audio_path = await asyncio.to_thread(previews.preview_path, track_id, audio_path)
+        except Exception as error:
+            print(error)
+    return await send_file(audio_path, mimetype='audio/mpeg', conditional=True, max_age=86400)
+
+if __name__ == '__main__':
+    app.run()
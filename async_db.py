@@ -0,0 +1,449 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from neo4j import AsyncGraphDatabase
+import numpy as np
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+
+import metrics
+from audiolib_server import DEFAULT_SEARCH_LIMIT, GENRE_MARKER_QUERY, MAX_BATCH_SEEDS, MAX_SEARCH_LIMIT, \
+    STREAM_ITERSIZE, ann_neighbours, fill_titles, like_pattern, pad_table_rows, rank_friends, search_order, \
+    table_rows_fit, use_ann_index
+from genre_index import GenreIndex, parse_genre_query
+from graph_server import BULK_BATCH_SIZE, CREATE_LIKE_QUERY, CREATE_LIKES_QUERY, DELETE_LIKE_QUERY, \
+    MISSING_LIKE_COUNT_QUERY, MOST_POPULAR_QUERY, REBUILD_LIKE_COUNTS_QUERY, TRENDING_QUERY, UNLIKED_SONGS_QUERY, \
+    batched, network_liked_songs_query, pad_popular
+from item_cf import ItemCF
+from track_cache import TrackCache
+from vector_index import VectorIndex, merge_neighbours
+from write_buffer import AsyncWriteBuffer
+
+
+class AsyncMusicDB:
+    """asyncio counterpart of MusicDB for the ASGI serving mode.
+
+    Queries go through a psycopg 3 async pool; the track cache, vector index
+    and friend ranking are the same in-memory structures MusicDB uses.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, track_cache=None, feature_store=None, ann_index=None, genre_index=None,
+            genre_index_ttl=60.0, instrument=False, **connect_kwargs):
+        self.audio_dir = "fma/"
+        db_params = dict(dbname="musiclib", user='postgres', password='password', host='127.0.0.1', port='5432')
+        db_params.update(connect_kwargs)
+        self.pool = AsyncConnectionPool(make_conninfo(**db_params), min_size=minconn, max_size=maxconn, open=False)
+        self.track_cache = TrackCache() if track_cache is None else track_cache
+        self.feature_store = feature_store
+        self.vector_index = VectorIndex(base=feature_store)
+        self.ann_index = ann_index
+        self._vector_index_lock = asyncio.Lock()
+        self._vector_index_loaded = False
+        self.genre_index = genre_index
+        self.genre_index_ttl = genre_index_ttl
+        self._genre_index_lock = asyncio.Lock()
+        self._genre_marker = None
+        self._genre_checked_at = None
+        self._trigram = None
+        # record every statement in the metrics module, like InstrumentedCursor
+        self.instrument = instrument
+
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _fetchall(self, query, params=()):
+        if self.instrument:
+            return await metrics.observe_awaitable('postgres', metrics.sql_label(query), self._query(query, params))
+        return await self._query(query, params)
+
+    async def _query(self, query, params):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+                return await cursor.fetchall()
+
+    async def _iter_named_query(self, query, params, itersize=STREAM_ITERSIZE):
+        # server-side cursor as in MusicDB; the connection is held until the
+        # generator is exhausted or closed
+        async with self.pool.connection() as conn:
+            async with conn.cursor(name='stream_{}'.format(uuid.uuid4().hex)) as cursor:
+                cursor.itersize = itersize
+                if self.instrument:
+                    await metrics.observe_awaitable('postgres', metrics.sql_label(query), cursor.execute(query, params))
+                else:
+                    await cursor.execute(query, params)
+                async for row in cursor:
+                    yield row
+
+    async def load_vector_index(self):
+        if self.feature_store is not None and not table_rows_fit(self.feature_store):
+            self._vector_index_loaded = True
+            return 0
+        after_id = self.vector_index.max_id
+        rows = await self._fetchall("""SELECT id, title, feature1, feature2, feature3 FROM track
+        WHERE track.id > %s
+        ORDER BY track.id;""", (-1 if after_id is None else after_id,))
+        if self.feature_store is not None:
+            rows = pad_table_rows(rows, self.feature_store.dim)
+        added = self.vector_index.add(rows)
+        if self.ann_index is not None:
+            rows = [r for r in rows if int(r[0]) not in self.ann_index]
+            if rows:
+                self.ann_index.add([int(r[0]) for r in rows], [r[2:2 + self.ann_index.dim] for r in rows])
+        self._vector_index_loaded = True
+        return added
+
+    def restore_vector_index(self, ids, vectors, norms, titles):
+        self.vector_index.restore(ids, vectors, norms, titles)
+        if self.ann_index is not None:
+            missing = [i for i, t in enumerate(ids.tolist()) if t not in self.ann_index]
+            if missing:
+                self.ann_index.add(ids[missing], np.asarray(vectors[missing])[:, :self.ann_index.dim])
+        self._vector_index_loaded = True
+
+    async def track_marker(self):
+        rows = await self._fetchall("SELECT count(*), coalesce(max(id), -1) FROM track;")
+        return {'tracks': int(rows[0][0]), 'max_id': int(rows[0][1])}
+
+    async def _ensure_vector_index(self, track_ids):
+        if not self._vector_index_loaded:
+            async with self._vector_index_lock:
+                if not self._vector_index_loaded:
+                    await self.load_vector_index()
+        if any(t not in self.vector_index for t in track_ids):
+            await self.load_vector_index()
+
+    async def most_similar_search(self, track_id, k, metric=None, nprobe=None, candidates=None, exact=False,
+            genre=None):
+        allowed = None if genre is None else await self.genre_tracks(genre)
+        await self._ensure_vector_index([track_id])
+        if allowed is not None:
+            hits = self.vector_index.most_similar(track_id, k, metric, allowed=allowed)
+        elif use_ann_index(self.ann_index, metric, exact):
+            hits = ann_neighbours(self.ann_index, self.vector_index, track_id, k, nprobe, candidates, (track_id,))
+        else:
+            hits = self.vector_index.most_similar(track_id, k, metric)
+        return await self._with_titles(hits)
+
+    async def most_similar_search_many(self, track_ids, k, mode='union', metric=None, nprobe=None, candidates=None,
+            exact=False):
+        track_ids = list(dict.fromkeys(int(t) for t in track_ids))
+        if len(track_ids) > MAX_BATCH_SEEDS:
+            raise ValueError("at most {} seed tracks, got {}".format(MAX_BATCH_SEEDS, len(track_ids)))
+        await self._ensure_vector_index(track_ids)
+        if mode == 'union' and use_ann_index(self.ann_index, metric, exact):
+            per_seed = {t: ann_neighbours(self.ann_index, self.vector_index, t, k, nprobe, candidates, track_ids)
+                for t in track_ids if t in self.vector_index}
+            return await self._with_titles(merge_neighbours(per_seed, k, self.ann_index.metric))
+        return await self._with_titles(self.vector_index.most_similar_many(track_ids, k, mode, metric))
+
+    async def _with_titles(self, hits):
+        missing = [h[0] for h in hits if h[1] is None]
+        return fill_titles(hits, await self.get_track_infos(missing)) if missing else hits
+
+    async def get_track_features_many(self, track_ids):
+        rows = await self._fetchall("""SELECT id, feature1, feature2, feature3 FROM track
+        WHERE track.id = ANY(%s);""", (list({int(t) for t in track_ids}),))
+        return {row[0]: [row[1], row[2], row[3]] for row in rows}
+
+    async def recommend_friends(self, user, user2likes, k):
+        all_tracks = set()
+        for tracks in user2likes.values():
+            all_tracks.update(tracks)
+        features = await self.get_track_features_many(all_tracks)
+        return rank_friends(user, user2likes, features, k)
+
+    async def _load_genres_many(self, track_ids):
+        rows = await self._fetchall("""SELECT track_id, ARRAY_AGG(RTRIM(genre)) FROM genre
+        WHERE genre.track_id = ANY(%s)
+        GROUP BY track_id;""", (list(track_ids),))
+        out = {track_id: [g.strip() for g in genres if g is not None] for track_id, genres in rows}
+        for track_id in track_ids:
+            out.setdefault(track_id, [])
+        return out
+
+    async def _load_track_infos(self, track_ids):
+        rows = await self._fetchall("""SELECT track.id, track.title, artist.name, track.listens, track.date_created, track.duration
+        FROM track INNER JOIN artist
+        ON track.artist_id = artist.id
+        WHERE track.id = ANY(%s);""", (list(track_ids),))
+        return {info[0]: (info[0], (info[1] or '').strip(), info[2].strip(), info[3], info[4].strftime('%m/%d/%Y'), info[5])
+            for info in rows}
+
+    async def _cached(self, namespace, track_ids, loader):
+        out, missing = self.track_cache.lookup(namespace, {int(t) for t in track_ids})
+        if missing:
+            loaded = await loader(missing)
+            self.track_cache.store(namespace, loaded)
+            out.update(loaded)
+        return out
+
+    async def get_genres_many(self, track_ids):
+        return await self._cached('genres', track_ids, self._load_genres_many)
+
+    async def get_track_infos(self, track_ids):
+        return await self._cached('info', track_ids, self._load_track_infos)
+
+    async def has_trigram(self):
+        if self._trigram is None:
+            rows = await self._fetchall("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm';")
+            self._trigram = bool(rows)
+        return self._trigram
+
+    async def get_songs_like(self, song_keyword, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        rows = await self._fetchall("""SELECT track.id, track.title FROM track
+        WHERE LOWER(track.title) LIKE %s
+        ORDER BY {}
+        LIMIT %s OFFSET %s;""".format(search_order('track.title', await self.has_trigram())), (like_pattern(song_keyword), song_keyword.lower(), min(limit, MAX_SEARCH_LIMIT), offset))
+        return [(r[0], (r[1] or '').strip()) for r in rows]
+
+    async def get_artist_songs(self, artist, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        rows = await self._fetchall("""SELECT track.id, track.title FROM artist
+        INNER JOIN track
+        ON artist.id = track.artist_id
+        WHERE LOWER(artist.name) LIKE %s
+        ORDER BY {}
+        LIMIT %s OFFSET %s;""".format(search_order('artist.name', await self.has_trigram())), (like_pattern(artist), artist.lower(), min(limit, MAX_SEARCH_LIMIT), offset))
+        return [(r[0], (r[1] or '').strip()) for r in rows]
+
+    async def iter_songs_like(self, song_keyword, after_id=None, limit=None):
+        # id-ordered keyset pages, streamed from a server-side cursor
+        async for r in self._iter_named_query("""SELECT track.id, track.title FROM track
+        WHERE LOWER(track.title) LIKE %s AND track.id > %s
+        ORDER BY track.id
+        LIMIT %s;""", (like_pattern(song_keyword), -1 if after_id is None else after_id, limit)):
+            yield (r[0], (r[1] or '').strip())
+
+    async def iter_artist_songs(self, artist, after_id=None, limit=None):
+        async for r in self._iter_named_query("""SELECT track.id, track.title FROM artist
+        INNER JOIN track
+        ON artist.id = track.artist_id
+        WHERE LOWER(artist.name) LIKE %s AND track.id > %s
+        ORDER BY track.id
+        LIMIT %s;""", (like_pattern(artist), -1 if after_id is None else after_id, limit)):
+            yield (r[0], (r[1] or '').strip())
+
+    async def load_genre_index(self):
+        track_rows = await self._fetchall("SELECT id FROM track;")
+        genre_rows = await self._fetchall("SELECT track_id, RTRIM(genre) FROM genre;")
+        pairs = [(track_id, genre.strip()) for track_id, genre in genre_rows if genre is not None]
+        self.genre_index = await asyncio.to_thread(GenreIndex.build, (r[0] for r in track_rows), pairs)
+        return self.genre_index
+
+    async def genre_marker(self):
+        rows = await self._fetchall(GENRE_MARKER_QUERY)
+        return tuple(int(v) for v in rows[0])
+
+    def _genre_index_expired(self):
+        return self._genre_checked_at is None or (self.genre_index_ttl is not None and
+            time.monotonic() - self._genre_checked_at > self.genre_index_ttl)
+
+    async def genre_tracks(self, genre):
+        # parsed first so a malformed expression fails without a round trip
+        query = parse_genre_query(genre)
+        if self.genre_index is None or self._genre_index_expired():
+            async with self._genre_index_lock:
+                if self.genre_index is None or self._genre_index_expired():
+                    marker = await self.genre_marker()
+                    if self.genre_index is None or marker != self._genre_marker:
+                        await self.load_genre_index()
+                    self._genre_marker = marker
+                    self._genre_checked_at = time.monotonic()
+        return self.genre_index.tracks(query)
+
+    async def get_tracks_by_genre(self, genre, k):
+        return (await self.genre_tracks(genre))[:int(k)].tolist()
+
+    async def get_audio_path(self, track_id):
+        rows = await self._fetchall("""SELECT file_path FROM audio
+        WHERE audio.track_id = %s LIMIT 1;""", (int(track_id),))
+        if not rows or rows[0][0] is None:
+            return None
+        return os.path.join(self.audio_dir, rows[0][0])
+
+
+class AsyncSocialDB:
+    """asyncio counterpart of SocialDB built on the async Neo4j driver."""
+
+    def __init__(self, uri, user, password, item_cf_ttl=600, write_behind=False, write_behind_items=256,
+            write_behind_delay=0.005, write_behind_ack='flush', instrument=False):
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password))
+        self.instrument = instrument
+        self.item_cf = ItemCF()
+        self.item_cf_ttl = item_cf_ttl
+        self._item_cf_lock = asyncio.Lock()
+        self._item_cf_task = None
+        self._like_counts_checked = False
+        self.like_buffer = None
+        if write_behind:
+            self.like_buffer = AsyncWriteBuffer(self._flush_likes, write_behind_items, write_behind_delay,
+                write_behind_ack)
+
+    async def close(self):
+        if self.like_buffer is not None:
+            await self.like_buffer.close()
+        await self.driver.close()
+
+    @staticmethod
+    async def _run(tx, query, params):
+        result = await tx.run(query, params)
+        return [record async for record in result]
+
+    async def _read(self, query, **params):
+        return await self._execute('execute_read', query, params)
+
+    async def _write(self, query, **params):
+        return await self._execute('execute_write', query, params)
+
+    async def _execute(self, access, query, params):
+        async with self.driver.session(database="neo4j") as session:
+            transaction = getattr(session, access)(self._run, query, params)
+            if self.instrument:
+                return await metrics.observe_awaitable('neo4j', metrics.cypher_label(query), transaction)
+            return await transaction
+
+    async def create_person(self, name):
+        await self._write("MERGE (p:Person { name: $pname }) RETURN p", pname=name)
+
+    async def delete_person(self, name):
+        await self._write("MATCH (p:Person) WHERE p.name = $pname DELETE p;", pname=name)
+
+    async def log_like(self, name, track_id):
+        if self.like_buffer is not None:
+            return await self.like_buffer.submit((name, track_id))
+        records = await self._write(CREATE_LIKE_QUERY, pname=name, trackidentifier=track_id)
+        created = records[0]['created'] if records else 0
+        if created:
+            self.item_cf.apply([(name, track_id, created)])
+        return created
+
+    async def remove_like(self, name, track_id):
+        records = await self._write(DELETE_LIKE_QUERY, pname=name, trackidentifier=track_id)
+        removed = records[0]['removed'] if records else 0
+        if removed:
+            self.item_cf.apply([(name, track_id, -removed)])
+
+    async def log_likes(self, likes, batch_size=BULK_BATCH_SIZE):
+        created = []
+        for batch in batched(likes, batch_size):
+            records = await self._write(CREATE_LIKES_QUERY, likes=[{'name': name, 'track_id': int(track_id)} for name, track_id in batch])
+            created.extend((r['name'], r['track_id']) for r in records)
+        self.item_cf.apply([(name, track_id, 1) for name, track_id in created])
+        return created
+
+    async def _flush_likes(self, likes):
+        remaining = {}
+        for like in await self.log_likes(likes):
+            remaining[like] = remaining.get(like, 0) + 1
+        results = []
+        for name, track_id in likes:
+            key = (name, int(track_id))
+            if remaining.get(key):
+                remaining[key] -= 1
+                results.append(1)
+            else:
+                results.append(0)
+        return results
+
+    async def create_friendship(self, a, b):
+        await self._write(
+            "MATCH (a:Person),(b:Person) "
+            "WHERE a.name = $paname AND b.name = $pbname "
+            "CREATE (a)-[:FRIENDS_WITH]->(b), (b)-[:FRIENDS_WITH]->(a)", paname=a, pbname=b)
+
+    async def create_friendships(self, pairs, batch_size=BULK_BATCH_SIZE):
+        created = 0
+        for batch in batched(pairs, batch_size):
+            records = await self._write(
+                "UNWIND $pairs AS pair "
+                "MATCH (a:Person { name: pair[0] }) "
+                "MATCH (b:Person { name: pair[1] }) "
+                "CREATE (a)-[:FRIENDS_WITH]->(b), (b)-[:FRIENDS_WITH]->(a) "
+                "RETURN count(*) AS created", pairs=[[a, b] for a, b in batch])
+            created += records[0]['created']
+        return created
+
+    async def remove_friendship(self, a, b):
+        await self._write(
+            "MATCH (a:Person)-[r:FRIENDS_WITH]-(b:Person) "
+            "WHERE a.name = $paname AND b.name = $pbname "
+            "DELETE r", paname=a, pbname=b)
+
+    async def get_liked_songs(self, name):
+        records = await self._read(
+            "MATCH (a:Person)-[r:LIKES]->(b:Song) "
+            "WHERE a.name = $paname "
+            "RETURN b.id AS id", paname=name)
+        return [r['id'] for r in records]
+
+    async def get_friends(self, name):
+        records = await self._read(
+            "MATCH (a:Person)-[r:FRIENDS_WITH]->(b:Person) "
+            "WHERE a.name = $pname "
+            "RETURN b.name AS name", pname=name)
+        return [r['name'] for r in records]
+
+    async def get_network_liked_songs(self, name, depth=1, limit=None, after_id=None):
+        if depth not in (1, 2, 3):
+            raise ValueError("depth must be between 1 and 3, got {}".format(depth))
+        records = await self._read(network_liked_songs_query(depth, limit, after_id), pname=name, l=limit,
+            after=after_id)
+        return [(r['id'], r['num_likes'], r['hops']) for r in records]
+
+    async def retrieve_all_likes_data(self):
+        records = await self._read(
+            "MATCH (p:Person) "
+            "OPTIONAL MATCH (p)-[:LIKES]->(s:Song) "
+            "RETURN p.name AS name, collect(s.id) AS likes")
+        return {r['name']: r['likes'] for r in records}
+
+    async def co_liked_songs(self, track_id, k):
+        # like SocialDB, a stale table is rebuilt in the background while
+        # requests keep reading the current lists
+        if self.item_cf.stale(self.item_cf_ttl) and not self._item_cf_lock.locked():
+            self._item_cf_task = asyncio.create_task(self._rebuild_item_cf_logged())
+        return self.item_cf.neighbours(track_id, k)
+
+    async def rebuild_item_cf(self):
+        async with self._item_cf_lock:
+            self.item_cf.begin_rebuild()
+            try:
+                likes = await self.retrieve_all_likes_data()
+                await asyncio.to_thread(self.item_cf.build, likes)
+            except BaseException:
+                self.item_cf.cancel_rebuild()
+                raise
+
+    async def _rebuild_item_cf_logged(self):
+        try:
+            await self.rebuild_item_cf()
+        except Exception:
+            logging.exception("item-item rebuild raised an error")
+
+    async def _ensure_like_counts(self):
+        # backfills Song.like_count once on graphs loaded before it existed
+        if self._like_counts_checked:
+            return
+        if await self._read(MISSING_LIKE_COUNT_QUERY):
+            async with self.driver.session(database="neo4j") as session:
+                await (await session.run(REBUILD_LIKE_COUNTS_QUERY)).consume()
+        self._like_counts_checked = True
+
+    async def most_popular_songs(self, k):
+        await self._ensure_like_counts()
+        records = await self._read(MOST_POPULAR_QUERY, l=k)
+        songs = [(r['id'], r['num_listeners']) for r in records]
+        if len(songs) < k:
+            records = await self._read(UNLIKED_SONGS_QUERY, l=k - len(songs))
+            songs = pad_popular(songs, [(r['id'], r['num_listeners']) for r in records], k)
+        return songs
+
+    async def trending_songs(self, k, window=86400):
+        records = await self._read(TRENDING_QUERY, l=k, since=int((time.time() - window) * 1000))
+        return [(r['id'], r['num_listeners']) for r in records]
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import threading
+
+from pydub import AudioSegment
+
+
+class PreviewCache:
+    """Short MP3 previews encoded once and kept on disk.
+
+    Only the first `duration_ms` of the source is decoded, and a preview is
+    re-encoded only when its source file is newer than the cached copy.
+    """
+
+    def __init__(self, cache_dir='previews/', duration_ms=10000, bitrate='128k'):
+        self.cache_dir = cache_dir
+        self.duration_ms = duration_ms
+        self.bitrate = bitrate
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _track_lock(self, track_id):
+        with self._locks_lock:
+            return self._locks.setdefault(track_id, threading.Lock())
+
+    def cached_path(self, track_id):
+        return os.path.join(self.cache_dir, '{}.mp3'.format(track_id))
+
+    def is_fresh(self, track_id, source_path):
+        target = self.cached_path(track_id)
+        return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source_path)
+
+    def preview_path(self, track_id, source_path):
+        if self.is_fresh(track_id, source_path):
+            return self.cached_path(track_id)
+        with self._track_lock(track_id):
+            if not self.is_fresh(track_id, source_path):
+                self.encode(track_id, source_path)
+        return self.cached_path(track_id)
+
+    def encode(self, track_id, source_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        clip = AudioSegment.from_file(source_path, format='mp3', duration=self.duration_ms / 1000.0)
+        clip = clip[:self.duration_ms]
+        fd, tmp_path = tempfile.mkstemp(suffix='.mp3', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            clip.export(tmp_path, format='mp3', bitrate=self.bitrate)
+            # readers never observe a partially written preview
+            os.replace(tmp_path, self.cached_path(track_id))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+if __name__ == '__main__':
+    # pre-encode previews: python audio_preview.py [track_id ...]
+    from audiolib_server import MusicDB
+    fma_db = MusicDB()
+    previews = PreviewCache()
+    track_ids = [int(t) for t in sys.argv[1:]] or None
+    audio_paths = fma_db.get_audio_paths(track_ids)
+    for i, (track_id, source_path) in enumerate(sorted(audio_paths.items())):
+        try:
+            previews.preview_path(track_id, source_path)
+        except Exception as error:
+            print(track_id, error)
+        if (i + 1) % 1000 == 0:
+            print("{} previews out of {}".format(i + 1, len(audio_paths)))
+    fma_db.close()
@@ -1,52 +1,316 @@
 import psycopg2
 import os
 import numpy as np
-import math
-from pydub import AudioSegment
-from pydub.playback import play
+import threading
+import time
+import uuid
+from db_pool import ConnectionPool
+from genre_index import GenreIndex, parse_genre_query
+from track_cache import TrackCache
+from vector_index import VectorIndex, merge_neighbours, pairwise_distances
+
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+STREAM_ITERSIZE = 2000
+# seeds per most_similar_search_many call, each scanning the whole index
+MAX_BATCH_SEEDS = 500
+GENRE_MARKER_QUERY = """SELECT (SELECT count(*) FROM track), (SELECT coalesce(max(id), -1) FROM track),
+    (SELECT count(*) FROM genre), (SELECT coalesce(max(track_id), -1) FROM genre);"""
+
+
+def like_pattern(keyword):
+    escaped = keyword.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return '%' + escaped + '%'
+
+
+def search_order(column, trigram):
+    # ranked by trigram similarity when pg_trgm is installed; on stock
+    # PostgreSQL exact matches come first, then track id. Both take the
+    # lower-cased keyword as their one parameter
+    if trigram:
+        return "similarity(LOWER({}), %s) DESC, track.id".format(column)
+    return "(LOWER({}) = %s) DESC, track.id".format(column)
+
+
+def liked_songs_similarity_many(base_features, cmp_features, block_size=65536):
+    # max pairwise distance between the base user's likes and each
+    # candidate's likes, computed over all candidates at once
+    out = np.full(len(cmp_features), 999999.0)
+    base = np.asarray(base_features, dtype=np.float32).reshape(-1, 3)
+    lengths = np.array([len(f) for f in cmp_features], dtype=np.int64)
+    nonempty = np.flatnonzero(lengths)
+    if len(base) == 0 or len(nonempty) == 0:
+        return out
+
+    packed = np.concatenate([np.asarray(cmp_features[i], dtype=np.float32).reshape(-1, 3) for i in nonempty])
+    col_max = np.empty(len(packed), dtype=np.float32)
+    for start in range(0, len(packed), block_size):
+        block = packed[start:start + block_size]
+        col_max[start:start + len(block)] = pairwise_distances(base, block).max(axis=0)
+    starts = np.concatenate([[0], np.cumsum(lengths[nonempty])[:-1]])
+    out[nonempty] = np.maximum.reduceat(col_max, starts)
+    return out
+
+
+def rank_friends(user, user2likes, features, k):
+    candidates = [cmp_user for cmp_user in user2likes if cmp_user != user]
+    if k <= 0 or not candidates:
+        return []
+
+    def pack(tracks):
+        return [features[t] for t in tracks if t in features]
+
+    base_user_features = pack(user2likes.get(user, []))
+    similarity = liked_songs_similarity_many(base_user_features,
+        [pack(user2likes[cmp_user]) for cmp_user in candidates])
+
+    if k < len(candidates):
+        # keep every candidate tied with the k-th score so the
+        # (similarity, name) ordering matches a full sort
+        kth = similarity[np.argpartition(similarity, k - 1)[k - 1]]
+        top = np.flatnonzero(similarity <= kth)
+    else:
+        top = range(len(candidates))
+    similarity_arr = [(float(similarity[i]), candidates[i]) for i in top]
+    similarity_arr.sort()
+    return similarity_arr[:k]
+
+
+def track_info_row(info):
+    # (id, title, artist, listens, date_created, duration) as served to clients
+    return (info[0], (info[1] or '').strip(), info[2].strip(), info[3], info[4].strftime('%m/%d/%Y'), info[5])
+
+
+def table_rows_fit(feature_store):
+    # feature1..3 of the track table are the first PCA components of the
+    # vectors in a pca store (ingest.py) or are its vectors (prefork.py); a
+    # store of standardized features lives in another space
+    source = feature_store.manifest.get('source') or ''
+    return source.startswith('pca') or source == 'track table'
+
+
+def pad_table_rows(rows, dim):
+    # components past feature3 are unknown for tracks inserted after the
+    # store was written and are set to 0, their mean, until ingest rewrites it
+    return [tuple(r[:2]) + tuple(r[2:2 + dim]) + (0.0,) * max(dim - (len(r) - 2), 0) for r in rows]
+
+
+def fill_titles(hits, track_infos):
+    # hits from the feature store segment carry no title
+    return [(h[0], track_infos[h[0]][1] if h[0] in track_infos else None) + tuple(h[2:]) if h[1] is None else h
+        for h in hits]
+
+
+def use_ann_index(ann_index, metric, exact):
+    # the ANN index answers when one is configured for this metric, unless
+    # exact search is asked for
+    return ann_index is not None and not exact and (metric is None or metric == ann_index.metric)
+
+
+def ann_neighbours(ann_index, vector_index, track_id, k, nprobe, candidates, exclude):
+    query = vector_index.vector(track_id)
+    if query is None:
+        return []
+    hits = ann_index.search(query, k, nprobe, candidates, exclude=exclude, rerank=vector_index.vectors)
+    return [(id, vector_index.title(id), score) for id, score in hits]
 
 
 class MusicDB:
     
-    def __init__(self):
+    def __init__(self, minconn=1, maxconn=10, pool_timeout=30.0, health_check_interval=30.0, track_cache=None,
+            feature_store=None, ann_index=None, metadata_index=None, genre_index=None, genre_index_ttl=60.0,
+            **connect_kwargs):
         self.audio_dir = "fma/"
+        db_params = dict(database="musiclib", user='postgres', password='password', host='127.0.0.1', port= '5432')
+        db_params.update(connect_kwargs)
+        self.pool = ConnectionPool(minconn, maxconn, timeout=pool_timeout,
+            health_check_interval=health_check_interval, **db_params)
+        self.track_cache = TrackCache() if track_cache is None else track_cache
+        # with a FeatureStore the index searches its memory-mapped vectors
+        # instead of the three feature columns of the track table
+        self.feature_store = feature_store
+        self.vector_index = VectorIndex(base=feature_store)
+        # optional IVFIndex answering most_similar_search approximately
+        self.ann_index = ann_index
+        self._vector_index_lock = threading.Lock()
+        self._vector_index_loaded = False
+        # optional memory-mapped MetadataIndex answering hydration ahead of the
+        # track cache; tracks invalidated since it was built skip it
+        self.metadata_index = metadata_index
+        self._stale_metadata = {}
+        # GenreIndex answering genre queries and filters, built on first use
+        # and rebuilt when genre_marker() has changed, checked at most every
+        # genre_index_ttl seconds (None never checks)
+        self.genre_index = genre_index
+        self.genre_index_ttl = genre_index_ttl
+        self._genre_index_lock = threading.Lock()
+        self._genre_marker = None
+        self._genre_checked_at = None
+        # whether pg_trgm is installed, checked on the first search
+        self._trigram = None
 
     def get_db_connection(self):
-        return psycopg2.connect(database="musiclib", user='postgres', password='password', host='127.0.0.1', port= '5432')
+        return self.pool.getconn()
+
+    def release_db_connection(self, conn):
+        self.pool.putconn(conn)
 
-    def most_similar_search(self, track_id, k):
-        k += 1
+    def close(self):
+        self.pool.closeall()
+
+    def create_search_indexes(self):
         conn = None
-        out = []
-        select_query = """SELECT feature1, feature2, feature3 FROM track 
-        WHERE track.id = %s;"""
+        index_queries = [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            "CREATE INDEX IF NOT EXISTS track_title_trgm_idx ON track USING GIN (LOWER(title) gin_trgm_ops);",
+            "CREATE INDEX IF NOT EXISTS artist_name_trgm_idx ON artist USING GIN (LOWER(name) gin_trgm_ops);",
+            "CREATE INDEX IF NOT EXISTS track_artist_id_idx ON track (artist_id);",
+        ]
+        try:
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            for query in index_queries:
+                cursor.execute(query)
+            conn.commit()
+            cursor.close()
+            self._trigram = True
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+        finally:
+            if conn is not None:
+                self.release_db_connection(conn)
 
-        compute_dist_query = '''
-        SELECT id, title, SQRT(POWER(feature1 - %s, 2) + POWER(feature2 - %s, 2) + POWER(feature3 - %s, 2)) AS DIST
-        FROM track 
-        ORDER BY DIST 
-        LIMIT %s;
-        '''
+    def has_trigram(self):
+        if self._trigram is not None:
+            return self._trigram
+        conn = None
+        try:
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm';")
+            self._trigram = cursor.fetchone() is not None
+            cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+        finally:
+            if conn is not None:
+                self.release_db_connection(conn)
+        return bool(self._trigram)
+
+    def load_vector_index(self):
+        conn = None
+        added = 0
+        after_id = self.vector_index.max_id
+        select_query = """SELECT id, title, feature1, feature2, feature3 FROM track 
+        WHERE track.id > %s 
+        ORDER BY track.id;"""
+        if self.feature_store is not None and not table_rows_fit(self.feature_store):
+            self._vector_index_loaded = True
+            return added
 
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (track_id,))
-            features = cursor.fetchone()
-            if features is not None:
-                cursor.execute(compute_dist_query, (features[0], features[1], features[2], k))
-                matching =  cursor.fetchall()
-                if matching is not None:
-                    for m in matching[1:]:
-                        out.append((m[0], m[1].strip(), m[2]))
+            cursor.execute(select_query, (-1 if after_id is None else after_id,))
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                if self.feature_store is not None:
+                    rows = pad_table_rows(rows, self.feature_store.dim)
+                added += self.vector_index.add(rows)
+                self._add_to_ann_index(rows)
             cursor.close()
+            self._vector_index_loaded = True
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
-            return out
+                self.release_db_connection(conn)
+            return added
+
+    def restore_vector_index(self, ids, vectors, norms, titles):
+        # arrays exported by vector_index.export(), e.g. mapped from a snapshot;
+        # tracks inserted since are picked up by the next load_vector_index
+        self.vector_index.restore(ids, vectors, norms, titles)
+        if self.ann_index is not None:
+            missing = [i for i, t in enumerate(ids.tolist()) if t not in self.ann_index]
+            if missing:
+                self.ann_index.add(ids[missing], np.asarray(vectors[missing])[:, :self.ann_index.dim])
+        self._vector_index_loaded = True
+
+    def track_marker(self):
+        # (row count, max id) of the track table, to tell whether a snapshot
+        # of the vector index is still current
+        conn = None
+        marker = None
+        try:
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT count(*), coalesce(max(id), -1) FROM track;")
+            count, max_id = cursor.fetchone()
+            marker = {'tracks': int(count), 'max_id': int(max_id)}
+            cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+        finally:
+            if conn is not None:
+                self.release_db_connection(conn)
+        return marker
+
+    def add_tracks_to_index(self, rows):
+        rows = list(rows)
+        added = self.vector_index.add(rows)
+        self._add_to_ann_index(rows, replace=True)
+        return added
+
+    def _add_to_ann_index(self, rows, replace=False):
+        if self.ann_index is None:
+            return
+        rows = [r for r in rows if replace or int(r[0]) not in self.ann_index]
+        if rows:
+            self.ann_index.add([int(r[0]) for r in rows], [r[2:2 + self.ann_index.dim] for r in rows])
+
+    def _ensure_vector_index(self, track_ids):
+        # with a feature store only tracks past its max id are loaded, into
+        # the delta segment
+        if not self._vector_index_loaded:
+            with self._vector_index_lock:
+                if not self._vector_index_loaded:
+                    self.load_vector_index()
+        if any(t not in self.vector_index for t in track_ids):
+            # tracks inserted since the last load are picked up incrementally
+            self.load_vector_index()
 
+    def most_similar_search(self, track_id, k, metric=None, nprobe=None, candidates=None, exact=False,
+            genre=None):
+        allowed = None if genre is None else self.genre_tracks(genre)
+        self._ensure_vector_index([track_id])
+        if allowed is not None:
+            # the genre filter is applied inside the exact scan, not to its results
+            hits = self.vector_index.most_similar(track_id, k, metric, allowed=allowed)
+        elif use_ann_index(self.ann_index, metric, exact):
+            hits = ann_neighbours(self.ann_index, self.vector_index, track_id, k, nprobe, candidates, (track_id,))
+        else:
+            hits = self.vector_index.most_similar(track_id, k, metric)
+        return self._with_titles(hits)
+
+    def most_similar_search_many(self, track_ids, k, mode='union', metric=None, nprobe=None, candidates=None,
+            exact=False):
+        # returns [(id, title, score, seed)], see VectorIndex.most_similar_many
+        track_ids = list(dict.fromkeys(int(t) for t in track_ids))
+        if len(track_ids) > MAX_BATCH_SEEDS:
+            raise ValueError("at most {} seed tracks, got {}".format(MAX_BATCH_SEEDS, len(track_ids)))
+        self._ensure_vector_index(track_ids)
+        if mode == 'union' and use_ann_index(self.ann_index, metric, exact):
+            per_seed = {t: ann_neighbours(self.ann_index, self.vector_index, t, k, nprobe, candidates, track_ids)
+                for t in track_ids if t in self.vector_index}
+            return self._with_titles(merge_neighbours(per_seed, k, self.ann_index.metric))
+        return self._with_titles(self.vector_index.most_similar_many(track_ids, k, mode, metric))
+
+    def _with_titles(self, hits):
+        missing = [h[0] for h in hits if h[1] is None]
+        return fill_titles(hits, self.get_track_infos(missing)) if missing else hits
 
     def get_track_features(self, track_id):
         conn = None
@@ -65,95 +329,166 @@ class MusicDB:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return track_features
 
+    def get_track_features_many(self, track_ids):
+        conn = None
+        out = {}
+        track_ids = list({int(t) for t in track_ids})
+        if not track_ids:
+            return out
+        select_query = """SELECT id, feature1, feature2, feature3 FROM track 
+        WHERE track.id = ANY(%s);"""
+
+        try:
+            conn = self.get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(select_query, (track_ids,))
+            for row in cursor.fetchall():
+                out[row[0]] = [row[1], row[2], row[3]]
+            cursor.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+        finally:
+            if conn is not None:
+                self.release_db_connection(conn)
+            return out
+
     def liked_songs_similarity(self, user1_features, user2_features):
-        max_dist = None
-        for f1 in user1_features:
-            for f2 in user2_features:
-                dist = math.sqrt((f1[0] - f2[0]) ** 2 + (f1[1] - f2[1]) ** 2 + (f1[2] - f2[2]) ** 2)
-                if max_dist == None or dist > max_dist:
-                    max_dist = dist
-        if max_dist is None:
-            return 999999
-        return max_dist
+        return self.liked_songs_similarity_many(user1_features, [user2_features])[0]
 
-    def recommend_friends(self, user, user2likes, k):
-        user_tracks = user2likes[user]
-        base_user_features = [self.get_track_features(track) for track in user_tracks]
-        similarity_arr = []
-        for cmp_user in user2likes:
-            if cmp_user == user:
-                continue
-            cmp_user_tracks = user2likes[cmp_user]
-            cmp_user_features = [self.get_track_features(track) for track in cmp_user_tracks]
-            similarity = self.liked_songs_similarity(base_user_features, cmp_user_features)
-            similarity_arr.append((similarity, cmp_user))
-        
-        similarity_arr.sort()
-        if k >= len(similarity_arr):
-            return similarity_arr
-        return similarity_arr[:k]
+    def liked_songs_similarity_many(self, base_features, cmp_features):
+        return liked_songs_similarity_many(base_features, cmp_features)
 
+    def recommend_friends(self, user, user2likes, k):
+        all_tracks = set()
+        for tracks in user2likes.values():
+            all_tracks.update(tracks)
+        features = self.get_track_features_many(all_tracks)
+        return rank_friends(user, user2likes, features, k)
 
 
     def get_genres(self, track_id):
+        return self.get_genres_many([track_id]).get(int(track_id), [])
+
+    def use_feature_store(self, feature_store):
+        # swap in another memory-mapped vector set, e.g. a newer generation;
+        # delta tracks it lacks carry over and the next search loads tracks
+        # added to the track table since
+        vector_index = VectorIndex(base=feature_store)
+        ids, vectors, _, titles = self.vector_index.export()
+        if len(ids) and vector_index.dim == self.vector_index.dim:
+            _, found = feature_store.rows(ids)
+            vector_index.add([(t, titles[i]) + tuple(vectors[i].tolist())
+                for i, t in enumerate(ids.tolist()) if not found[i]])
+        self.feature_store = feature_store
+        self.vector_index = vector_index
+        self._vector_index_loaded = False
+
+    def use_metadata_index(self, metadata_index):
+        # invalidations from before its data was read are reflected in it
+        started_at = metadata_index.started_at
+        self.metadata_index = metadata_index
+        if started_at is not None:
+            self._stale_metadata = {t: at for t, at in list(self._stale_metadata.items()) if at >= started_at}
+        # genre queries re-encode from the new files on next use
+        self.genre_index = None
+
+    def _from_metadata_index(self, lookup, track_ids):
+        track_ids = {int(t) for t in track_ids}
+        if self.metadata_index is None:
+            return {}, track_ids
+        found = getattr(self.metadata_index, lookup)(track_ids - self._stale_metadata.keys())
+        return found, track_ids - set(found)
+
+    def get_genres_many(self, track_ids):
+        found, missing = self._from_metadata_index('genres', track_ids)
+        if missing:
+            found.update(self.track_cache.get_many('genres', missing, self._load_genres_many))
+        return found
+
+    def get_track_info(self, track_id):
+        return self.get_track_infos([track_id]).get(int(track_id))
+
+    def get_track_infos(self, track_ids):
+        found, missing = self._from_metadata_index('track_infos', track_ids)
+        if missing:
+            found.update(self.track_cache.get_many('info', missing, self._load_track_infos))
+        return found
+
+    def invalidate_tracks(self, track_ids):
+        invalidated_at = time.time()
+        self._stale_metadata.update((int(t), invalidated_at) for t in track_ids)
+        # rebuilt from the database by the next genre query
+        self.genre_index = None
+        self.track_cache.invalidate(('info', 'genres'), [int(t) for t in track_ids])
+
+    def _load_genres_many(self, track_ids):
         conn = None
-        out = []
-        select_query = """SELECT genre FROM genre 
-        WHERE genre.track_id = %s;"""
+        out = {}
+        track_ids = list({int(t) for t in track_ids})
+        if not track_ids:
+            return out
+        select_query = """SELECT track_id, ARRAY_AGG(RTRIM(genre)) FROM genre 
+        WHERE genre.track_id = ANY(%s) 
+        GROUP BY track_id;"""
 
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (track_id,))
-            genres = cursor.fetchall()
-            if genres is not None:
-                for g in genres:
-                    out.append(g[0].strip())
+            cursor.execute(select_query, (track_ids,))
+            for track_id, genres in cursor.fetchall():
+                out[track_id] = [g.strip() for g in genres if g is not None]
             cursor.close()
+            # tracks without genres are cached as empty lists too
+            for track_id in track_ids:
+                out.setdefault(track_id, [])
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return out
 
-    def get_track_info(self, track_id):
+    def _load_track_infos(self, track_ids):
         conn = None
-        out = None
+        out = {}
+        track_ids = list({int(t) for t in track_ids})
+        if not track_ids:
+            return out
         select_query = """SELECT track.id, track.title, artist.name, track.listens, track.date_created, track.duration 
         FROM track INNER JOIN artist  
         ON track.artist_id = artist.id 
-        WHERE track.id = %s;"""
+        WHERE track.id = ANY(%s);"""
 
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (track_id,))
-            info = cursor.fetchone()
-            if info is not None:
-                out = (info[0], info[1].strip(), info[2].strip(), info[3], info[4].strftime('%m/%d/%Y'), info[5])
+            cursor.execute(select_query, (track_ids,))
+            for info in cursor.fetchall():
+                out[info[0]] = track_info_row(info)
             cursor.close()
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return out
 
 
     def get_track_id(self, song_title):
-        prep_input = '%' + song_title.lower() + '%'
+        prep_input = like_pattern(song_title)
         conn = None
         track_id = -1
         select_query = """SELECT track.id FROM track 
-        WHERE LOWER(track.title) LIKE %s;"""
+        WHERE LOWER(track.title) LIKE %s 
+        ORDER BY {} 
+        LIMIT 1;""".format(search_order('track.title', self.has_trigram()))
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (prep_input,))
+            cursor.execute(select_query, (prep_input, song_title.lower()))
             row = cursor.fetchone()
             if row is not None:
                 track_id = row[0]
@@ -162,19 +497,21 @@ class MusicDB:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return track_id
 
-    def get_songs_like(self, song_keyword):
-        prep_input = '%' + song_keyword.lower() + '%'
+    def get_songs_like(self, song_keyword, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        prep_input = like_pattern(song_keyword)
         conn = None
         out = []
         select_query = """SELECT track.id, track.title FROM track 
-        WHERE LOWER(track.title) LIKE %s;"""
+        WHERE LOWER(track.title) LIKE %s 
+        ORDER BY {} 
+        LIMIT %s OFFSET %s;""".format(search_order('track.title', self.has_trigram()))
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (prep_input,))
+            cursor.execute(select_query, (prep_input, song_keyword.lower(), min(limit, MAX_SEARCH_LIMIT), offset))
             rows = cursor.fetchall()
             if rows is not None:
                 for r in rows:
@@ -184,45 +521,51 @@ class MusicDB:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return out
 
-    def play_song(self, song_title):
-        prep_input = '%' + song_title.lower() + '%'
+    def get_audio_paths(self, track_ids=None):
         conn = None
-        select_query = """SELECT track.id, track.title, audio.file_path FROM track 
-        INNER JOIN audio 
-        ON track.id = audio.track_id 
-        WHERE LOWER(track.title) LIKE %s;"""
+        out = {}
+        if track_ids is None:
+            select_query = """SELECT track_id, file_path FROM audio;"""
+            params = ()
+        else:
+            select_query = """SELECT track_id, file_path FROM audio 
+            WHERE audio.track_id = ANY(%s);"""
+            params = (list({int(t) for t in track_ids}),)
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (prep_input,))
-            row = cursor.fetchone()
-            if row is not None:
-                print("Playing: {}".format(row[1]))
-                audio_file_path = self.audio_dir + row[2]
-                song = AudioSegment.from_mp3(audio_file_path)[:10000]
-                play(song)
+            cursor.execute(select_query, params)
+            for track_id, file_path in cursor.fetchall():
+                if file_path is not None:
+                    out[track_id] = os.path.join(self.audio_dir, file_path)
             cursor.close()
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
+            return out
 
-    def get_artist_songs(self, artist):
-        prep_input = '%' + artist.lower() + '%'
+    def get_audio_path(self, track_id):
+        return self.get_audio_paths([track_id]).get(int(track_id))
+
+    def get_artist_songs(self, artist, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        prep_input = like_pattern(artist)
         conn = None
         out = []
         select_query = """SELECT track.id, track.title FROM artist 
         INNER JOIN track 
         ON artist.id = track.artist_id 
-        WHERE LOWER(artist.name) LIKE %s;"""
+        WHERE LOWER(artist.name) LIKE %s 
+        ORDER BY {} 
+        LIMIT %s OFFSET %s;""".format(search_order('artist.name', self.has_trigram()))
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (prep_input,))
+            cursor.execute(select_query, (prep_input, artist.lower(), min(limit, MAX_SEARCH_LIMIT), offset))
             rows = cursor.fetchall()
             if rows is not None:
                 for r in rows:
@@ -232,31 +575,136 @@ class MusicDB:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
+                self.release_db_connection(conn)
             return out
 
-    def get_tracks_by_genre(self, genre, k):
-        conn = None
-        out = []
-        prep_input = '%' + genre.lower() + '%'
-        select_query = """SELECT track_id FROM genre WHERE LOWER(genre) LIKE %s LIMIT %s;"""
+    def _iter_named_query(self, select_query, params, itersize):
+        # server-side cursor: rows arrive in batches of itersize, so memory
+        # stays bounded however many rows match; the connection is held
+        # until the generator is exhausted or closed
+        conn = self.get_db_connection()
+        cursor = None
+        try:
+            cursor = conn.cursor(name='stream_{}'.format(uuid.uuid4().hex))
+            cursor.itersize = itersize
+            cursor.execute(select_query, params)
+            for row in cursor:
+                yield row
+        finally:
+            if cursor is not None and not cursor.closed and not conn.closed:
+                cursor.close()
+            self.release_db_connection(conn)
+
+    def iter_songs_like(self, song_keyword, after_id=None, limit=None, itersize=STREAM_ITERSIZE):
+        select_query = """SELECT track.id, track.title FROM track 
+        WHERE LOWER(track.title) LIKE %s AND track.id > %s 
+        ORDER BY track.id 
+        LIMIT %s;"""
+        params = (like_pattern(song_keyword), -1 if after_id is None else after_id, limit)
+        for r in self._iter_named_query(select_query, params, itersize):
+            yield (r[0], (r[1] or '').strip())
+
+    def iter_artist_songs(self, artist, after_id=None, limit=None, itersize=STREAM_ITERSIZE):
+        select_query = """SELECT track.id, track.title FROM artist 
+        INNER JOIN track 
+        ON artist.id = track.artist_id 
+        WHERE LOWER(artist.name) LIKE %s AND track.id > %s 
+        ORDER BY track.id 
+        LIMIT %s;"""
+        params = (like_pattern(artist), -1 if after_id is None else after_id, limit)
+        for r in self._iter_named_query(select_query, params, itersize):
+            yield (r[0], (r[1] or '').strip())
+
+    def iter_track_infos(self, itersize=STREAM_ITERSIZE):
+        # every track's hydration row, in id order, for building a MetadataIndex
+        select_query = """SELECT track.id, track.title, artist.name, track.listens, track.date_created, track.duration
+        FROM track INNER JOIN artist
+        ON track.artist_id = artist.id
+        ORDER BY track.id;"""
+        for info in self._iter_named_query(select_query, (), itersize):
+            yield track_info_row(info)
 
+    def iter_genres(self, itersize=STREAM_ITERSIZE):
+        select_query = """SELECT track_id, RTRIM(genre) FROM genre ORDER BY track_id;"""
+        for track_id, genre in self._iter_named_query(select_query, (), itersize):
+            if genre is not None:
+                yield track_id, genre.strip()
+
+    def iter_track_ids(self, itersize=STREAM_ITERSIZE):
+        select_query = """SELECT id FROM track ORDER BY id;"""
+        for r in self._iter_named_query(select_query, (), itersize):
+            yield r[0]
+
+    def genre_marker(self):
+        # row counts and max ids of the track and genre tables, which change
+        # whenever tracks or genre rows are added or removed
+        conn = None
+        marker = None
         try:
             conn = self.get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(select_query, (prep_input, k ))
-            rows = cursor.fetchall()
-            if rows is not None:
-                for r in rows:
-                    out.append(r[0])
+            cursor.execute(GENRE_MARKER_QUERY)
+            marker = tuple(int(v) for v in cursor.fetchone())
             cursor.close()
         except (Exception, psycopg2.DatabaseError) as error:
             print(error)
         finally:
             if conn is not None:
-                conn.close()
-            return out
+                self.release_db_connection(conn)
+        return marker
+
+    def load_genre_index(self, from_database=False):
+        # from the mapped metadata files when they are current, otherwise one
+        # pass over the track and genre tables; None if that failed
+        try:
+            if self.metadata_index is not None and not self._stale_metadata and not from_database:
+                self.genre_index = GenreIndex.from_metadata_index(self.metadata_index)
+            else:
+                self.genre_index = GenreIndex.build(self.iter_track_ids(), self.iter_genres())
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+            return None
+        return self.genre_index
+
+    def _genre_index_expired(self):
+        return self._genre_checked_at is None or (self.genre_index_ttl is not None and
+            time.monotonic() - self._genre_checked_at > self.genre_index_ttl)
 
+    def _current_genre_index(self):
+        genre_index = self.genre_index
+        if genre_index is not None and not self._genre_index_expired():
+            return genre_index
+        with self._genre_index_lock:
+            if self.genre_index is not None and not self._genre_index_expired():
+                return self.genre_index
+            marker = self.genre_marker()
+            if self.genre_index is None:
+                loaded = self.load_genre_index()
+            elif marker is not None and marker != self._genre_marker:
+                # the tables changed since the index was built, so the
+                # metadata files are behind them too
+                loaded = self.load_genre_index(from_database=True)
+            else:
+                loaded = self.genre_index
+            if loaded is not None:
+                if marker is not None:
+                    self._genre_marker = marker
+                self._genre_checked_at = time.monotonic()
+            return self.genre_index
+
+    def genre_tracks(self, genre):
+        """Sorted ids of the tracks matching a genre name or an expression such as "Jazz AND NOT Pop".
+
+        Raises ValueError for a malformed expression.
+        """
+        query = parse_genre_query(genre)
+        genre_index = self._current_genre_index()
+        if genre_index is None:
+            return np.empty(0, dtype=np.int64)
+        return genre_index.tracks(query)
+
+    def get_tracks_by_genre(self, genre, k):
+        return self.genre_tracks(genre)[:int(k)].tolist()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from bench.run import percentile_summary
+from feature_store import open_feature_store, write_feature_store
+from vector_index import VectorIndex
+
+
+def clustered_vectors(n, dim, n_clusters, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=4.0, size=(n_clusters, dim))
+    vectors = centers[rng.integers(0, n_clusters, size=n)] + rng.normal(size=(n, dim))
+    return np.arange(1, n + 1, dtype=np.int64), vectors.astype(np.float32)
+
+
+def measure(search, queries, k, exact):
+    latencies, recalls = [], []
+    for track_id in queries:
+        t0 = time.perf_counter()
+        hits = search(track_id)
+        latencies.append(time.perf_counter() - t0)
+        recalls.append(len({h[0] for h in hits} & exact[track_id]) / max(len(exact[track_id]), 1))
+    summary = percentile_summary(latencies)
+    summary['recall'] = float(np.mean(recalls))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and latency of the IVF index against exact k-NN search.")
+    parser.add_argument('--feature-store', help="feature store to index, default a synthetic clustered set")
+    parser.add_argument('--vectors', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=64)
+    parser.add_argument('--lists', type=int, default=None, help="default 4 * sqrt(n)")
+    parser.add_argument('--pq', type=int, default=0)
+    parser.add_argument('--metric', choices=['euclidean', 'cosine'], default='euclidean')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nprobe', default='1,2,4,8,16,32,64')
+    parser.add_argument('--candidates', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_results_ann.json')
+    args = parser.parse_args()
+
+    if args.feature_store:
+        store = open_feature_store(args.feature_store)
+    else:
+        store_dir = tempfile.mkdtemp(prefix='ann_recall_')
+        write_feature_store(store_dir, *clustered_vectors(args.vectors, args.dim, args.clusters, args.seed),
+            source='synthetic')
+        store = open_feature_store(store_dir)
+    exact_index = VectorIndex(base=store, metric=args.metric)
+    n_lists = args.lists or max(1, int(4 * np.sqrt(len(store))))
+
+    t0 = time.perf_counter()
+    ann = IVFIndex(n_lists, args.metric, args.pq, args.seed).build(store.ids, store.vectors)
+    build_seconds = time.perf_counter() - t0
+    print("Built {} cells over {} x {} vectors in {:.1f}s".format(n_lists, len(store), store.dim, build_seconds),
+        file=sys.stderr)
+
+    rng = np.random.default_rng(args.seed + 1)
+    queries = [int(t) for t in rng.choice(store.ids, size=min(args.queries, len(store)), replace=False)]
+    exact = {t: {h[0] for h in exact_index.most_similar(t, args.k)} for t in queries}
+    rows = [dict(measure(lambda t: exact_index.most_similar(t, args.k), queries, args.k, exact), nprobe='exact')]
+    for nprobe in [int(p) for p in args.nprobe.split(',')]:
+        def search(t):
+            return ann.search(store.vector(t), args.k, nprobe, args.candidates, exclude=(t,),
+                rerank=exact_index.vectors)
+        rows.append(dict(measure(search, queries, args.k, exact), nprobe=nprobe))
+
+    result = {'config': vars(args), 'vectors': len(store), 'dim': store.dim, 'lists': n_lists,
+        'build_seconds': build_seconds, 'results': rows}
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print("{:>8} {:>9} {:>9} {:>9}".format('nprobe', 'recall', 'p50 ms', 'p95 ms'))
+    for row in rows:
+        print("{:>8} {:>9.3f} {:>9.2f} {:>9.2f}".format(row['nprobe'], row['recall'], row['p50_ms'], row['p95_ms']))
+
+
+if __name__ == '__main__':
+    main()
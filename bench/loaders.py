@@ -0,0 +1,29 @@
+from ingest import TRACK_COLUMNS, copy_rows
+
+
+def load_postgres(catalogue, fma_db):
+    # wipes the relational tables of the target database
+    conn = fma_db.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("TRUNCATE audio, genre, track, artist;")
+        copy_rows(cursor, 'artist', ['id', 'name', 'bio', 'location'], catalogue.artist_rows())
+        copy_rows(cursor, 'track', TRACK_COLUMNS, catalogue.track_rows())
+        copy_rows(cursor, 'genre', ['track_id', 'genre'], catalogue.genre_rows())
+        cursor.execute("CREATE INDEX IF NOT EXISTS genre_track_id_idx ON genre (track_id);")
+        conn.commit()
+        cursor.close()
+    finally:
+        fma_db.release_db_connection(conn)
+    fma_db.create_search_indexes()
+
+
+def load_neo4j(catalogue, graph_db):
+    # wipes every node and relationship of the target graph
+    with graph_db.driver.session(database="neo4j") as session:
+        session.run("MATCH (n) CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS").consume()
+    graph_db.create_schema()
+    graph_db.create_songs(catalogue.track_ids.tolist())
+    graph_db.create_people(catalogue.users)
+    graph_db.log_likes(catalogue.likes)
+    graph_db.create_friendships(catalogue.friendships)
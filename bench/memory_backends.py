@@ -0,0 +1,386 @@
+import heapq
+import time
+from collections import deque
+
+from neo4j.exceptions import ConstraintError
+
+from audiolib_server import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, MusicDB, pad_table_rows, \
+    table_rows_fit
+from graph_server import MOST_POPULAR_QUERY, REBUILD_LIKE_COUNTS_QUERY, UNLIKED_SONGS_QUERY, SocialDB
+
+
+class MemoryMusicDB(MusicDB):
+    """MusicDB whose SQL round trips are answered from a synthetic Catalogue.
+
+    Only the methods that talk to PostgreSQL are replaced, so caching, the
+    vector index and friend ranking run the production code paths. Every
+    replaced call counts as one round trip.
+    """
+
+    def __init__(self, catalogue, **kwargs):
+        super().__init__(minconn=0, **kwargs)
+        self.catalogue = catalogue
+        self.round_trips = 0
+        self._rows = {int(t): i for i, t in enumerate(catalogue.track_ids)}
+        self._artist_names = dict(zip(catalogue.artist_ids.tolist(), catalogue.artist_names))
+
+    def _row_values(self, i):
+        c = self.catalogue
+        return (int(c.track_ids[i]), c.titles[i]) + tuple(float(f) for f in c.features[i])
+
+    def load_vector_index(self):
+        if self.feature_store is not None and not table_rows_fit(self.feature_store):
+            self._vector_index_loaded = True
+            return 0
+        self.round_trips += 1
+        after_id = self.vector_index.max_id
+        rows = [self._row_values(i) for t, i in self._rows.items() if after_id is None or t > after_id]
+        if self.feature_store is not None:
+            rows = pad_table_rows(rows, self.feature_store.dim)
+        self._vector_index_loaded = True
+        return self.vector_index.add(rows)
+
+    def get_track_features_many(self, track_ids):
+        self.round_trips += 1
+        features = self.catalogue.features
+        return {int(t): features[self._rows[int(t)]].tolist() for t in track_ids if int(t) in self._rows}
+
+    def _load_track_infos(self, track_ids):
+        self.round_trips += 1
+        c = self.catalogue
+        out = {}
+        for t in track_ids:
+            i = self._rows.get(int(t))
+            if i is None:
+                continue
+            artist = self._artist_names[int(c.artist_ids[c.track_artists[i]])]
+            out[int(t)] = (int(t), c.titles[i], artist, int(c.listens[i]), c.dates[i].strftime('%m/%d/%Y'),
+                int(c.durations[i]))
+        return out
+
+    def _load_genres_many(self, track_ids):
+        self.round_trips += 1
+        out = {}
+        for t in track_ids:
+            i = self._rows.get(int(t))
+            out[int(t)] = [] if i is None else list(self.catalogue.track_genres[i])
+        return out
+
+    def iter_track_infos(self, itersize=None):
+        infos = self._load_track_infos(self._rows)
+        for track_id in sorted(infos):
+            yield infos[track_id]
+
+    def iter_genres(self, itersize=None):
+        genres = self._load_genres_many(self._rows)
+        for track_id in sorted(genres):
+            for genre in genres[track_id]:
+                yield track_id, genre
+
+    def _matching_titles(self, keyword, after_id=None):
+        keyword = keyword.lower()
+        for t, i in self._rows.items():
+            if (after_id is None or t > after_id) and keyword in self.catalogue.titles[i].lower():
+                yield (t, self.catalogue.titles[i])
+
+    def _matching_artist_tracks(self, artist, after_id=None):
+        artist = artist.lower()
+        c = self.catalogue
+        for t, i in self._rows.items():
+            name = self._artist_names[int(c.artist_ids[c.track_artists[i]])]
+            if (after_id is None or t > after_id) and artist in name.lower():
+                yield (t, c.titles[i])
+
+    def get_songs_like(self, song_keyword, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        self.round_trips += 1
+        matches = list(self._matching_titles(song_keyword))
+        return matches[offset:offset + min(limit, MAX_SEARCH_LIMIT)]
+
+    def iter_songs_like(self, song_keyword, after_id=None, limit=None, itersize=None):
+        self.round_trips += 1
+        for n, row in enumerate(self._matching_titles(song_keyword, after_id)):
+            if limit is not None and n >= limit:
+                break
+            yield row
+
+    def get_artist_songs(self, artist, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+        self.round_trips += 1
+        matches = list(self._matching_artist_tracks(artist))
+        return matches[offset:offset + min(limit, MAX_SEARCH_LIMIT)]
+
+    def iter_artist_songs(self, artist, after_id=None, limit=None, itersize=None):
+        self.round_trips += 1
+        for n, row in enumerate(self._matching_artist_tracks(artist, after_id)):
+            if limit is not None and n >= limit:
+                break
+            yield row
+
+    def get_audio_paths(self, track_ids=None):
+        self.round_trips += 1
+        return {}
+
+    def genre_marker(self):
+        self.round_trips += 1
+        genres = self.catalogue.track_genres
+        return (len(self._rows), max(self._rows, default=-1), sum(len(genres[i]) for i in self._rows.values()),
+            max((t for t, i in self._rows.items() if genres[i]), default=-1))
+
+    def iter_track_ids(self, itersize=None):
+        self.round_trips += 1
+        return iter(sorted(self._rows))
+
+class MemoryGraph:
+    """Songs, people, LIKES and FRIENDS_WITH relationships held in dicts.
+
+    likes maps a person to one (track_id, created_at ms) pair per LIKES
+    relationship and friends to the target of each outgoing FRIENDS_WITH, so
+    duplicate relationships behave as they do in Neo4j.
+    """
+
+    def __init__(self, catalogue):
+        now = int(time.time() * 1000)
+        self.songs = {int(t): 0 for t in catalogue.track_ids}
+        self.likes = {user: [] for user in catalogue.users}
+        self.friends = {user: [] for user in catalogue.users}
+        for user, track_id in catalogue.likes:
+            self.likes[user].append((int(track_id), now))
+            self.songs[int(track_id)] += 1
+        for a, b in catalogue.friendships:
+            self.friends[a].append(b)
+            self.friends[b].append(a)
+
+    def recount_likes(self):
+        self.songs = dict.fromkeys(self.songs, 0)
+        for likes in self.likes.values():
+            for track_id, _ in likes:
+                self.songs[track_id] += 1
+
+
+class MemoryResult:
+
+    def consume(self):
+        return self
+
+    def single(self):
+        return None
+
+
+class MemorySession:
+    """Session whose transaction functions receive the MemoryGraph as tx."""
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute_read(self, fn, *args):
+        self.driver.round_trips += 1
+        return fn(self.driver.graph, *args)
+
+    execute_write = execute_read
+
+    def run(self, query):
+        # schema commands are no-ops and the counters are always backfilled,
+        # so only the recount has any effect
+        self.driver.round_trips += 1
+        if query == REBUILD_LIKE_COUNTS_QUERY:
+            self.driver.graph.recount_likes()
+        return MemoryResult()
+
+
+class MemoryDriver:
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.round_trips = 0
+
+    def session(self, database=None):
+        return MemorySession(self)
+
+    def close(self):
+        pass
+
+
+class MemorySocialDB(SocialDB):
+    """SocialDB whose Cypher transactions run against a MemoryGraph.
+
+    Only the transaction functions are replaced, so the likes snapshot,
+    popularity tracker, item-item lists and batching run the production code
+    paths. Every session call counts as one round trip.
+    """
+
+    def __init__(self, catalogue, **kwargs):
+        super().__init__('bolt://localhost:7687', 'neo4j', 'password', **kwargs)
+        self.driver.close()
+        self.driver = MemoryDriver(MemoryGraph(catalogue))
+
+    @property
+    def round_trips(self):
+        return self.driver.round_trips
+
+    @staticmethod
+    def _count_people_and_likes(tx):
+        return {'people': len(tx.likes), 'likes': sum(len(likes) for likes in tx.likes.values())}
+
+    @staticmethod
+    def _create_and_return_person(tx, name):
+        tx.likes.setdefault(name, [])
+        tx.friends.setdefault(name, [])
+
+    @staticmethod
+    def _delete_and_return_person(tx, name):
+        if name not in tx.likes:
+            return
+        # DELETE without DETACH refuses a node that still has relationships
+        if tx.likes[name] or tx.friends[name] or any(name in friends for friends in tx.friends.values()):
+            raise ConstraintError("Cannot delete node<{}>, because it still has relationships".format(name))
+        del tx.likes[name], tx.friends[name]
+
+    @staticmethod
+    def _create_and_return_song(tx, track_id):
+        tx.songs.setdefault(int(track_id), 0)
+
+    @staticmethod
+    def _create_and_return_like(tx, name, track_id):
+        if name not in tx.likes or track_id not in tx.songs:
+            return 0
+        tx.likes[name].append((track_id, int(time.time() * 1000)))
+        tx.songs[track_id] += 1
+        return 1
+
+    @staticmethod
+    def _destroy_and_return_like(tx, name, track_id):
+        likes = tx.likes.get(name, [])
+        kept = [like for like in likes if like[0] != track_id]
+        removed = len(likes) - len(kept)
+        if removed:
+            tx.likes[name] = kept
+            tx.songs[track_id] = max(tx.songs[track_id] - removed, 0)
+        return removed
+
+    @staticmethod
+    def _create_and_return_friendship(tx, a, b):
+        if a not in tx.friends or b not in tx.friends:
+            return 0
+        tx.friends[a].append(b)
+        tx.friends[b].append(a)
+        return 2
+
+    @staticmethod
+    def _destroy_friendship(tx, a, b):
+        deleted = 0
+        for x, y in ((a, b), (b, a)):
+            friends = tx.friends.get(x, [])
+            kept = [f for f in friends if f != y]
+            deleted += len(friends) - len(kept)
+            if x in tx.friends:
+                tx.friends[x] = kept
+        return deleted
+
+    @staticmethod
+    def _retrieve_liked_songs(tx, name):
+        return [track_id for track_id, _ in tx.likes.get(name, [])]
+
+    @staticmethod
+    def _retrieve_friends(tx, name):
+        return list(tx.friends.get(name, []))
+
+    @staticmethod
+    def _retrieve_network_liked_songs(tx, name, depth, limit, after_id=None):
+        if name not in tx.friends:
+            return []
+        hops = {name: 0}
+        queue = deque([name])
+        while queue:
+            person = queue.popleft()
+            if hops[person] == depth:
+                continue
+            for f in tx.friends[person]:
+                if f not in hops:
+                    hops[f] = hops[person] + 1
+                    queue.append(f)
+        counts, min_hops = {}, {}
+        for person, h in hops.items():
+            if person == name:
+                continue
+            for track_id in set(t for t, _ in tx.likes[person]):
+                counts[track_id] = counts.get(track_id, 0) + 1
+                min_hops[track_id] = min(h, min_hops.get(track_id, h))
+        rows = [(t, counts[t], min_hops[t]) for t in counts if after_id is None or t > after_id]
+        if after_id is None:
+            rows.sort(key=lambda r: (-r[1], r[2], r[0]))
+        else:
+            rows.sort()
+        return rows if limit is None else rows[:limit]
+
+    @staticmethod
+    def _retrieve_all_likes(tx):
+        return {name: [track_id for track_id, _ in likes] for name, likes in tx.likes.items()}
+
+    @staticmethod
+    def _query_most_popular(tx, query, k):
+        if query == MOST_POPULAR_QUERY:
+            liked = ((t, n) for t, n in tx.songs.items() if n > 0)
+            return heapq.nsmallest(k, liked, key=lambda item: (-item[1], item[0]))
+        if query == UNLIKED_SONGS_QUERY:
+            return [(t, 0) for t in heapq.nsmallest(k, (t for t, n in tx.songs.items() if n == 0))]
+        raise ValueError("no in-memory plan for {}".format(query))
+
+    @staticmethod
+    def _query_trending(tx, k, since):
+        counts = {}
+        for likes in tx.likes.values():
+            for track_id, created_at in likes:
+                if created_at > since:
+                    counts[track_id] = counts.get(track_id, 0) + 1
+        return heapq.nsmallest(k, counts.items(), key=lambda item: (-item[1], item[0]))
+
+    @staticmethod
+    def _retrieve_like_counts(tx):
+        return [(t, n) for t, n in tx.songs.items() if n > 0]
+
+    @staticmethod
+    def _retrieve_recent_likes(tx, since):
+        return [(created_at / 1000.0, track_id) for likes in tx.likes.values()
+            for track_id, created_at in likes if created_at > since]
+
+    @staticmethod
+    def _merge_songs(tx, track_ids):
+        created = sum(1 for t in set(track_ids) if t not in tx.songs)
+        for t in track_ids:
+            tx.songs.setdefault(t, 0)
+        return created
+
+    @staticmethod
+    def _merge_people(tx, names):
+        created = sum(1 for name in set(names) if name not in tx.likes)
+        for name in names:
+            tx.likes.setdefault(name, [])
+            tx.friends.setdefault(name, [])
+        return created
+
+    @staticmethod
+    def _create_likes(tx, rows):
+        created = []
+        now = int(time.time() * 1000)
+        for row in rows:
+            name, track_id = row['name'], row['track_id']
+            if name in tx.likes and track_id in tx.songs:
+                tx.likes[name].append((track_id, now))
+                tx.songs[track_id] += 1
+                created.append((name, track_id))
+        return created
+
+    @staticmethod
+    def _create_friendships(tx, pairs):
+        created = 0
+        for a, b in pairs:
+            if a in tx.friends and b in tx.friends:
+                tx.friends[a].append(b)
+                tx.friends[b].append(a)
+                created += 2
+        return created
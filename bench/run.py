@@ -0,0 +1,216 @@
+import argparse
+import concurrent.futures
+import json
+import platform
+import random
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+from bench.synthetic import GENRES, WORDS, Catalogue
+
+
+def build_requests(catalogue, n, seed):
+    rng = random.Random(seed)
+    track_ids = catalogue.track_ids.tolist()
+    users = catalogue.users
+    liked = catalogue.likes
+    genre_queries = GENRES[:4] + ['{} AND NOT {}'.format(a, b) for a, b in zip(GENRES, GENRES[1:])] + \
+        ['({} OR {}) AND NOT Pop'.format(a, b) for a, b in zip(GENRES[1:], GENRES[2:])]
+    genre_queries = [urllib.parse.quote(q) for q in genre_queries]
+    routes = [
+        ('GET /like', lambda: ('GET', '/like?name={}'.format(rng.choice(users)))),
+        ('PUT /like', lambda: ('PUT', '/like?name={}&trackid={}'.format(rng.choice(users), rng.choice(track_ids)))),
+        ('DELETE /like', lambda: ('DELETE', '/like?name={}&trackid={}'.format(*rng.choice(liked)))),
+        ('POST /like/batch', lambda: ('POST', '/like/batch', {'name': rng.choice(users),
+            'track_ids': rng.sample(track_ids, 20)})),
+        ('GET /friend', lambda: ('GET', '/friend?name={}'.format(rng.choice(users)))),
+        ('PUT /friend', lambda: ('PUT', '/friend?f1={}&f2={}'.format(rng.choice(users), rng.choice(users)))),
+        ('POST /friend/batch', lambda: ('POST', '/friend/batch', {'pairs': [rng.sample(users, 2) for _ in range(10)]})),
+        ('GET /elikes', lambda: ('GET', '/elikes?name={}&depth={}'.format(rng.choice(users), rng.choice([1, 2])))),
+        ('GET /popular', lambda: ('GET', '/popular?k=10')),
+        ('GET /popular?window', lambda: ('GET', '/popular?k=10&window=86400')),
+        ('GET /recommend', lambda: ('GET', '/recommend?trackid={}&k=10'.format(rng.choice(track_ids)))),
+        ('GET /recommend?genre', lambda: ('GET', '/recommend?trackid={}&k=10&genre={}'.format(rng.choice(track_ids),
+            rng.choice(genre_queries)))),
+        ('GET /genre', lambda: ('GET', '/genre?query={}'.format(rng.choice(genre_queries)))),
+        ('GET /recommend/blend', lambda: ('GET', '/recommend/blend?trackid={}&k=10'.format(rng.choice(track_ids)))),
+        ('GET /recommend_friends', lambda: ('GET', '/recommend_friends?name={}&k=5'.format(rng.choice(users)))),
+        ('GET /search', lambda: ('GET', '/search?keyword={}'.format(rng.choice(WORDS)))),
+        ('GET /artist', lambda: ('GET', '/artist?name={}'.format(rng.choice(WORDS)))),
+        ('PUT /user', lambda: ('PUT', '/user?name=bench{}'.format(rng.getrandbits(32)))),
+    ]
+    # (route, method, url, json body or None)
+    requests = []
+    for name, make in (routes[i % len(routes)] for i in range(n)):
+        request = make()
+        requests.append((name,) + request + (None,) * (3 - len(request)))
+    return requests
+
+
+def percentile_summary(latencies):
+    latencies = np.asarray(latencies) * 1000.0
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+    }
+
+
+def summarize(records, wall_time):
+    routes = {}
+    for name in sorted({r['route'] for r in records}):
+        rows = [r for r in records if r['route'] == name]
+        summary = percentile_summary([r['latency'] for r in rows])
+        summary['count'] = len(rows)
+        summary['errors'] = sum(1 for r in rows if r['status'] >= 500)
+        trips = [r['round_trips'] for r in rows if r['round_trips'] is not None]
+        summary['round_trips_per_request'] = float(np.mean(trips)) if trips else None
+        routes[name] = summary
+    overall = percentile_summary([r['latency'] for r in records])
+    overall['count'] = len(records)
+    overall['throughput_rps'] = len(records) / wall_time if wall_time > 0 else None
+    return {'overall': overall, 'routes': routes}
+
+
+def run_test_client(flask_app, requests, round_trips):
+    client = flask_app.test_client()
+    records = []
+    start = time.perf_counter()
+    for name, method, url, body in requests:
+        before = round_trips()
+        t0 = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        latency = time.perf_counter() - t0
+        records.append({'route': name, 'latency': latency, 'status': response.status_code,
+            'round_trips': round_trips() - before})
+    return records, time.perf_counter() - start
+
+
+def run_http(base_url, requests, concurrency):
+    def send(request):
+        name, method, url, body = request
+        data = None if body is None else json.dumps(body).encode()
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(base_url + url, data=data, method=method,
+                    headers={'Content-Type': 'application/json'})) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        return {'route': name, 'latency': time.perf_counter() - t0, 'status': status, 'round_trips': None}
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        records = list(pool.map(send, requests))
+    return records, time.perf_counter() - start
+
+
+# the in-process caches app.py enables on its SocialDB
+SOCIAL_DB_OPTIONS = dict(cache_likes=True, likes_snapshot_ttl=30, track_popularity=True, popularity_ttl=30,
+    item_cf=True, item_cf_ttl=600)
+
+
+def memory_backends(catalogue):
+    from bench.memory_backends import MemoryMusicDB, MemorySocialDB
+    fma_db, graph_db = MemoryMusicDB(catalogue), MemorySocialDB(catalogue, **SOCIAL_DB_OPTIONS)
+    return fma_db, graph_db, lambda: fma_db.round_trips + graph_db.round_trips
+
+
+def local_backends(catalogue, args):
+    import metrics
+    from audiolib_server import MusicDB
+    from bench.loaders import load_neo4j, load_postgres
+    from graph_server import SocialDB
+    fma_db = MusicDB(cursor_factory=metrics.InstrumentedCursor)
+    graph_db = SocialDB(args.neo4j_uri, args.neo4j_user, args.neo4j_password, **SOCIAL_DB_OPTIONS)
+    if args.load:
+        print("Loading synthetic catalogue into PostgreSQL and Neo4j", file=sys.stderr)
+        load_postgres(catalogue, fma_db)
+        load_neo4j(catalogue, graph_db)
+    graph_db.driver = metrics.InstrumentedDriver(graph_db.driver)
+    return fma_db, graph_db, metrics.DB_ROUND_TRIPS.total
+
+
+def compare(result, baseline):
+    print("{:<24} {:>12} {:>12} {:>8}".format('route', 'base p95 ms', 'new p95 ms', 'change'))
+    for name, summary in result['results']['routes'].items():
+        base = baseline['results']['routes'].get(name)
+        if base is None:
+            continue
+        change = (summary['p95_ms'] - base['p95_ms']) / base['p95_ms'] * 100 if base['p95_ms'] else float('nan')
+        print("{:<24} {:>12.2f} {:>12.2f} {:>7.1f}%".format(name, base['p95_ms'], summary['p95_ms'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every app.py route against a synthetic FMA-shaped catalogue.")
+    parser.add_argument('--backend', choices=['memory', 'local', 'http'], default='memory',
+        help="memory: in-process stand-ins; local: local PostgreSQL and Neo4j; http: a running server")
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--likes-per-user', type=int, default=20)
+    parser.add_argument('--friends-per-user', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--warmup', type=int, default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--load', action='store_true', help="(re)load the catalogue into the local databases, wiping them")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--neo4j-uri', default='bolt://localhost:7687')
+    parser.add_argument('--neo4j-user', default='neo4j')
+    parser.add_argument('--neo4j-password', default='password')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', help="previous results JSON to compare p95 latencies against")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    catalogue = Catalogue(args.tracks, args.users, args.likes_per_user, args.friends_per_user, seed=args.seed)
+    print("Generated {} in {:.1f}s".format(catalogue.summary(), time.perf_counter() - t0), file=sys.stderr)
+    warmup = build_requests(catalogue, args.warmup, args.seed + 1)
+    requests = build_requests(catalogue, args.requests, args.seed)
+
+    if args.backend == 'http':
+        run_http(args.url, warmup, args.concurrency)
+        records, wall_time = run_http(args.url, requests, args.concurrency)
+    else:
+        import app as app_module
+        if args.backend == 'memory':
+            fma_db, graph_db, round_trips = memory_backends(catalogue)
+        else:
+            fma_db, graph_db, round_trips = local_backends(catalogue, args)
+        app_module.fma_db, app_module.graph_db = fma_db, graph_db
+        # measure the routes alone, without a background warm-up
+        app_module.warmup = None
+        run_test_client(app_module.app, warmup, round_trips)
+        records, wall_time = run_test_client(app_module.app, requests, round_trips)
+
+    result = {
+        'config': dict(vars(args), catalogue=catalogue.summary()),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': summarize(records, wall_time),
+    }
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    overall = result['results']['overall']
+    print("{:<24} {:>6} {:>9} {:>9} {:>9} {:>8}".format('route', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'trips'))
+    for name, summary in result['results']['routes'].items():
+        trips = summary['round_trips_per_request']
+        print("{:<24} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>8}".format(name, summary['count'], summary['p50_ms'],
+            summary['p95_ms'], summary['p99_ms'], '-' if trips is None else '{:.1f}'.format(trips)))
+    print("overall: {:.1f} req/s, p95 {:.2f} ms -> {}".format(overall['throughput_rps'], overall['p95_ms'], args.out))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
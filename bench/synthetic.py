@@ -0,0 +1,90 @@
+import datetime
+
+import numpy as np
+
+GENRES = ['Pop', 'Hip-Hop', 'Folk', 'Jazz', 'Classical', 'Blues', 'International', 'Experimental', 'Electronic',
+    'Rock', 'Instrumental', 'Country', 'Spoken', 'Soul-RnB', 'Old-Time / Historic', 'Easy Listening']
+WORDS = ['electric', 'night', 'blue', 'river', 'dream', 'fire', 'city', 'love', 'ghost', 'summer', 'machine',
+    'light', 'shadow', 'ocean', 'kalimba', 'pulse', 'echo', 'golden', 'silent', 'wild', 'broken', 'star', 'rain',
+    'heart', 'road', 'magnetic', 'velvet', 'winter', 'moon', 'desert', 'glass', 'signal']
+LANGUAGES = ['en', 'en', 'en', 'fr', 'es', 'de', 'pt', 'it']
+
+
+class Catalogue:
+    """Synthetic catalogue shaped like the FMA metadata loaded by ingest.py.
+
+    Track features are drawn from per-genre clusters so similarity search has
+    structure to find; likes favour a couple of genres per user.
+    """
+
+    def __init__(self, n_tracks=10000, n_users=100, likes_per_user=20, friends_per_user=3, n_artists=None, seed=0):
+        rng = np.random.default_rng(seed)
+        n_artists = n_artists or max(1, n_tracks // 10)
+        self.seed = seed
+
+        self.artist_ids = np.arange(1, n_artists + 1, dtype=np.int64)
+        self.artist_names = ['{} {}'.format(WORDS[i % len(WORDS)].title(), i) for i in range(n_artists)]
+        self.artist_locations = [None if i % 3 else 'Location {}'.format(i % 50) for i in range(n_artists)]
+
+        self.track_ids = np.arange(2, n_tracks + 2, dtype=np.int64)
+        words = rng.integers(0, len(WORDS), size=(n_tracks, 3))
+        self.titles = ['{} {} {}'.format(WORDS[a], WORDS[b], WORDS[c]).title() for a, b, c in words]
+        self.track_artists = rng.integers(0, n_artists, size=n_tracks)
+        self.listens = rng.zipf(1.5, size=n_tracks).clip(max=10 ** 6)
+        self.interest = self.listens * rng.integers(1, 4, size=n_tracks)
+        base = datetime.date(2008, 11, 26)
+        self.dates = [base + datetime.timedelta(days=int(d)) for d in rng.integers(0, 3000, size=n_tracks)]
+        self.durations = rng.integers(30, 600, size=n_tracks)
+        self.languages = [LANGUAGES[i] for i in rng.integers(0, len(LANGUAGES), size=n_tracks)]
+
+        primary = rng.integers(0, len(GENRES), size=n_tracks)
+        secondary = rng.integers(0, len(GENRES), size=n_tracks)
+        self.track_genres = [sorted({GENRES[p], GENRES[s]}) if i % 2 else [GENRES[p]]
+            for i, (p, s) in enumerate(zip(primary, secondary))]
+        centers = rng.normal(scale=4.0, size=(len(GENRES), 3))
+        self.features = (centers[primary] + rng.normal(size=(n_tracks, 3))).astype(np.float32)
+
+        self.users = ['user{}'.format(i) for i in range(n_users)]
+        by_genre = [np.flatnonzero(primary == g) for g in range(len(GENRES))]
+        self.likes = []
+        for i, user in enumerate(self.users):
+            favourites = [by_genre[g] for g in rng.choice(len(GENRES), size=2, replace=False) if len(by_genre[g])]
+            pool = np.concatenate(favourites) if favourites else np.arange(n_tracks)
+            picks = rng.choice(pool, size=min(likes_per_user, len(pool)), replace=False)
+            self.likes.extend((user, int(self.track_ids[p])) for p in picks)
+
+        self.friendships = set()
+        for i in range(n_users):
+            for j in rng.choice(n_users, size=min(friends_per_user, max(n_users - 1, 0)), replace=False):
+                if i != j:
+                    self.friendships.add((self.users[min(i, j)], self.users[max(i, j)]))
+        self.friendships = sorted(self.friendships)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def summary(self):
+        return {
+            'tracks': len(self.track_ids),
+            'artists': len(self.artist_ids),
+            'users': len(self.users),
+            'likes': len(self.likes),
+            'friendships': len(self.friendships),
+            'seed': self.seed,
+        }
+
+    def artist_rows(self):
+        for artist_id, name, location in zip(self.artist_ids, self.artist_names, self.artist_locations):
+            yield (int(artist_id), name, None, location)
+
+    def track_rows(self):
+        for i, track_id in enumerate(self.track_ids):
+            f = self.features[i]
+            yield (int(track_id), self.titles[i], int(self.artist_ids[self.track_artists[i]]), int(self.interest[i]),
+                int(self.listens[i]), self.dates[i], int(self.durations[i]), self.languages[i],
+                float(f[0]), float(f[1]), float(f[2]))
+
+    def genre_rows(self):
+        for track_id, genres in zip(self.track_ids, self.track_genres):
+            for genre in genres:
+                yield (int(track_id), genre)
@@ -0,0 +1,147 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolError(psycopg2.Error):
+    pass
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to `maxconn`; callers block for up to
+    `timeout` seconds when every connection is checked out. Idle connections
+    are pinged before reuse once they have sat unused for longer than
+    `health_check_interval` seconds, and broken ones are replaced.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=30.0, health_check_interval=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: minconn={} maxconn={}".format(minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.connect_kwargs = connect_kwargs
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _warm(self):
+        opened = []
+        with self._cond:
+            missing = max(self.minconn - self._size, 0)
+            self._size += missing
+        try:
+            for _ in range(missing):
+                opened.append((self._connect(), time.monotonic()))
+        finally:
+            with self._cond:
+                self._size -= missing - len(opened)
+                self._idle.extend(opened)
+                self._cond.notify_all()
+
+    def getconn(self):
+        if self._size == 0 and self.minconn > 0:
+            self._warm()
+        deadline = time.monotonic() + self.timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError("timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+        if conn is not None:
+            if self._is_healthy(conn, last_used):
+                return conn
+            # broken connection: drop it and reconnect in the same slot
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        try:
+            return self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self._cond:
+            if not (close or conn.closed or self._closed):
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import sklearn.decomposition
+import sklearn.preprocessing
+
+from feature_store import save_array, save_json
+
+# bump when the fitted transform or the artifact layout changes, so cached
+# artifacts from an older pipeline are not reused
+PIPELINE_VERSION = 1
+DEFAULT_CHUNKSIZE = 20000
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_feature_chunks(features_path, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield (track ids, float64 rows) from features.csv, chunksize rows at a time.
+
+    Rows with missing values are dropped.
+    """
+    for chunk in pd.read_csv(features_path, index_col=0, header=[0, 1, 2], chunksize=chunksize):
+        values = chunk.to_numpy(dtype=np.float64)
+        keep = np.isfinite(values).all(axis=1)
+        yield chunk.index.to_numpy(dtype=np.int64)[keep], values[keep]
+
+
+def batches_of_at_least(batches, min_rows):
+    # IncrementalPCA needs at least n_components rows per partial_fit, so a
+    # short final chunk is merged into the one before it
+    pending, short = None, None
+    for batch in batches:
+        short = batch if short is None else np.vstack([short, batch])
+        if len(short) < min_rows:
+            continue
+        if pending is not None:
+            yield pending
+        pending, short = short, None
+    if pending is not None and short is not None:
+        pending = np.vstack([pending, short])
+    if pending is not None:
+        yield pending
+    elif short is not None:
+        yield short
+
+
+class FeatureTransform:
+    """StandardScaler followed by an optional PCA, fitted out of core.
+
+    Fitting streams the input twice, once for the scaler's running moments
+    and once for IncrementalPCA over the scaled chunks, so memory is bounded
+    by the chunk size rather than the catalogue. The fitted parameters are
+    plain arrays and transform is a subtract, divide and matrix product.
+    """
+
+    def __init__(self, scaler_mean, scaler_scale, pca_mean=None, pca_components=None):
+        self.scaler_mean = scaler_mean
+        self.scaler_scale = scaler_scale
+        self.pca_mean = pca_mean
+        self.pca_components = pca_components
+
+    @property
+    def n_components(self):
+        return 0 if self.pca_components is None else len(self.pca_components)
+
+    @property
+    def dim(self):
+        return self.n_components or len(self.scaler_mean)
+
+    @classmethod
+    def fit(cls, read_chunks, n_components=20):
+        """Fit from read_chunks(), a callable returning a fresh iterator of (ids, rows)."""
+        scaler = sklearn.preprocessing.StandardScaler()
+        for _, values in read_chunks():
+            scaler.partial_fit(values)
+        transform = cls(scaler.mean_, scaler.scale_)
+        if not n_components:
+            return transform
+        pca = sklearn.decomposition.IncrementalPCA(n_components=n_components)
+        for batch in batches_of_at_least((transform.scale(values) for _, values in read_chunks()), n_components):
+            pca.partial_fit(batch)
+        transform.pca_mean, transform.pca_components = pca.mean_, pca.components_
+        return transform
+
+    def scale(self, values):
+        return (np.asarray(values, dtype=np.float64) - self.scaler_mean) / self.scaler_scale
+
+    def transform(self, values):
+        scaled = self.scale(values)
+        if self.pca_components is None:
+            return scaled.astype(np.float32)
+        return ((scaled - self.pca_mean) @ self.pca_components.T).astype(np.float32)
+
+    def save(self, directory):
+        save_array(directory, 'scaler_mean.npy', self.scaler_mean)
+        save_array(directory, 'scaler_scale.npy', self.scaler_scale)
+        if self.pca_components is not None:
+            save_array(directory, 'pca_mean.npy', self.pca_mean)
+            save_array(directory, 'pca_components.npy', self.pca_components)
+
+    @classmethod
+    def load(cls, directory):
+        transform = cls(np.load(os.path.join(directory, 'scaler_mean.npy')),
+            np.load(os.path.join(directory, 'scaler_scale.npy')))
+        if os.path.exists(os.path.join(directory, 'pca_components.npy')):
+            transform.pca_mean = np.load(os.path.join(directory, 'pca_mean.npy'))
+            transform.pca_components = np.load(os.path.join(directory, 'pca_components.npy'))
+        return transform
+
+
+def artifact_name(n_components):
+    return 'pca{}'.format(n_components) if n_components else 'scaled'
+
+
+def version_id(input_sha256, n_components, fitted_on):
+    key = json.dumps([PIPELINE_VERSION, input_sha256, n_components, fitted_on])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class FeatureArtifacts:
+    """One version of the pipeline output, loaded from its directory.
+
+    Holds the fitted transform plus every track's projected vector, sorted
+    by track id and memory-mapped.
+    """
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        self.ids = np.load(os.path.join(directory, 'track_ids.npy'), mmap_mode=mmap_mode)
+        self.vectors = np.load(os.path.join(directory, 'vectors.npy'), mmap_mode=mmap_mode)
+        self.transform = FeatureTransform.load(directory)
+
+    @property
+    def version(self):
+        return self.manifest['version']
+
+    def project(self, values):
+        """Project raw features.csv rows, e.g. of newly added tracks, with the stored fit."""
+        return self.transform.transform(values)
+
+    def frame(self):
+        return pd.DataFrame(np.asarray(self.vectors), index=pd.Index(np.asarray(self.ids), name='track_id'))
+
+
+def open_features(out_dir, n_components=20):
+    """Current FeatureArtifacts for n_components under out_dir, or None."""
+    pointer = os.path.join(out_dir, artifact_name(n_components) + '.json')
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        version = json.load(f)['version']
+    return FeatureArtifacts(os.path.join(out_dir, version))
+
+
+def build_features(features_path, out_dir, n_components=20, chunksize=DEFAULT_CHUNKSIZE, refit=False):
+    """Fit (or reuse) the transform, project every track and persist a new artifact version.
+
+    Nothing is recomputed when features_path is byte-identical to the input
+    of the current version. When it has changed, rows are projected with the
+    transform already fitted unless refit is set, so added tracks land in
+    the same space as the existing ones.
+    """
+    input_sha256 = file_digest(features_path)
+    current = open_features(out_dir, n_components)
+    if current is not None and current.manifest['input_sha256'] == input_sha256 and not refit:
+        print("{} is unchanged, keeping feature version {}".format(features_path, current.version))
+        return current
+
+    def read_chunks():
+        return read_feature_chunks(features_path, chunksize)
+
+    t0 = time.perf_counter()
+    if current is None or refit:
+        transform, fitted_on = FeatureTransform.fit(read_chunks, n_components), input_sha256
+    else:
+        transform, fitted_on = current.transform, current.manifest['fitted_on']
+    version = version_id(input_sha256, n_components, fitted_on)
+    directory = os.path.join(out_dir, version)
+    os.makedirs(directory, exist_ok=True)
+
+    # only the projected output is held in memory, never the raw input
+    ids, vectors = [], []
+    for chunk_ids, values in read_chunks():
+        ids.append(chunk_ids)
+        vectors.append(transform.transform(values))
+    ids = np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+    vectors = np.concatenate(vectors) if vectors else np.empty((0, transform.dim), dtype=np.float32)
+    order = np.argsort(ids, kind='stable')
+    save_array(directory, 'track_ids.npy', ids[order])
+    save_array(directory, 'vectors.npy', np.ascontiguousarray(vectors[order]))
+    transform.save(directory)
+
+    files = {name: file_digest(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+        if name.endswith('.npy')}
+    manifest = {'version': version, 'pipeline_version': PIPELINE_VERSION, 'input': os.path.abspath(features_path),
+        'input_sha256': input_sha256, 'fitted_on': fitted_on, 'n_components': n_components, 'tracks': int(len(ids)),
+        'dim': transform.dim, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': files}
+    save_json(directory, MANIFEST_FILE, manifest)
+    # switching the pointer last means readers see either the old version or
+    # the complete new one
+    save_json(out_dir, artifact_name(n_components) + '.json', {'version': version})
+    print("{} {} feature version {} for {} tracks in {:.1f}s".format('Fitted' if fitted_on == input_sha256 else
+        'Projected', artifact_name(n_components), version, len(ids), time.perf_counter() - t0))
+    return FeatureArtifacts(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Standardize and PCA-project features.csv out of core into versioned .npy artifacts.")
+    parser.add_argument('--features', default='fma/data/fma_metadata/features.csv')
+    parser.add_argument('--out', default='feature_pipeline/')
+    parser.add_argument('--components', type=int, default=20, help="PCA components, 0 for standardized features only")
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('--refit', action='store_true', help="refit the scaler and PCA instead of reusing the current fit")
+    args = parser.parse_args()
+    build_features(args.features, args.out, args.components, args.chunksize, args.refit)
+
+
+if __name__ == '__main__':
+    main()
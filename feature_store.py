@@ -0,0 +1,103 @@
+import json
+import os
+
+import numpy as np
+
+FEATURES_FILE = 'features.npy'
+TRACK_IDS_FILE = 'track_ids.npy'
+NORMS_FILE = 'norms.npy'
+MANIFEST_FILE = 'manifest.json'
+
+
+def save_array(directory, name, array):
+    # written under a temporary name and renamed, so a reader never maps a
+    # half-written file
+    tmp_path = os.path.join(directory, name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+
+def save_json(directory, name, obj):
+    tmp_path = os.path.join(directory, name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+
+def write_feature_store(directory, track_ids, features, source=None):
+    """Persist track vectors as float32 .npy files sorted by track id."""
+    track_ids = np.asarray(track_ids, dtype=np.int64)
+    features = np.asarray(features, dtype=np.float32)
+    if features.ndim != 2 or len(features) != len(track_ids):
+        raise ValueError("expected one feature row per track id, got {} ids and shape {}".format(
+            len(track_ids), features.shape))
+    order = np.argsort(track_ids, kind='stable')
+    track_ids, features = track_ids[order], np.ascontiguousarray(features[order])
+    if len(track_ids) and (np.diff(track_ids) == 0).any():
+        raise ValueError("duplicate track ids in feature store input")
+
+    os.makedirs(directory, exist_ok=True)
+    save_array(directory, FEATURES_FILE, features)
+    save_array(directory, TRACK_IDS_FILE, track_ids)
+    save_array(directory, NORMS_FILE, np.linalg.norm(features, axis=1).astype(np.float32))
+    manifest = {'tracks': int(len(track_ids)), 'dim': int(features.shape[1]), 'source': source}
+    save_json(directory, MANIFEST_FILE, manifest)
+    return manifest
+
+
+def open_feature_store(directory):
+    """FeatureStore for directory, or None when nothing has been written there."""
+    if not os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        return None
+    return FeatureStore(directory)
+
+
+class FeatureStore:
+    """Read-only track vectors memory-mapped from a write_feature_store directory.
+
+    Pages are shared through the OS page cache, so every worker process
+    mapping the same files holds a single copy of the matrix. Rows are
+    sorted by track id and looked up with a binary search.
+    """
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.vectors = np.load(os.path.join(directory, FEATURES_FILE), mmap_mode=mmap_mode)
+        self.ids = np.load(os.path.join(directory, TRACK_IDS_FILE), mmap_mode=mmap_mode)
+        self.norms = np.load(os.path.join(directory, NORMS_FILE), mmap_mode=mmap_mode)
+        if self.vectors.shape != (len(self.ids), self.manifest['dim']) or len(self.norms) != len(self.ids):
+            raise ValueError("feature store {} is inconsistent with its manifest".format(directory))
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, track_id):
+        i = int(np.searchsorted(self.ids, track_id))
+        if i < len(self.ids) and self.ids[i] == track_id:
+            return i
+        return None
+
+    def rows(self, track_ids):
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, track_ids).clip(max=max(len(self.ids) - 1, 0))
+        found = self.ids[rows] == track_ids if len(self.ids) else np.zeros(len(track_ids), dtype=bool)
+        return rows, found
+
+    def __contains__(self, track_id):
+        return self.row(track_id) is not None
+
+    def vector(self, track_id):
+        row = self.row(track_id)
+        return None if row is None else np.asarray(self.vectors[row])
+
+    @property
+    def max_id(self):
+        return int(self.ids[-1]) if len(self.ids) else None
@@ -0,0 +1,162 @@
+import re
+
+import numpy as np
+
+QUERY_TOKENS = re.compile(r'(\(|\)|\bAND\b|\bOR\b|\bNOT\b)')
+
+
+def encode_genres(ids, track_genres):
+    """Dictionary-encode (track id, genre) pairs against sorted ids.
+
+    Returns (offsets, codes, names): the codes of row i of ids are
+    codes[offsets[i]:offsets[i + 1]] and names[c] is the genre with code c.
+    Pairs for ids not in ids are dropped.
+    """
+    pairs = list(track_genres)
+    vocabulary = {}
+    codes = np.array([vocabulary.setdefault(genre, len(vocabulary)) for _, genre in pairs], dtype=np.int32)
+    genre_ids = np.array([track_id for track_id, _ in pairs], dtype=np.int64)
+    rows = np.searchsorted(ids, genre_ids).clip(max=max(len(ids) - 1, 0))
+    keep = ids[rows] == genre_ids if len(ids) else np.zeros(len(genre_ids), dtype=bool)
+    rows, codes = rows[keep], codes[keep]
+    order = np.argsort(rows, kind='stable')
+    counts = np.bincount(rows, minlength=len(ids))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return offsets, codes[order], sorted(vocabulary, key=vocabulary.get)
+
+
+def parse_genre_query(text):
+    """Parse a genre expression such as "Jazz AND NOT (Pop OR Rock)" into nested tuples.
+
+    AND, OR and NOT are operators only in upper case, NOT binding tightest
+    and OR loosest; everything between them is a genre name, so names may
+    contain spaces or a lower-case "and". Raises ValueError when malformed.
+    """
+    tokens = [t.strip() for t in QUERY_TOKENS.split(text or '')]
+    tokens = [t for t in tokens if t]
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        token = peek()
+        position[0] += 1
+        return token
+
+    def parse_or():
+        expr = parse_and()
+        while peek() == 'OR':
+            take()
+            expr = ('or', expr, parse_and())
+        return expr
+
+    def parse_and():
+        expr = parse_not()
+        while peek() == 'AND':
+            take()
+            expr = ('and', expr, parse_not())
+        return expr
+
+    def parse_not():
+        token = take()
+        if token == 'NOT':
+            return ('not', parse_not())
+        if token == '(':
+            expr = parse_or()
+            if take() != ')':
+                raise ValueError("unbalanced parentheses in genre query {!r}".format(text))
+            return expr
+        if token is None or token in (')', 'AND', 'OR'):
+            raise ValueError("expected a genre name in genre query {!r}".format(text))
+        return ('genre', token)
+
+    expr = parse_or()
+    if peek() is not None:
+        raise ValueError("unexpected {!r} in genre query {!r}".format(peek(), text))
+    return expr
+
+
+class GenreIndex:
+    """Genres of every track, dictionary-encoded, with a sorted id array per genre.
+
+    track_ids are the sorted ids of the whole catalogue, the set NOT is
+    taken against; offsets and codes hold each track's genre codes in that
+    row order and postings[c] the sorted ids of the tracks in genre c.
+    Queries are set operations on those arrays and never touch the database.
+    """
+
+    def __init__(self, track_ids, offsets, codes, names):
+        self.track_ids = np.asarray(track_ids, dtype=np.int64)
+        self.offsets = offsets
+        self.codes = codes
+        self.names = list(names)
+        self._codes_by_name = {name.lower(): c for c, name in enumerate(self.names)}
+        codes = np.asarray(codes)
+        rows = np.repeat(np.arange(len(self.track_ids)), np.diff(np.asarray(offsets)))
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(self.names) + 1))
+        self.postings = [np.unique(self.track_ids[rows[order[bounds[c]:bounds[c + 1]]]])
+            for c in range(len(self.names))]
+
+    @classmethod
+    def build(cls, track_ids, track_genres):
+        ids = np.unique(np.fromiter((int(t) for t in track_ids), dtype=np.int64))
+        return cls(ids, *encode_genres(ids, track_genres))
+
+    @classmethod
+    def from_metadata_index(cls, metadata_index):
+        # the shared metadata files already hold the encoded genres
+        return cls(metadata_index.ids, metadata_index.genre_offsets, metadata_index.genre_codes,
+            metadata_index.genre_names)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def match(self, name):
+        # a name selects the genre of that name, ignoring case, or failing
+        # that every genre containing it, like the LIKE query it replaces
+        name = name.lower()
+        if name in self._codes_by_name:
+            return [self._codes_by_name[name]]
+        return [c for lowered, c in self._codes_by_name.items() if name in lowered]
+
+    def tracks(self, query):
+        """Sorted ids of the tracks matching query, a genre expression or its parse_genre_query tuple."""
+        if isinstance(query, str):
+            query = parse_genre_query(query)
+        return self._evaluate(query)
+
+    def _evaluate(self, expr):
+        op = expr[0]
+        if op == 'genre':
+            codes = self.match(expr[1])
+            if len(codes) == 1:
+                return self.postings[codes[0]]
+            return np.unique(np.concatenate([self.postings[c] for c in codes])) if codes else \
+                np.empty(0, dtype=np.int64)
+        if op == 'not':
+            return np.setdiff1d(self.track_ids, self._evaluate(expr[1]), assume_unique=True)
+        if op == 'and':
+            # x AND NOT y removes y from x without materialising the complement
+            if expr[2][0] == 'not':
+                return np.setdiff1d(self._evaluate(expr[1]), self._evaluate(expr[2][1]), assume_unique=True)
+            if expr[1][0] == 'not':
+                return np.setdiff1d(self._evaluate(expr[2]), self._evaluate(expr[1][1]), assume_unique=True)
+            return np.intersect1d(self._evaluate(expr[1]), self._evaluate(expr[2]), assume_unique=True)
+        if op == 'or':
+            return np.union1d(self._evaluate(expr[1]), self._evaluate(expr[2]))
+        raise ValueError("unknown genre query operator {!r}".format(op))
+
+    def genres(self, track_ids):
+        """{track id: [genre names]} for the track_ids in the index."""
+        track_ids = np.asarray(list(track_ids), dtype=np.int64)
+        if not len(self.track_ids) or not len(track_ids):
+            return {}
+        rows = np.searchsorted(self.track_ids, track_ids).clip(max=len(self.track_ids) - 1)
+        found = self.track_ids[rows] == track_ids
+        out = {}
+        for track_id, row in zip(track_ids[found].tolist(), rows[found].tolist()):
+            codes = self.codes[self.offsets[row]:self.offsets[row + 1]]
+            out[track_id] = [self.names[c] for c in codes.tolist()]
+        return out
@@ -1,23 +1,205 @@
 from neo4j import GraphDatabase
 import logging
 from neo4j.exceptions import ServiceUnavailable
-from fma import utils
 import pandas as pd
 import random
+import threading
+import time
+
+import metrics
+from item_cf import ItemCF
+from popularity import PopularityTracker
+from write_buffer import WriteBuffer
+
+BULK_BATCH_SIZE = 5000
+
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT song_id_unique IF NOT EXISTS FOR (s:Song) REQUIRE s.id IS UNIQUE",
+    "CREATE CONSTRAINT person_name_unique IF NOT EXISTS FOR (p:Person) REQUIRE p.name IS UNIQUE",
+    "CREATE INDEX song_like_count IF NOT EXISTS FOR (s:Song) ON (s.like_count)",
+]
+
+# Song.like_count moves by one for every LIKES relationship a write creates
+# or deletes. Creating or deleting a relationship locks the song before the
+# SET reads the counter, so it stays exact however writes interleave. LIKES
+# carry created_at (epoch milliseconds) for the trending window
+CREATE_LIKE_QUERY = (
+    "MATCH (a:Person),(b:Song) "
+    "WHERE a.name = $pname AND b.id = $trackidentifier "
+    "CREATE (a)-[r:LIKES { created_at: timestamp() }]->(b) "
+    "SET b.like_count = coalesce(b.like_count, 0) + 1 "
+    "RETURN count(r) AS created"
+)
+CREATE_LIKES_QUERY = (
+    "UNWIND $likes AS like "
+    "MATCH (a:Person { name: like.name }) "
+    "MATCH (b:Song { id: like.track_id }) "
+    "CREATE (a)-[:LIKES { created_at: timestamp() }]->(b) "
+    "SET b.like_count = coalesce(b.like_count, 0) + 1 "
+    "RETURN like.name AS name, like.track_id AS track_id"
+)
+DELETE_LIKE_QUERY = (
+    "MATCH (a:Person)-[r:LIKES]->(b:Song) "
+    "WHERE a.name = $pname AND b.id = $trackidentifier "
+    "DELETE r "
+    "SET b.like_count = CASE WHEN b.like_count > 0 THEN b.like_count - 1 ELSE 0 END "
+    "RETURN count(*) AS removed"
+)
+MOST_POPULAR_QUERY = (
+    "MATCH (t:Song) "
+    "WHERE t.like_count > 0 "
+    "RETURN t.id AS id, t.like_count AS num_listeners "
+    "ORDER BY num_listeners DESC, id ASC "
+    "LIMIT $l"
+)
+# pads /popular with songs nobody likes when k exceeds the liked songs. The
+# walk follows the song_id_unique index in id order and stops after $l
+# matches, so it does not scan every Song when most are unliked
+UNLIKED_SONGS_QUERY = (
+    "MATCH (t:Song) "
+    "WHERE t.id IS NOT NULL AND coalesce(t.like_count, 0) = 0 "
+    "WITH t ORDER BY t.id ASC LIMIT $l "
+    "RETURN t.id AS id, 0 AS num_listeners"
+)
+# a liked song without a counter means the graph predates Song.like_count
+MISSING_LIKE_COUNT_QUERY = (
+    "MATCH (t:Song)<-[:LIKES]-(:Person) "
+    "WHERE t.like_count IS NULL "
+    "RETURN t.id AS id "
+    "LIMIT 1"
+)
+REBUILD_LIKE_COUNTS_QUERY = (
+    "MATCH (t:Song) "
+    "CALL { WITH t "
+    "OPTIONAL MATCH (t)<-[r:LIKES]-(:Person) "
+    "WITH t, count(r) AS n "
+    "SET t.like_count = n } IN TRANSACTIONS OF 10000 ROWS"
+)
+TRENDING_QUERY = (
+    "MATCH (:Person)-[r:LIKES]->(t:Song) "
+    "WHERE r.created_at > $since "
+    "RETURN t.id AS id, count(r) AS num_listeners "
+    "ORDER BY num_listeners DESC, id ASC "
+    "LIMIT $l"
+)
+
+
+def batched(items, batch_size):
+    items = list(items)
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def pad_popular(songs, unliked, k):
+    # songs nobody likes fill the list up to k, as the full SIZE() scan did
+    seen = {t for t, _ in songs}
+    return songs + [(t, n) for t, n in unliked if t not in seen][:max(k - len(songs), 0)]
+
+def network_liked_songs_query(depth, limit=None, after_id=None):
+    # variable-length bounds cannot be parameters, so depth must be validated
+    # by the caller. With after_id the songs are paged by id (keyset) instead
+    # of ranked. Parameters are $pname, $l and $after.
+    query = (
+        "MATCH path = (a:Person)-[:FRIENDS_WITH*1..{depth}]->(f:Person) "
+        "WHERE a.name = $pname AND f <> a "
+        "WITH f, min(length(path)) AS hops "
+        "MATCH (f)-[:LIKES]->(s:Song) "
+        "{after}"
+        "RETURN s.id AS id, count(DISTINCT f) AS num_likes, min(hops) AS hops "
+        "ORDER BY {order}"
+    ).format(depth=int(depth),
+        after="" if after_id is None else "WHERE s.id > $after ",
+        order="num_likes DESC, hops ASC, id ASC" if after_id is None else "id ASC")
+    if limit is not None:
+        query += " LIMIT $l"
+    return query
 
 class SocialDB:
 
-    def __init__(self, uri, user, password):
+    def __init__(self, uri, user, password, cache_likes=False, likes_snapshot_ttl=None, instrument=False,
+            track_popularity=False, popularity_ttl=None, trending_window=86400, item_cf=False, item_cf_ttl=None,
+            write_behind=False, write_behind_items=256, write_behind_delay=0.005, write_behind_ack='flush'):
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        if instrument:
+            self.driver = metrics.InstrumentedDriver(self.driver)
+        # optional in-process top-k of like counts answering most_popular_songs
+        # and trending_songs without touching the graph
+        self.popularity = None
+        if track_popularity:
+            self.popularity = PopularityTracker(self._load_like_counts, self._load_recent_likes,
+                trending_window, popularity_ttl)
+        # optional co-like neighbour lists, patched by like writes and rebuilt
+        # in a background thread when missing or older than item_cf_ttl
+        self.item_cf = ItemCF() if item_cf else None
+        self.item_cf_ttl = item_cf_ttl
+        self._item_cf_lock = threading.Lock()
+        # optional in-process copy of the user -> liked songs map, patched by
+        # the write methods below and reloaded once older than the ttl
+        self.cache_likes = cache_likes
+        self.likes_snapshot_ttl = likes_snapshot_ttl
+        self._likes_snapshot = None
+        self._likes_snapshot_time = 0.0
+        self._likes_lock = threading.Lock()
+        # optional write-behind queue coalescing log_like calls from concurrent
+        # requests into one log_likes transaction (see write_buffer.py for
+        # what each ack mode guarantees)
+        self.like_buffer = None
+        if write_behind:
+            self.like_buffer = WriteBuffer(self._flush_likes, write_behind_items, write_behind_delay,
+                write_behind_ack)
+        self._like_counts_checked = False
+
+    def _patch_likes_snapshot(self, patch):
+        with self._likes_lock:
+            if self._likes_snapshot is not None:
+                patch(self._likes_snapshot)
+
+    def invalidate_likes_snapshot(self):
+        with self._likes_lock:
+            self._likes_snapshot = None
+
+    def export_likes_snapshot(self):
+        with self._likes_lock:
+            return None if self._likes_snapshot is None else dict(self._likes_snapshot)
+
+    def restore_likes_snapshot(self, user2likes):
+        # a snapshot the caller has checked against graph_marker counts as
+        # freshly loaded
+        if not self.cache_likes:
+            return
+        with self._likes_lock:
+            self._likes_snapshot = user2likes
+            self._likes_snapshot_time = time.monotonic()
+
+    def graph_marker(self):
+        # people and LIKES counts, to tell whether a snapshot is still current
+        with self.driver.session(database="neo4j") as session:
+            return session.execute_read(self._count_people_and_likes)
+
+    @staticmethod
+    def _count_people_and_likes(tx):
+        query = (
+            "CALL { MATCH (p:Person) RETURN count(p) AS people } "
+            "CALL { MATCH ()-[r:LIKES]->() RETURN count(r) AS likes } "
+            "RETURN people, likes"
+        )
+        result = tx.run(query)
+        try:
+            record = result.single()
+            return {'people': record['people'], 'likes': record['likes']}
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
 
     def create_person(self, name):
         with self.driver.session(database="neo4j") as session:
             result = session.execute_write(self._create_and_return_person, name)
+        self._patch_likes_snapshot(lambda snapshot: snapshot.setdefault(name, []))
 
     @staticmethod
     def _create_and_return_person(tx, name):
         query = (
-            "CREATE (p:Person { name: $pname }) "
+            "MERGE (p:Person { name: $pname }) "
             "RETURN p"
         )
         result = tx.run(query, pname=name)
@@ -30,6 +212,7 @@ class SocialDB:
     def delete_person(self, name):
         with self.driver.session(database="neo4j") as session:
             result = session.execute_write(self._delete_and_return_person, name)
+        self._patch_likes_snapshot(lambda snapshot: snapshot.pop(name, None))
 
     @staticmethod
     def _delete_and_return_person(tx, name):
@@ -63,20 +246,25 @@ class SocialDB:
             raise
 
     def log_like(self, name, track_id):
+        if self.like_buffer is not None:
+            return self.like_buffer.submit((name, track_id))
         with self.driver.session(database="neo4j") as session:
-            result = session.execute_write(self._create_and_return_like, name, track_id)
+            created = session.execute_write(self._create_and_return_like, name, track_id)
+
+        def patch(snapshot):
+            if name in snapshot:
+                snapshot[name] = snapshot[name] + [track_id] * created
+        if created:
+            self._patch_likes_snapshot(patch)
+            self._record_like_changes([(name, track_id, created)])
+        return created
 
     @staticmethod
     def _create_and_return_like(tx, name, track_id):
-        query = (
-            "MATCH (a:Person),(b:Song) "
-            "WHERE a.name = $pname AND b.id = $trackidentifier "
-            "CREATE (a)-[r:LIKES]->(b) "
-            "RETURN r"
-        )
+        query = CREATE_LIKE_QUERY
         result = tx.run(query, pname=name, trackidentifier=track_id)
         try:
-            return result
+            return result.consume().counters.relationships_created
         except ServiceUnavailable as exception:
             logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
             raise
@@ -84,19 +272,22 @@ class SocialDB:
 
     def remove_like(self, name, track_id):
         with self.driver.session(database="neo4j") as session:
-            result = session.execute_write(self._destroy_and_return_like, name, track_id)
+            removed = session.execute_write(self._destroy_and_return_like, name, track_id)
+
+        def patch(snapshot):
+            if name in snapshot:
+                snapshot[name] = [t for t in snapshot[name] if t != track_id]
+        self._patch_likes_snapshot(patch)
+        if removed:
+            self._record_like_changes([(name, track_id, -removed)])
 
     @staticmethod
     def _destroy_and_return_like(tx, name, track_id):
-        query = (
-            "MATCH (a:Person)-[r:LIKES]->(b:Song) "
-            "WHERE a.name = $pname AND b.id = $trackidentifier "
-            "DELETE r "
-            "RETURN a, b"
-        )
+        query = DELETE_LIKE_QUERY
         result = tx.run(query, pname=name, trackidentifier=track_id)
         try:
-            return result
+            record = result.single()
+            return 0 if record is None else record['removed']
         except ServiceUnavailable as exception:
             logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
             raise
@@ -111,11 +302,14 @@ class SocialDB:
         query = (
             "MATCH (a:Person),(b:Person) "
             "WHERE a.name = $paname AND b.name = $pbname "
-            "CREATE (a)-[r:FRIENDS_WITH]->(b) "
-            "RETURN r"
+            "CREATE (a)-[:FRIENDS_WITH]->(b), (b)-[:FRIENDS_WITH]->(a)"
         )
-        tx.run(query, paname=a, pbname=b)
-        tx.run(query, paname=b, pbname=a)
+        result = tx.run(query, paname=a, pbname=b)
+        try:
+            return result.consume().counters.relationships_created
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
 
 
     def remove_friendship(self, a, b):
@@ -125,13 +319,16 @@ class SocialDB:
     @staticmethod
     def _destroy_friendship(tx, a, b):
         query = (
-            "MATCH (a:Person)-[r:FRIENDS_WITH]->(b:Person) "
+            "MATCH (a:Person)-[r:FRIENDS_WITH]-(b:Person) "
             "WHERE a.name = $paname AND b.name = $pbname "
-            "DELETE r "
-            "RETURN a, b"
+            "DELETE r"
         )
-        tx.run(query, paname=a, pbname=b)
-        tx.run(query, paname=b, pbname=a)
+        result = tx.run(query, paname=a, pbname=b)
+        try:
+            return result.consume().counters.relationships_deleted
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
 
     def get_liked_songs(self, name):
         with self.driver.session(database="neo4j") as session:
@@ -186,71 +383,329 @@ class SocialDB:
             network_liked_songs.extend(liked_songs)
         return network_liked_songs
 
+    def get_network_liked_songs(self, name, depth=1, limit=None, after_id=None):
+        if depth not in (1, 2, 3):
+            raise ValueError("depth must be between 1 and 3, got {}".format(depth))
+        with self.driver.session(database="neo4j") as session:
+            return session.execute_read(self._retrieve_network_liked_songs, name, depth, limit, after_id)
+
+    @staticmethod
+    def _retrieve_network_liked_songs(tx, name, depth, limit, after_id=None):
+        query = network_liked_songs_query(depth, limit, after_id)
+        result = tx.run(query, pname=name, l=limit, after=after_id)
+        try:
+            out = []
+            for res in result:
+                out.append((res['id'], res['num_likes'], res['hops']))
+            return out
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
     def retrieve_all_likes_data(self):
-        user_names = None
+        if not self.cache_likes:
+            return self._load_all_likes_data()
+        with self._likes_lock:
+            expired = self.likes_snapshot_ttl is not None and \
+                time.monotonic() - self._likes_snapshot_time > self.likes_snapshot_ttl
+            if self._likes_snapshot is None or expired:
+                self._likes_snapshot = self._load_all_likes_data()
+                self._likes_snapshot_time = time.monotonic()
+            # patches replace per-user lists rather than mutating them, so a
+            # shallow copy is a consistent view for the caller
+            return dict(self._likes_snapshot)
+
+    def _load_all_likes_data(self):
         with self.driver.session(database="neo4j") as session:
-            user_names = session.execute_write(self._get_all_user_names)
-        
-        user2likes = {}
-        for user in user_names:
-            user2likes[user] = self.get_liked_songs(user)
-        return user2likes
+            return session.execute_read(self._retrieve_all_likes)
 
     @staticmethod
-    def _get_all_user_names(tx):
+    def _retrieve_all_likes(tx):
         query = (
             "MATCH (p:Person) "
-            "RETURN p"
+            "OPTIONAL MATCH (p)-[:LIKES]->(s:Song) "
+            "RETURN p.name AS name, collect(s.id) AS likes"
         )
         result = tx.run(query)
         try:
-            out = []
+            user2likes = {}
             for res in result:
-                out.append(res['p']['name'])
-            return out
+                user2likes[res['name']] = res['likes']
+            return user2likes
         except ServiceUnavailable as exception:
             logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
             raise
 
+    def _record_like_changes(self, changes):
+        # changes are (name, track_id, +n liked / -n unliked) triples
+        if self.popularity is not None:
+            self.popularity.record([(track_id, delta) for _, track_id, delta in changes])
+        if self.item_cf is not None:
+            self.item_cf.apply(changes)
+
+    def co_liked_songs(self, track_id, k):
+        """[(track_id, cosine similarity)] of the songs most often liked together with track_id."""
+        if self.item_cf is None:
+            return ItemCF(k).build(self.retrieve_all_likes_data()).neighbours(track_id, k)
+        if self.item_cf.stale(self.item_cf_ttl) and not self._item_cf_lock.locked():
+            # requests keep reading the current lists, empty before the first
+            # build, while the new ones are computed
+            threading.Thread(target=self._rebuild_item_cf_logged, name='item-cf', daemon=True).start()
+        return self.item_cf.neighbours(track_id, k)
+
+    def rebuild_item_cf(self, wait=True):
+        """Rebuild the co-like lists from all likes; False if one was already running and wait is unset."""
+        if not self._item_cf_lock.acquire(blocking=wait):
+            return False
+        try:
+            self.item_cf.begin_rebuild()
+            try:
+                self.item_cf.build(self.retrieve_all_likes_data())
+            except BaseException:
+                self.item_cf.cancel_rebuild()
+                raise
+        finally:
+            self._item_cf_lock.release()
+        return True
+
+    def _rebuild_item_cf_logged(self):
+        try:
+            self.rebuild_item_cf(wait=False)
+        except Exception as exception:
+            logging.error("item-item rebuild raised an error: \n {exception}".format(exception=exception))
+
     def most_popular_songs(self, k):
+        if self.popularity is not None:
+            songs = self.popularity.top(k)
+        else:
+            self._ensure_like_counts()
+            with self.driver.session(database="neo4j") as session:
+                songs = session.execute_read(self._query_most_popular, MOST_POPULAR_QUERY, k)
+        if len(songs) < k:
+            with self.driver.session(database="neo4j") as session:
+                songs = pad_popular(songs,
+                    session.execute_read(self._query_most_popular, UNLIKED_SONGS_QUERY, k - len(songs)), k)
+        return songs
+
+    def trending_songs(self, k, window=None):
+        # window in seconds; only the tracker's own window is served in-process
+        if self.popularity is not None and (window is None or window == self.popularity.window):
+            return self.popularity.top_trending(k)
+        window = window or (self.popularity.window if self.popularity is not None else 86400)
+        since = int((time.time() - window) * 1000)
         with self.driver.session(database="neo4j") as session:
-            songs = session.execute_write(self._query_most_popular, k)
-            return songs
-    
+            return session.execute_read(self._query_trending, k, since)
+
     @staticmethod
-    def _query_most_popular(tx, k):
-        query = (
-            "MATCH (t:Song) "
-            "RETURN t, SIZE((t) <-- ()) AS num_listeners "
-            "ORDER BY num_listeners DESC "
-            "LIMIT $l"
-        )
+    def _query_most_popular(tx, query, k):
         result = tx.run(query, l=k)
         try:
             out = []
             for res in result:
-                out.append((res['t']['id'], res['num_listeners']))
+                out.append((res['id'], res['num_listeners']))
             return out
         except ServiceUnavailable as exception:
             logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
             raise
 
+    @staticmethod
+    def _query_trending(tx, k, since):
+        query = TRENDING_QUERY
+        result = tx.run(query, l=k, since=since)
+        try:
+            return [(res['id'], res['num_listeners']) for res in result]
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def _load_like_counts(self):
+        self._ensure_like_counts()
+        with self.driver.session(database="neo4j") as session:
+            return session.execute_read(self._retrieve_like_counts)
+
+    @staticmethod
+    def _retrieve_like_counts(tx):
+        query = (
+            "MATCH (t:Song) "
+            "WHERE t.like_count > 0 "
+            "RETURN t.id AS id, t.like_count AS num_listeners"
+        )
+        result = tx.run(query)
+        try:
+            return [(res['id'], res['num_listeners']) for res in result]
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def _load_recent_likes(self, since):
+        with self.driver.session(database="neo4j") as session:
+            return session.execute_read(self._retrieve_recent_likes, int(since * 1000))
+
+    @staticmethod
+    def _retrieve_recent_likes(tx, since):
+        query = (
+            "MATCH (:Person)-[r:LIKES]->(t:Song) "
+            "WHERE r.created_at > $since "
+            "RETURN r.created_at AS created_at, t.id AS id"
+        )
+        result = tx.run(query, since=since)
+        try:
+            return [(res['created_at'] / 1000.0, res['id']) for res in result]
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def rebuild_like_counts(self):
+        # recounts Song.like_count from the LIKES relationships
+        self._recount_likes()
+        if self.popularity is not None:
+            self.popularity.invalidate()
+
+    def _recount_likes(self):
+        with self.driver.session(database="neo4j") as session:
+            session.run(REBUILD_LIKE_COUNTS_QUERY).consume()
+        self._like_counts_checked = True
+
+    def _ensure_like_counts(self):
+        # graphs loaded before Song.like_count existed are backfilled once,
+        # before the counter is first read
+        if self._like_counts_checked:
+            return
+        with self.driver.session(database="neo4j") as session:
+            missing = session.run(MISSING_LIKE_COUNT_QUERY).single()
+        if missing is not None:
+            self._recount_likes()
+        self._like_counts_checked = True
+
+    def create_schema(self):
+        # schema commands cannot share a transaction with data writes
+        with self.driver.session(database="neo4j") as session:
+            for query in SCHEMA_QUERIES:
+                session.run(query).consume()
+        self._ensure_like_counts()
+
+    def create_songs(self, track_ids, batch_size=BULK_BATCH_SIZE):
+        with self.driver.session(database="neo4j") as session:
+            for batch in batched(track_ids, batch_size):
+                session.execute_write(self._merge_songs, [int(t) for t in batch])
+
+    @staticmethod
+    def _merge_songs(tx, track_ids):
+        query = (
+            "UNWIND $ids AS trackidentifier "
+            "MERGE (t:Song { id: trackidentifier })"
+        )
+        result = tx.run(query, ids=track_ids)
+        try:
+            return result.consume().counters.nodes_created
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def create_people(self, names, batch_size=BULK_BATCH_SIZE):
+        with self.driver.session(database="neo4j") as session:
+            for batch in batched(names, batch_size):
+                session.execute_write(self._merge_people, batch)
+
+        def patch(snapshot):
+            for name in names:
+                snapshot.setdefault(name, [])
+        self._patch_likes_snapshot(patch)
+
+    @staticmethod
+    def _merge_people(tx, names):
+        query = (
+            "UNWIND $names AS pname "
+            "MERGE (p:Person { name: pname })"
+        )
+        result = tx.run(query, names=names)
+        try:
+            return result.consume().counters.nodes_created
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def log_likes(self, likes, batch_size=BULK_BATCH_SIZE):
+        created = []
+        with self.driver.session(database="neo4j") as session:
+            for batch in batched(likes, batch_size):
+                rows = [{'name': name, 'track_id': int(track_id)} for name, track_id in batch]
+                created.extend(session.execute_write(self._create_likes, rows))
+
+        def patch(snapshot):
+            for name, track_id in created:
+                if name in snapshot:
+                    snapshot[name] = snapshot[name] + [track_id]
+        if created:
+            self._patch_likes_snapshot(patch)
+            self._record_like_changes([(name, track_id, 1) for name, track_id in created])
+        return created
+
+    def _flush_likes(self, likes):
+        # one entry per buffered log_like: 1 if its relationship was created
+        remaining = {}
+        for like in self.log_likes(likes):
+            remaining[like] = remaining.get(like, 0) + 1
+        results = []
+        for name, track_id in likes:
+            key = (name, int(track_id))
+            if remaining.get(key):
+                remaining[key] -= 1
+                results.append(1)
+            else:
+                results.append(0)
+        return results
+
+    @staticmethod
+    def _create_likes(tx, rows):
+        query = CREATE_LIKES_QUERY
+        result = tx.run(query, likes=rows)
+        try:
+            return [(res['name'], res['track_id']) for res in result]
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
+    def create_friendships(self, pairs, batch_size=BULK_BATCH_SIZE):
+        created = 0
+        with self.driver.session(database="neo4j") as session:
+            for batch in batched(pairs, batch_size):
+                created += session.execute_write(self._create_friendships, [[a, b] for a, b in batch])
+        # relationships are created in both directions
+        return created // 2
+
+    @staticmethod
+    def _create_friendships(tx, pairs):
+        query = (
+            "UNWIND $pairs AS pair "
+            "MATCH (a:Person { name: pair[0] }) "
+            "MATCH (b:Person { name: pair[1] }) "
+            "CREATE (a)-[:FRIENDS_WITH]->(b), (b)-[:FRIENDS_WITH]->(a)"
+        )
+        result = tx.run(query, pairs=pairs)
+        try:
+            return result.consume().counters.relationships_created
+        except ServiceUnavailable as exception:
+            logging.error("{query} raised an error: \n {exception}".format(query=query, exception=exception))
+            raise
+
     def close(self):
+        if self.like_buffer is not None:
+            self.like_buffer.close()
         self.driver.close()
 
 #-------------------------------------
 #ONLY RUN ONCE
 def populate_graphdb_tracks(conn):
+    from fma import utils
     tracks = utils.load('fma/data/fma_metadata/tracks.csv')
     track_ids = list(tracks.index.values)
-    for id in track_ids:
-        conn.create_song(int(id))
+    conn.create_songs(track_ids)
 
 def populate_graphdb_people(conn):
     names = ['Neal', 'Chris', 'Sham', 'Aditya', 'Lauren', 'Jerry', 'Ankith', \
         'Patrick', 'Anne', 'Pranav', 'Neha', 'Yao', 'Taylor', 'Griffin', 'Andy']
-    for n in names:
-        conn.create_person(n)
+    conn.create_people(names)
 
 def populate_graphdb_likes(conn):
     from audiolib_server import MusicDB
@@ -258,32 +713,38 @@ def populate_graphdb_likes(conn):
     'Patrick', 'Anne', 'Pranav', 'Neha', 'Yao', 'Taylor', 'Griffin', 'Andy']
     genres = ['Pop', 'Hip-Hop', 'Folk', 'Jazz', 'Classical', 'Blues', 'International', 'Experimental', 'Electronic']
     genre2tracks = {}
+    fma_db = MusicDB()
     for g in genres:
-        genre2tracks[g] = MusicDB().get_tracks_by_genre(g, '30')
+        genre2tracks[g] = fma_db.get_tracks_by_genre(g, '30')
+    fma_db.close()
+    likes = []
     for i, name in enumerate(names):
         tracks = random.sample(genre2tracks['Pop'], 10)
         genre_pick = i % len(genres)
         tracks.extend(random.sample(genre2tracks[genres[genre_pick]], 10))
-        for t in tracks:
-            conn.log_like(name, t)
+        likes.extend((name, t) for t in tracks)
+    conn.log_likes(likes)
 
 def populate_graphdb_friends(conn):
-    conn.create_friendship('Neal', 'Chris')
-    conn.create_friendship('Neal', 'Sham')
-    conn.create_friendship('Chris', 'Patrick')
-    conn.create_friendship("Anne", "Yao")
-    conn.create_friendship('Taylor', 'Griffin')
-    conn.create_friendship('Ankith', 'Patrick')
-    conn.create_friendship('Neha', 'Pranav')
-    conn.create_friendship('Aditya', 'Sham')
-    conn.create_friendship('Lauren', 'Andy')
-    conn.create_friendship('Aditya', 'Chris')
-    conn.create_friendship('Taylor', 'Chris')
+    conn.create_friendships([
+        ('Neal', 'Chris'),
+        ('Neal', 'Sham'),
+        ('Chris', 'Patrick'),
+        ("Anne", "Yao"),
+        ('Taylor', 'Griffin'),
+        ('Ankith', 'Patrick'),
+        ('Neha', 'Pranav'),
+        ('Aditya', 'Sham'),
+        ('Lauren', 'Andy'),
+        ('Aditya', 'Chris'),
+        ('Taylor', 'Chris'),
+    ])
 #-------------------------------------
 
 if __name__ == "__main__":
     conn = SocialDB("bolt://localhost:7687", "neo4j", "password")
     
+    conn.create_schema()
     populate_graphdb_tracks(conn)
     populate_graphdb_people(conn)
     populate_graphdb_likes(conn)
@@ -0,0 +1,253 @@
+import argparse
+import ast
+import csv
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from audiolib_server import MusicDB
+from feature_pipeline import build_features
+from feature_store import write_feature_store
+
+TRACK_COLUMNS = ['id', 'title', 'artist_id', 'interest', 'listens', 'date_created', 'duration', 'language',
+    'feature1', 'feature2', 'feature3']
+
+
+def load_genre_names(genres_path):
+    genres = pd.read_csv(genres_path, index_col=0)
+    return genres['title'].to_dict()
+
+
+def clean(value):
+    if pd.isnull(value) or value == 'nan':
+        return None
+    return value
+
+
+def truncate(value, max_len, keep):
+    value = clean(value)
+    if value is not None and len(str(value)) > max_len:
+        return str(value)[:keep]
+    return value
+
+
+def to_int(value):
+    value = clean(value)
+    return None if value is None else int(value)
+
+
+def copy_rows(cursor, table, columns, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+    if n == 0:
+        return 0
+    buf.seek(0)
+    cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns)), buf)
+    return n
+
+
+def ensure_checkpoint_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""CREATE TABLE IF NOT EXISTS ingest_checkpoint(stage TEXT PRIMARY KEY, position BIGINT NOT NULL);""")
+    conn.commit()
+    cursor.close()
+
+
+def get_checkpoint(conn, stage):
+    cursor = conn.cursor()
+    cursor.execute("SELECT position FROM ingest_checkpoint WHERE stage = %s;", (stage,))
+    row = cursor.fetchone()
+    cursor.close()
+    return 0 if row is None else row[0]
+
+
+def set_checkpoint(cursor, stage, position):
+    cursor.execute("""INSERT INTO ingest_checkpoint(stage, position) VALUES(%s, %s)
+    ON CONFLICT (stage) DO UPDATE SET position = EXCLUDED.position;""", (stage, position))
+
+
+def fetch_ids(conn, table):
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM {};".format(table))
+    ids = {r[0] for r in cursor.fetchall()}
+    cursor.close()
+    return ids
+
+
+def read_track_chunks(tracks_path, chunksize):
+    for chunk in pd.read_csv(tracks_path, index_col=0, header=[0, 1], chunksize=chunksize):
+        chunk[('track', 'genres_all')] = chunk[('track', 'genres_all')].map(ast.literal_eval)
+        chunk[('track', 'date_created')] = pd.to_datetime(chunk[('track', 'date_created')])
+        yield chunk
+
+
+def track_chunk_rows(chunk, features_output, genre_id2name, stored_artist_ids):
+    track, artist = chunk['track'], chunk['artist']
+    features = features_output.reindex(chunk.index)
+    keep = artist['id'].notnull() & artist['name'].notnull() & track['date_created'].notnull() \
+        & track['duration'].notnull() & features.notnull().all(axis=1)
+    track, artist, features = track[keep], artist[keep], features[keep]
+
+    artist_rows = []
+    for artist_id, name, bio, location in zip(artist['id'].astype(int), artist['name'], artist['bio'],
+            artist['location']):
+        if artist_id not in stored_artist_ids:
+            stored_artist_ids.add(artist_id)
+            artist_rows.append((artist_id, name, clean(bio), truncate(location, 50, 45)))
+
+    track_rows = list(zip(track.index, track['title'].map(lambda v: truncate(v, 100, 95)),
+        artist['id'].astype(int), track['interest'].map(to_int), track['listens'].map(to_int),
+        track['date_created'].dt.date, track['duration'].astype(int),
+        track['language_code'].map(lambda v: truncate(v, 10, 9)),
+        features.iloc[:, 0], features.iloc[:, 1], features.iloc[:, 2]))
+    genre_rows = [(track_id, genre_id2name[gid]) for track_id, genre_ids in zip(track.index, track['genres_all'])
+        for gid in genre_ids]
+    return artist_rows, track_rows, genre_rows
+
+
+def load_tracks(conn, metadata_dir, chunksize, features_output):
+    done = get_checkpoint(conn, 'tracks')
+    genre_id2name = load_genre_names(os.path.join(metadata_dir, 'genres.csv'))
+    stored_artist_ids = fetch_ids(conn, 'artist')
+
+    # the checkpoint counts tracks.csv rows, so a resumed run may use another
+    # chunksize and pick up part-way through a chunk
+    num_rows = 0
+    for i, chunk in enumerate(read_track_chunks(os.path.join(metadata_dir, 'tracks.csv'), chunksize)):
+        start, num_rows = num_rows, num_rows + len(chunk)
+        if num_rows <= done:
+            continue
+        chunk = chunk.iloc[max(done - start, 0):]
+        artist_rows, track_rows, genre_rows = track_chunk_rows(chunk, features_output, genre_id2name,
+            stored_artist_ids)
+        cursor = conn.cursor()
+        try:
+            copy_rows(cursor, 'artist', ['id', 'name', 'bio', 'location'], artist_rows)
+            copy_rows(cursor, 'track', TRACK_COLUMNS, track_rows)
+            copy_rows(cursor, 'genre', ['track_id', 'genre'], genre_rows)
+            # the checkpoint commits atomically with the chunk it records
+            set_checkpoint(cursor, 'tracks', num_rows)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            for artist_row in artist_rows:
+                stored_artist_ids.discard(artist_row[0])
+            raise
+        finally:
+            cursor.close()
+        print("{} tracks read, {} inserted from chunk {}".format(num_rows, len(track_rows), i + 1))
+
+
+def write_features(conn, store_dir, features, source):
+    # only tracks that made it into the track table are searchable
+    features = features[features.index.isin(fetch_ids(conn, 'track'))].dropna()
+    manifest = write_feature_store(store_dir, features.index.values, features.values.astype(np.float32), source)
+    print("Wrote {} {}-dimensional feature vectors to {}".format(manifest['tracks'], manifest['dim'], store_dir))
+
+
+def load_audio_paths(conn, audio_dir, audio_root):
+    done = get_checkpoint(conn, 'audio')
+    track_ids = fetch_ids(conn, 'track')
+    dirs = sorted(d for d in os.listdir(audio_dir) if os.path.isdir(os.path.join(audio_dir, d)))
+    for i, d in enumerate(dirs):
+        if i < done:
+            continue
+        audio_path = os.path.join(audio_dir, d)
+        rows = []
+        for f in sorted(os.listdir(audio_path)):
+            # FMA names files <track_id>.mp3; skip .DS_Store and the like
+            prefix = f.split('.', 1)[0]
+            if '.' not in f or not prefix.isdigit():
+                continue
+            track_id = int(prefix)
+            if track_id in track_ids:
+                rows.append((track_id, os.path.relpath(os.path.join(audio_path, f), audio_root)))
+        cursor = conn.cursor()
+        try:
+            copy_rows(cursor, 'audio', ['track_id', 'file_path'], rows)
+            set_checkpoint(cursor, 'audio', i + 1)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    print("Loaded audio paths from {} directories".format(len(dirs)))
+
+
+def build_indexes(fma_db, conn):
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS genre_track_id_idx ON genre (track_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS audio_track_id_idx ON audio (track_id);")
+    conn.commit()
+    cursor.close()
+    fma_db.create_search_indexes()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("ANALYZE;")
+    cursor.close()
+    conn.autocommit = False
+
+
+def reset(conn):
+    cursor = conn.cursor()
+    cursor.execute("TRUNCATE audio, genre, track, artist;")
+    cursor.execute("DELETE FROM ingest_checkpoint;")
+    conn.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load FMA metadata into the musiclib database.")
+    parser.add_argument('--metadata-dir', default='fma/data/fma_metadata')
+    parser.add_argument('--audio-dir', default='fma/data/fma_small',
+        help="directory of FMA audio subfolders, skipped if it does not exist")
+    parser.add_argument('--audio-root', default='fma/', help="audio paths are stored relative to this directory")
+    parser.add_argument('--chunksize', type=int, default=20000)
+    parser.add_argument('--reset', action='store_true', help="truncate all tables and start from scratch")
+    parser.add_argument('--feature-store', default='feature_store/',
+        help="directory for the memory-mapped feature vectors used by /recommend")
+    parser.add_argument('--feature-dims', type=int, default=20,
+        help="PCA components kept in the feature store, 0 for the raw standardized features.csv columns")
+    parser.add_argument('--feature-pipeline', default='feature_pipeline/',
+        help="directory of versioned scaler/PCA artifacts, reused while features.csv is unchanged")
+    parser.add_argument('--refit-features', action='store_true',
+        help="refit the scaler and PCA even if features.csv only gained tracks")
+    args = parser.parse_args()
+
+    fma_db = MusicDB(minconn=0, maxconn=2)
+    conn = fma_db.get_db_connection()
+    try:
+        ensure_checkpoint_table(conn)
+        if args.reset:
+            reset(conn)
+        print("Projecting audio features")
+        features_path = os.path.join(args.metadata_dir, 'features.csv')
+        projected = build_features(features_path, args.feature_pipeline, max(args.feature_dims, 3), args.chunksize,
+            args.refit_features)
+        features_projected = projected.frame()
+        # the track table keeps the first three components as feature1..3
+        load_tracks(conn, args.metadata_dir, args.chunksize, features_projected.iloc[:, :3])
+        if args.feature_dims:
+            write_features(conn, args.feature_store, features_projected.iloc[:, :args.feature_dims],
+                'pca{}@{}'.format(args.feature_dims, projected.version))
+        else:
+            scaled = build_features(features_path, args.feature_pipeline, 0, args.chunksize, args.refit_features)
+            write_features(conn, args.feature_store, scaled.frame(), 'features.csv@{}'.format(scaled.version))
+        if os.path.isdir(args.audio_dir):
+            load_audio_paths(conn, args.audio_dir, args.audio_root)
+        build_indexes(fma_db, conn)
+    finally:
+        fma_db.release_db_connection(conn)
+        fma_db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import bisect
+import threading
+import time
+
+import numpy as np
+import scipy.sparse
+
+DEFAULT_TOP_N = 50
+
+
+def top_neighbours(others, common, other_counts, song_count, top_n):
+    """Cosine top-n of one song given its co-liked songs, their co-likes and like counts."""
+    if not len(others) or not song_count:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    keep = (common > 0) & (other_counts > 0)
+    others, scores = others[keep], common[keep] / np.sqrt(song_count * other_counts[keep])
+    order = np.lexsort((others, -scores))[:top_n]
+    return others[order], scores[order].astype(np.float32)
+
+
+class ItemCF:
+    """Item-item collaborative filtering over the LIKES graph.
+
+    `build` turns user -> liked songs into a sparse user x song matrix and
+    takes its co-occurrence product; each song keeps its top_n neighbours by
+    cosine similarity (co-likes / sqrt(likes_a * likes_b)) in CSR arrays, so
+    serving is a slice. The product is kept as a song x song lil_matrix whose
+    diagonal holds each song's like count. Single likes and unlikes are
+    applied to it as deltas, and only the rows whose co-likes changed are
+    recomputed into an overlay consulted before the arrays; other songs keep
+    their scores against the liked song until the next build.
+
+    A rebuild runs alongside serving: begin_rebuild starts journaling the
+    changes applied from then on, and build replays them onto the new state
+    before swapping it in, so likes written while the graph was being read
+    are not lost.
+    """
+
+    def __init__(self, top_n=DEFAULT_TOP_N):
+        self.top_n = top_n
+        self.built_at = None
+        self._lock = threading.Lock()
+        self._user_likes = {}
+        # song id -> row of the co-like matrix, and the reverse
+        self._index = {}
+        self._song_ids = np.empty(0, dtype=np.int64)
+        self._co = scipy.sparse.lil_matrix((0, 0))
+        # (song ids, offsets, neighbour ids, scores) swapped as one tuple
+        self._lists = (np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float32))
+        self._overlay = {}
+        self._journal = None
+
+    def stale(self, ttl):
+        return self.built_at is None or (ttl is not None and time.monotonic() - self.built_at > ttl)
+
+    def begin_rebuild(self):
+        with self._lock:
+            self._journal = []
+
+    def cancel_rebuild(self):
+        with self._lock:
+            self._journal = None
+
+    def build(self, user2likes):
+        user_likes = {user: set(int(t) for t in likes) for user, likes in user2likes.items()}
+        song_ids = np.array(sorted({t for likes in user_likes.values() for t in likes}), dtype=np.int64)
+        rows, cols = [], []
+        for u, likes in enumerate(user_likes.values()):
+            rows.extend([u] * len(likes))
+            cols.extend(likes)
+        cols = np.searchsorted(song_ids, np.asarray(cols, dtype=np.int64))
+        likes_matrix = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)),
+            shape=(len(user_likes), len(song_ids)))
+        co_likes = (likes_matrix.T @ likes_matrix).tocsr()
+        counts = co_likes.diagonal()
+        co = co_likes.copy()
+        co.setdiag(0)
+        co.eliminate_zeros()
+
+        # per-row cosine top-n straight from the sparse product
+        offsets, neighbours, scores = [0], [], []
+        for i in range(len(song_ids)):
+            start, stop = co.indptr[i], co.indptr[i + 1]
+            cols_i, common = co.indices[start:stop], co.data[start:stop]
+            sims = common / np.sqrt(counts[i] * counts[cols_i])
+            order = np.lexsort((song_ids[cols_i], -sims))[:self.top_n]
+            neighbours.append(song_ids[cols_i[order]])
+            scores.append(sims[order].astype(np.float32))
+            offsets.append(offsets[-1] + len(order))
+
+        co_likes = co_likes.tolil()
+        with self._lock:
+            self._user_likes = user_likes
+            self._song_ids = song_ids
+            self._index = {t: i for i, t in enumerate(song_ids.tolist())}
+            self._co = co_likes
+            self._lists = (song_ids, np.asarray(offsets, dtype=np.int64),
+                np.concatenate(neighbours) if neighbours else np.empty(0, dtype=np.int64),
+                np.concatenate(scores) if scores else np.empty(0, dtype=np.float32))
+            self._overlay = {}
+            self.built_at = time.monotonic()
+            # replayed changes already in user2likes are skipped by _apply,
+            # which treats likes as a set
+            journal, self._journal = self._journal or [], None
+            self._apply(journal)
+        return self
+
+    def __len__(self):
+        return len(self._song_ids)
+
+    def neighbours(self, track_id, k=None):
+        """[(track_id, cosine similarity)] of the songs most co-liked with track_id."""
+        k = self.top_n if k is None else min(k, self.top_n)
+        entry = self._overlay.get(track_id)
+        if entry is None:
+            song_ids, offsets, neighbours, scores = self._lists
+            i = int(np.searchsorted(song_ids, track_id))
+            if i >= len(song_ids) or song_ids[i] != track_id:
+                return []
+            entry = (neighbours[offsets[i]:offsets[i + 1]], scores[offsets[i]:offsets[i + 1]])
+        ids, scores = entry
+        return [(int(t), float(s)) for t, s in zip(ids[:k], scores[:k])]
+
+    def _row(self, track_id):
+        i = self._index.get(track_id)
+        if i is None:
+            i = self._index[track_id] = len(self._song_ids)
+            self._song_ids = np.append(self._song_ids, track_id)
+            self._co.resize((i + 1, i + 1))
+        return i
+
+    def _count(self, i):
+        # a song's like count, read off the diagonal of its lil row
+        row = self._co.rows[i]
+        k = bisect.bisect_left(row, i)
+        return self._co.data[i][k] if k < len(row) and row[k] == i else 0
+
+    def _refresh(self, track_ids):
+        for track_id in track_ids:
+            i = self._index[track_id]
+            cols = np.asarray(self._co.rows[i], dtype=np.int64)
+            common = np.asarray(self._co.data[i], dtype=np.float64)
+            off_diagonal = cols != i
+            cols, common = cols[off_diagonal], common[off_diagonal]
+            self._overlay[track_id] = top_neighbours(self._song_ids[cols], common,
+                np.array([self._count(j) for j in cols.tolist()], dtype=np.float64), self._count(i), self.top_n)
+
+    def apply(self, changes):
+        """Apply (user, track_id, +1 like / -1 unlike) changes as deltas."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.extend(changes)
+            if self.built_at is not None:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        touched = set()
+        for user, track_id, delta in changes:
+            track_id = int(track_id)
+            likes = self._user_likes.setdefault(user, set())
+            if (delta > 0) == (track_id in likes):
+                # repeated likes of a song count once, unlikes of unliked songs not at all
+                continue
+            step = 1 if delta > 0 else -1
+            i = self._row(track_id)
+            # the diagonal entry, i == j, is the song's like count
+            for other in likes | {track_id}:
+                j = self._row(other)
+                self._co[i, j] += step
+                if j != i:
+                    self._co[j, i] += step
+            if delta > 0:
+                likes.add(track_id)
+            else:
+                likes.discard(track_id)
+            touched.add(track_id)
+            touched.update(likes)
+        self._refresh(touched)
+
+
+def blend(audio_hits, cf_hits, k, alpha=0.5, metric='euclidean'):
+    """Mix audio-similarity and co-like neighbours into [(id, score, audio, cf)].
+
+    Audio scores are min-max scaled into [0, 1] (1 = most similar) and the
+    co-like cosine is used as is; a track missing from one list scores 0
+    there. alpha weights the co-like side.
+    """
+    audio = {}
+    if audio_hits:
+        values = np.array([s for _, s in audio_hits], dtype=np.float64)
+        if metric != 'dot':
+            values = -values
+        low, high = values.min(), values.max()
+        scaled = (values - low) / (high - low) if high > low else np.ones_like(values)
+        audio = {t: float(v) for (t, _), v in zip(audio_hits, scaled)}
+    cf = dict(cf_hits)
+    rows = [(t, alpha * cf.get(t, 0.0) + (1 - alpha) * audio.get(t, 0.0), audio.get(t), cf.get(t))
+        for t in set(audio) | set(cf)]
+    rows.sort(key=lambda r: (-r[1], r[0]))
+    return rows[:k]
@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+
+from feature_store import save_array, save_json
+from genre_index import encode_genres
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def save_strings(directory, name, values):
+    # variable-length strings as one UTF-8 byte array plus row offsets
+    encoded = [(v or '').encode('utf-8') for v in values]
+    save_array(directory, name + '_offsets.npy', np.cumsum([0] + [len(e) for e in encoded]).astype(np.int64))
+    save_array(directory, name + '_data.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+def load_strings(offsets, data):
+    # every string saved by save_strings, None having become ''
+    data = bytes(data)
+    offsets = np.asarray(offsets).tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def write_metadata_index(directory, track_infos, track_genres, started_at=None):
+    """Persist hydration data as memory-mappable arrays sorted by track id.
+
+    track_infos are (id, title, artist, listens, date_created, duration)
+    tuples as returned by MusicDB.get_track_infos, track_genres (track id,
+    genre) pairs. started_at is the time.time() before they were read.
+    """
+    infos = sorted(track_infos, key=lambda info: info[0])
+    os.makedirs(directory, exist_ok=True)
+    ids = np.array([info[0] for info in infos], dtype=np.int64)
+    save_array(directory, 'ids.npy', ids)
+    save_strings(directory, 'title', [info[1] for info in infos])
+    save_strings(directory, 'artist', [info[2] for info in infos])
+    save_strings(directory, 'date_created', [info[4] for info in infos])
+    # -1 stands for a NULL count
+    save_array(directory, 'listens.npy', np.array([-1 if info[3] is None else info[3] for info in infos],
+        dtype=np.int64))
+    save_array(directory, 'duration.npy', np.array([-1 if info[5] is None else info[5] for info in infos],
+        dtype=np.int64))
+
+    # genres dictionary-encoded, grouped per row of ids
+    offsets, codes, names = encode_genres(ids, track_genres)
+    save_array(directory, 'genre_offsets.npy', offsets)
+    save_array(directory, 'genre_codes.npy', codes)
+    manifest = {'tracks': int(len(ids)), 'genres': names, 'started_at': started_at}
+    save_json(directory, MANIFEST_FILE, manifest)
+    return manifest
+
+
+class MetadataIndex:
+    """Read-only track metadata memory-mapped from a write_metadata_index directory.
+
+    Every process mapping the same files shares one copy through the page
+    cache; lookups binary-search the sorted ids and decode only the rows
+    asked for.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.genre_names = manifest['genres']
+        self.started_at = manifest.get('started_at')
+        self.ids = self._load('ids')
+        self.listens = self._load('listens')
+        self.duration = self._load('duration')
+        self.genre_offsets = self._load('genre_offsets')
+        self.genre_codes = self._load('genre_codes')
+        self._strings = {name: (self._load(name + '_offsets'), self._load(name + '_data'))
+            for name in ('title', 'artist', 'date_created')}
+
+    def _load(self, name):
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, track_ids):
+        """{track id: row} for the track_ids present in the index."""
+        track_ids = np.asarray(list(track_ids), dtype=np.int64)
+        if not len(self.ids) or not len(track_ids):
+            return {}
+        rows = np.searchsorted(self.ids, track_ids).clip(max=len(self.ids) - 1)
+        found = self.ids[rows] == track_ids
+        return dict(zip(track_ids[found].tolist(), rows[found].tolist()))
+
+    def _string(self, name, row):
+        offsets, data = self._strings[name]
+        return bytes(data[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def track_infos(self, track_ids):
+        out = {}
+        for track_id, row in self.rows(track_ids).items():
+            listens, duration = int(self.listens[row]), int(self.duration[row])
+            out[track_id] = (track_id, self._string('title', row), self._string('artist', row),
+                None if listens < 0 else listens, self._string('date_created', row),
+                None if duration < 0 else duration)
+        return out
+
+    def genres(self, track_ids):
+        out = {}
+        for track_id, row in self.rows(track_ids).items():
+            codes = self.genre_codes[self.genre_offsets[row]:self.genre_offsets[row + 1]]
+            out[track_id] = [self.genre_names[c] for c in codes.tolist()]
+        return out
@@ -0,0 +1,307 @@
+import bisect
+import contextvars
+import logging
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+logger = logging.getLogger('musiclib.metrics')
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, escape_label(v)) for k, v in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, format_labels(self.labels, label_values), format_value(value)))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_values, (counts, total, n) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name,
+                        format_labels(self.labels, label_values, ('le', format_value(float(bound)))), cumulative))
+                lines.append('{}_bucket{} {}'.format(self.name,
+                    format_labels(self.labels, label_values, ('le', '+Inf')), n))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, label_values), repr(total)))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, label_values), n))
+        return lines
+
+
+class GaugeCallback:
+    """Gauge whose samples are read from a callback at scrape time."""
+
+    def __init__(self, name, help, labels, callback):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.callback = callback
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} gauge'.format(self.name)]
+        for label_values, value in sorted(self.callback().items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(self.labels, label_values), format_value(value)))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+DB_QUERY_SECONDS = REGISTRY.register(Histogram('musiclib_db_query_seconds',
+    'Latency of database queries and transactions.', ('store', 'query')))
+DB_ROWS = REGISTRY.register(Histogram('musiclib_db_rows_returned',
+    'Rows returned per database query or transaction.', ('store', 'query'), ROW_BUCKETS))
+DB_ROUND_TRIPS = REGISTRY.register(Counter('musiclib_db_round_trips_total',
+    'Database round trips issued.', ('store',)))
+DB_ERRORS = REGISTRY.register(Counter('musiclib_db_errors_total',
+    'Database queries or transactions that raised.', ('store', 'query')))
+HTTP_SECONDS = REGISTRY.register(Histogram('musiclib_http_request_seconds',
+    'Latency of HTTP requests until the response is returned.', ('method', 'endpoint', 'status')))
+HTTP_ROUND_TRIPS = REGISTRY.register(Histogram('musiclib_http_request_db_round_trips',
+    'Database round trips made while handling one HTTP request.', ('method', 'endpoint', 'store'), COUNT_BUCKETS))
+
+_slow_query_threshold = None
+_request_trips = contextvars.ContextVar('musiclib_request_trips', default=None)
+
+
+def set_slow_query_threshold(seconds):
+    global _slow_query_threshold
+    _slow_query_threshold = seconds
+
+
+def observe_query(store, query, seconds, rows=None, error=False):
+    DB_ROUND_TRIPS.inc(store)
+    DB_QUERY_SECONDS.observe(seconds, store, query)
+    if rows is not None and rows >= 0:
+        DB_ROWS.observe(rows, store, query)
+    if error:
+        DB_ERRORS.inc(store, query)
+    trips = _request_trips.get()
+    if trips is not None:
+        trips[store] = trips.get(store, 0) + 1
+    if _slow_query_threshold is not None and seconds >= _slow_query_threshold:
+        logger.warning("slow %s query %s took %.1f ms", store, query, seconds * 1000.0)
+
+
+def begin_request():
+    _request_trips.set({})
+    return time.perf_counter()
+
+
+def end_request(method, endpoint, status, started):
+    HTTP_SECONDS.observe(time.perf_counter() - started, method, endpoint, status)
+    trips = _request_trips.get() or {}
+    for store in ('postgres', 'neo4j'):
+        HTTP_ROUND_TRIPS.observe(trips.get(store, 0), method, endpoint, store)
+    _request_trips.set(None)
+
+
+def register_cache(name, stats_fn):
+    def samples():
+        stats = stats_fn()
+        lookups = stats['hits'] + stats['misses']
+        return {
+            (name, 'hits'): stats['hits'],
+            (name, 'misses'): stats['misses'],
+            (name, 'evictions'): stats['evictions'],
+            (name, 'size'): stats['size'],
+            (name, 'hit_ratio'): stats['hits'] / lookups if lookups else 0.0,
+        }
+    return REGISTRY.register(GaugeCallback('musiclib_cache', 'Cache statistics by cache and statistic.',
+        ('cache', 'stat'), samples))
+
+
+_SQL_TABLE = re.compile(r'\b(?:from|into|update|table|on)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+
+
+def sql_label(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    words = str(query).split(None, 1)
+    verb = words[0].upper() if words else 'UNKNOWN'
+    table = _SQL_TABLE.search(str(query))
+    return verb if table is None else '{} {}'.format(verb, table.group(1).lower())
+
+
+_CYPHER_LABEL = re.compile(r':([A-Za-z_][A-Za-z0-9_]*)')
+
+
+def cypher_label(query):
+    # verb and first node label, e.g. "MATCH Person", for drivers without
+    # transaction function names to label by
+    words = str(query).split(None, 1)
+    verb = words[0].upper() if words else 'UNKNOWN'
+    label = _CYPHER_LABEL.search(str(query))
+    return verb if label is None else '{} {}'.format(verb, label.group(1))
+
+
+async def observe_awaitable(store, query, awaitable):
+    """Await awaitable, recording it as one round trip labelled query."""
+    started = time.perf_counter()
+    try:
+        result = await awaitable
+    except Exception:
+        observe_query(store, query, time.perf_counter() - started, error=True)
+        raise
+    observe_query(store, query, time.perf_counter() - started, _result_rows(result))
+    return result
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor recording every statement; pass as MusicDB(cursor_factory=...)."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            observe_query('postgres', sql_label(query), time.perf_counter() - started, error=True)
+            raise
+        observe_query('postgres', sql_label(query), time.perf_counter() - started,
+            None if self.name else self.rowcount)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            observe_query('postgres', sql_label(sql), time.perf_counter() - started, self.rowcount)
+
+
+def _result_rows(result):
+    if isinstance(result, (list, tuple, dict, set)):
+        return len(result)
+    return None
+
+
+class InstrumentedSession:
+
+    def __init__(self, session):
+        self._session = session
+
+    def __enter__(self):
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._session.__exit__(*exc)
+
+    def _timed(self, execute, transaction_function, args, kwargs):
+        name = getattr(transaction_function, '__name__', 'transaction').lstrip('_')
+        started = time.perf_counter()
+        try:
+            result = execute(transaction_function, *args, **kwargs)
+        except Exception:
+            observe_query('neo4j', name, time.perf_counter() - started, error=True)
+            raise
+        observe_query('neo4j', name, time.perf_counter() - started, _result_rows(result))
+        return result
+
+    def execute_read(self, transaction_function, *args, **kwargs):
+        return self._timed(self._session.execute_read, transaction_function, args, kwargs)
+
+    def execute_write(self, transaction_function, *args, **kwargs):
+        return self._timed(self._session.execute_write, transaction_function, args, kwargs)
+
+    def run(self, query, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._session.run(query, *args, **kwargs)
+        finally:
+            observe_query('neo4j', 'run', time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class InstrumentedDriver:
+    """Neo4j driver wrapper timing every transaction function a session runs."""
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def session(self, *args, **kwargs):
+        return InstrumentedSession(self._driver.session(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
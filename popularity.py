@@ -0,0 +1,159 @@
+import bisect
+import heapq
+import threading
+import time
+from collections import deque
+
+
+class TopK:
+    """Like counts kept in (-count, track_id) order so the top k is a slice."""
+
+    def __init__(self, counts=()):
+        self.counts = {}
+        self._order = []
+        self.reset(counts)
+
+    def __len__(self):
+        return len(self._order)
+
+    def reset(self, counts):
+        self.counts = {int(t): int(n) for t, n in counts if n > 0}
+        self._order = sorted((-n, t) for t, n in self.counts.items())
+
+    def add(self, track_id, delta):
+        old = self.counts.get(track_id, 0)
+        new = max(old + delta, 0)
+        if new == old:
+            return
+        if old:
+            del self._order[bisect.bisect_left(self._order, (-old, track_id))]
+        if new:
+            bisect.insort(self._order, (-new, track_id))
+            self.counts[track_id] = new
+        else:
+            del self.counts[track_id]
+
+    def top(self, k):
+        return [(t, -n) for n, t in self._order[:k]]
+
+
+class TrendingWindow:
+    """Net likes per track over a sliding time window, fed with timestamped events."""
+
+    def __init__(self, window):
+        self.window = window
+        self.counts = {}
+        self._events = deque()
+
+    def reset(self, events, now):
+        self.counts, self._events = {}, deque()
+        for timestamp, track_id in sorted(events):
+            self.add(track_id, 1, timestamp)
+        self.expire(now)
+
+    def events(self):
+        return list(self._events)
+
+    def replay(self, events, now):
+        # (timestamp, track_id, delta) events as returned by events()
+        self.counts, self._events = {}, deque()
+        for timestamp, track_id, delta in events:
+            self.add(int(track_id), int(delta), float(timestamp))
+        self.expire(now)
+
+    def add(self, track_id, delta, timestamp):
+        self._events.append((timestamp, track_id, delta))
+        self._apply(track_id, delta)
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self._events and self._events[0][0] <= cutoff:
+            _, track_id, delta = self._events.popleft()
+            self._apply(track_id, -delta)
+
+    def _apply(self, track_id, delta):
+        # a count can dip below zero while an unlike outlives the like it undid
+        n = self.counts.get(track_id, 0) + delta
+        if n:
+            self.counts[track_id] = n
+        else:
+            self.counts.pop(track_id, None)
+
+    def top(self, k):
+        return heapq.nsmallest(k, ((t, n) for t, n in self.counts.items() if n > 0), key=lambda item: (-item[1], item[0]))
+
+
+class PopularityTracker:
+    """In-process all-time and trending like counts for one SocialDB.
+
+    The structures are seeded from the graph through the two loaders and
+    reseeded once older than reseed_interval, so likes written by other
+    processes eventually show up; local writes are applied immediately.
+    """
+
+    def __init__(self, load_counts, load_recent, window=86400, reseed_interval=None):
+        self.load_counts = load_counts
+        self.load_recent = load_recent
+        self.reseed_interval = reseed_interval
+        self.all_time = TopK()
+        self.trending = TrendingWindow(window)
+        self._seeded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def window(self):
+        return self.trending.window
+
+    def _ensure_seeded(self):
+        now = time.time()
+        stale = self.reseed_interval is not None and self._seeded_at is not None and \
+            now - self._seeded_at > self.reseed_interval
+        if self._seeded_at is None or stale:
+            self.all_time.reset(self.load_counts())
+            self.trending.reset(self.load_recent(now - self.window), now)
+            self._seeded_at = now
+        return now
+
+    def invalidate(self):
+        with self._lock:
+            self._seeded_at = None
+
+    @property
+    def seeded(self):
+        return self._seeded_at is not None
+
+    def export(self):
+        """(all-time counts, trending events) to persist, or None before seeding."""
+        with self._lock:
+            if self._seeded_at is None:
+                return None
+            return list(self.all_time.counts.items()), self.trending.events()
+
+    def restore(self, counts, events):
+        # counts the caller has checked against the graph count as a fresh seed
+        with self._lock:
+            now = time.time()
+            self.all_time.reset(counts)
+            self.trending.replay(events, now)
+            self._seeded_at = now
+
+    def record(self, changes, timestamp=None):
+        # changes are (track_id, delta) pairs; nothing to patch before seeding
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._seeded_at is None:
+                return
+            for track_id, delta in changes:
+                self.all_time.add(int(track_id), delta)
+                self.trending.add(int(track_id), delta, timestamp)
+
+    def top(self, k):
+        with self._lock:
+            self._ensure_seeded()
+            return self.all_time.top(k)
+
+    def top_trending(self, k):
+        with self._lock:
+            now = self._ensure_seeded()
+            self.trending.expire(now)
+            return self.trending.top(k)
@@ -0,0 +1,197 @@
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+
+from audiolib_server import MusicDB
+from feature_store import FeatureStore, open_feature_store, write_feature_store
+from metadata_index import MetadataIndex, write_metadata_index
+from snapshot import current_generation, new_generation, publish_generation
+
+DEFAULT_DIRECTORY = 'shared_index/'
+METADATA_DIR = 'metadata'
+VECTORS_DIR = 'vectors'
+
+
+def build_generation(directory, feature_store=None):
+    """Build the hydration and vector indexes from PostgreSQL and publish them as a new generation.
+
+    Vectors are only written when there is no feature store to search; the
+    track table's feature columns then become one. Runs with its own
+    connections and closes them, so nothing is left open across a fork.
+    """
+    t0 = time.perf_counter()
+    fma_db = MusicDB(minconn=0, maxconn=2)
+    try:
+        generation, path = new_generation(directory)
+        manifest = write_metadata_index(os.path.join(path, METADATA_DIR), fma_db.iter_track_infos(),
+            fma_db.iter_genres(), started_at=time.time())
+        if feature_store is None:
+            fma_db.load_vector_index()
+            ids, vectors, _, _ = fma_db.vector_index.export()
+            write_feature_store(os.path.join(path, VECTORS_DIR), ids, vectors, source='track table')
+        publish_generation(directory, generation)
+    finally:
+        fma_db.close()
+    print("Published generation {} ({} tracks) in {:.1f}s".format(generation, manifest['tracks'],
+        time.perf_counter() - t0), flush=True)
+    return generation
+
+
+class SharedIndexes:
+    """Worker-side view of the current generation, re-checked at most every check_interval seconds.
+
+    Attaching maps the generation's files into this process and swaps them
+    into fma_db with single attribute assignments, so requests in flight
+    finish on the generation they started with.
+    """
+
+    def __init__(self, directory, fma_db, check_interval=1.0):
+        self.directory = directory
+        self.fma_db = fma_db
+        self.check_interval = check_interval
+        self.generation = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval:
+                return
+            self._checked = now
+            generation = current_generation(self.directory)
+            if generation is None or generation == self.generation:
+                return
+            path = os.path.join(self.directory, generation)
+            try:
+                metadata_index = MetadataIndex(os.path.join(path, METADATA_DIR))
+                vectors = None
+                if os.path.isdir(os.path.join(path, VECTORS_DIR)):
+                    vectors = FeatureStore(os.path.join(path, VECTORS_DIR))
+            except (OSError, ValueError) as error:
+                # pruned or half-published; the next check tries again
+                print(error)
+                return
+            if vectors is not None:
+                self.fma_db.use_feature_store(vectors)
+            self.fma_db.use_metadata_index(metadata_index)
+            self.generation = generation
+
+
+def run_worker(sock, directory, check_interval):
+    # app is imported after the fork so every worker opens its own database
+    # connections; the indexes themselves come from the shared mapped files
+    import app as app_module
+    from werkzeug.serving import make_server
+    from snapshot import Warmup
+
+    shared = SharedIndexes(directory, app_module.fma_db, check_interval)
+    shared.refresh()
+    app_module.app.before_request(shared.refresh)
+    # per-process state such as the popularity counters still warms up, but
+    # only the parent writes files
+    app_module.warmup = Warmup(app_module.fma_db, app_module.graph_db, write=False)
+    app_module.warmup.start()
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app_module.app, threaded=True, fd=sock.fileno())
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+
+
+def serve(host, port, workers, directory, rebuild_interval=None, check_interval=1.0, feature_store_dir=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    feature_store = open_feature_store(feature_store_dir) if feature_store_dir else None
+    os.makedirs(directory, exist_ok=True)
+    try:
+        build_generation(directory, feature_store)
+    except Exception as error:
+        # workers fall back to loading from the databases themselves
+        print(error)
+
+    children = set()
+    state = {'stopping': False, 'rebuild': False}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            code = 0
+            try:
+                run_worker(sock, directory, check_interval)
+            except BaseException as error:
+                print(error)
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        state['stopping'] = True
+
+    def rebuild(signum, frame):
+        state['rebuild'] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, rebuild)
+    for _ in range(workers):
+        spawn()
+    print("Serving on {}:{} with {} workers".format(host, port, workers), flush=True)
+
+    next_rebuild = None if rebuild_interval is None else time.monotonic() + rebuild_interval
+    while not state['stopping']:
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            children.discard(pid)
+            if not state['stopping']:
+                print("Worker {} exited with status {}, restarting".format(pid, status), flush=True)
+                spawn()
+        if state['rebuild'] or (next_rebuild is not None and time.monotonic() >= next_rebuild):
+            state['rebuild'] = False
+            try:
+                build_generation(directory, feature_store)
+            except Exception as error:
+                # workers keep serving the previous generation
+                print(error)
+            if rebuild_interval is not None:
+                next_rebuild = time.monotonic() + rebuild_interval
+        time.sleep(0.2)
+
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve app.py from N forked workers sharing memory-mapped indexes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--index-dir', default=os.environ.get('MUSICLIB_SHARED_INDEX', DEFAULT_DIRECTORY))
+    parser.add_argument('--rebuild-interval', type=float, default=None,
+        help="seconds between index rebuilds; SIGHUP also triggers one")
+    parser.add_argument('--check-interval', type=float, default=1.0,
+        help="how often a worker looks for a newer generation, in seconds")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.index_dir, args.rebuild_interval, args.check_interval,
+        os.environ.get('MUSICLIB_FEATURE_STORE', 'feature_store/'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from feature_store import save_array, save_json
+from metadata_index import load_strings, save_strings
+
+CURRENT_FILE = 'current.json'
+MANIFEST_FILE = 'manifest.json'
+KEEP_GENERATIONS = 2
+DEFAULT_MAX_AGE = 86400
+
+
+def new_generation(directory):
+    """(name, path) of a fresh generation directory under directory."""
+    now = time.time()
+    generation = '{}.{:06d}-{}'.format(time.strftime('%Y%m%dT%H%M%S', time.localtime(now)), int(now % 1 * 1e6),
+        os.getpid())
+    path = os.path.join(directory, generation)
+    os.makedirs(path, exist_ok=True)
+    return generation, path
+
+
+def publish_generation(directory, generation, keep=KEEP_GENERATIONS):
+    # readers follow current.json, so replacing it is the atomic switch;
+    # processes still mapping pruned files keep their pages until they unmap
+    save_json(directory, CURRENT_FILE, {'generation': generation})
+    generations = sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+    for name in generations[:-keep]:
+        if name != generation:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def current_generation(directory):
+    pointer = os.path.join(directory, CURRENT_FILE)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as f:
+        return json.load(f)['generation']
+
+
+def write_snapshot(directory, fma_db, graph_db, markers, keep=KEEP_GENERATIONS):
+    """Persist the loaded in-memory structures of fma_db and graph_db as a new generation.
+
+    markers are the track_marker() and graph_marker() results taken before
+    those structures were loaded, so a snapshot can only look staler than
+    it is, never fresher. Each generation is a directory of .npy files; the
+    current.json pointer is switched last and older generations are pruned.
+    """
+    generation, path = new_generation(directory)
+    parts = {}
+
+    if fma_db.feature_store is None and fma_db._vector_index_loaded and markers.get('tracks') is not None:
+        ids, vectors, norms, titles = fma_db.vector_index.export()
+        save_array(path, 'vector_ids.npy', ids)
+        save_array(path, 'vector_data.npy', vectors)
+        save_array(path, 'vector_norms.npy', norms)
+        save_strings(path, 'vector_titles', titles)
+        parts['vectors'] = markers['tracks']
+
+    graph_marker = markers.get('graph')
+    likes = graph_db.export_likes_snapshot() if graph_marker is not None else None
+    if likes is not None:
+        users = list(likes)
+        save_array(path, 'like_users.npy', np.asarray(users, dtype=str))
+        save_array(path, 'like_offsets.npy', np.cumsum([0] + [len(likes[u]) for u in users]).astype(np.int64))
+        save_array(path, 'like_tracks.npy', np.asarray([t for u in users for t in likes[u]], dtype=np.int64))
+        parts['likes'] = graph_marker
+
+    popularity = None
+    if graph_marker is not None and graph_db.popularity is not None:
+        popularity = graph_db.popularity.export()
+    if popularity is not None:
+        counts, events = popularity
+        save_array(path, 'popularity_counts.npy', np.asarray(counts, dtype=np.int64).reshape(-1, 2))
+        save_array(path, 'trending_events.npy', np.asarray(events, dtype=np.float64).reshape(-1, 3))
+        parts['popularity'] = graph_marker
+
+    save_json(path, MANIFEST_FILE, {'generation': generation, 'created': time.time(), 'parts': parts})
+    publish_generation(directory, generation, keep)
+    return generation
+
+
+def open_snapshot(directory):
+    """Current Snapshot in directory, or None when none has been written."""
+    generation = current_generation(directory)
+    if generation is None:
+        return None
+    return Snapshot(os.path.join(directory, generation))
+
+
+class Snapshot:
+    """One generation of snapshot files, memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+
+    @property
+    def generation(self):
+        return self.manifest['generation']
+
+    @property
+    def age(self):
+        return time.time() - self.manifest['created']
+
+    def marker(self, part):
+        return self.manifest['parts'].get(part)
+
+    def load(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def vectors(self):
+        return self.load('vector_ids'), self.load('vector_data'), self.load('vector_norms'), \
+            load_strings(self.load('vector_titles_offsets'), self.load('vector_titles_data'))
+
+    def likes(self):
+        users, offsets, tracks = self.load('like_users').tolist(), self.load('like_offsets'), self.load('like_tracks')
+        return {user: tracks[offsets[i]:offsets[i + 1]].tolist() for i, user in enumerate(users)}
+
+    def popularity(self):
+        counts = [(int(t), int(n)) for t, n in self.load('popularity_counts')]
+        events = [(float(at), int(t), int(d)) for at, t, d in self.load('trending_events')]
+        return counts, events
+
+
+def usable(snapshot, part, marker, max_age):
+    # parts are reused when the database still matches the counts they were
+    # taken at, or, with the database unreachable, while not too old
+    saved = snapshot.marker(part)
+    if saved is None or snapshot.age > max_age:
+        return False
+    return marker is None or saved == marker
+
+
+class WarmupStatus:
+    """Progress of the warm-up stages, as reported by /healthz."""
+
+    def __init__(self, stages):
+        self.started = time.time()
+        self.snapshot = None
+        self._stages = {name: {'state': 'pending'} for name in stages}
+        self._lock = threading.Lock()
+
+    def begin(self, name):
+        with self._lock:
+            self._stages[name] = {'state': 'loading', 'started': time.time()}
+
+    def done(self, name, source):
+        with self._lock:
+            stage = self._stages[name]
+            self._stages[name] = {'state': 'ready', 'source': source,
+                'seconds': round(time.time() - stage.get('started', time.time()), 3)}
+
+    def failed(self, name, error):
+        with self._lock:
+            self._stages[name] = dict(self._stages[name], state='failed', error=str(error))
+
+    def source(self, name):
+        return self._stages[name].get('source')
+
+    def report(self):
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self._stages.items()}
+        ready = all(stage['state'] == 'ready' for stage in stages.values())
+        return {'ready': ready, 'snapshot': self.snapshot, 'uptime': round(time.time() - self.started, 3),
+            'stages': stages}
+
+
+class Warmup:
+    """Warms fma_db and graph_db in a background thread, from a snapshot where it can.
+
+    The snapshot stage checks the database's markers and restores the parts
+    that still match; the remaining stages load whatever is missing from the
+    databases, retrying every retry_interval seconds while they are down.
+    Once everything is warm a new snapshot is written if anything had to be
+    loaded from the databases.
+    """
+
+    STAGES = ('snapshot', 'vector_index', 'likes', 'popularity', 'item_cf')
+
+    def __init__(self, fma_db, graph_db, directory=None, max_age=DEFAULT_MAX_AGE, retry_interval=5.0, write=True):
+        self.fma_db = fma_db
+        self.graph_db = graph_db
+        self.directory = directory
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.write = write
+        self.status = WarmupStatus(self.STAGES)
+        self.markers = {}
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='warmup', daemon=True)
+                self._thread.start()
+
+    def report(self):
+        return self.status.report()
+
+    def _stage(self, name, load):
+        while True:
+            self.status.begin(name)
+            try:
+                self.status.done(name, load())
+                return
+            except Exception as error:
+                print(error)
+                self.status.failed(name, error)
+                time.sleep(self.retry_interval)
+
+    def run(self):
+        self._stage('snapshot', self._restore)
+        self._stage('vector_index', self._warm_vector_index)
+        self._stage('likes', self._warm_likes)
+        self._stage('popularity', self._warm_popularity)
+        self._stage('item_cf', self._warm_item_cf)
+        loaded = any(self.status.source(name) == 'database' for name in ('vector_index', 'likes', 'popularity'))
+        if self.write and self.directory and loaded:
+            try:
+                self.status.snapshot = write_snapshot(self.directory, self.fma_db, self.graph_db, self.markers)
+            except Exception as error:
+                print(error)
+
+    def _restore(self):
+        self.markers['tracks'] = self.fma_db.track_marker()
+        try:
+            self.markers['graph'] = self.graph_db.graph_marker()
+        except Exception as error:
+            print(error)
+            self.markers['graph'] = None
+        snapshot = open_snapshot(self.directory) if self.directory else None
+        if snapshot is None:
+            return 'none'
+        restored = []
+        if self.fma_db.feature_store is None and usable(snapshot, 'vectors', self.markers['tracks'], self.max_age):
+            self.fma_db.restore_vector_index(*snapshot.vectors())
+            restored.append('vectors')
+        if self.graph_db.cache_likes and usable(snapshot, 'likes', self.markers['graph'], self.max_age):
+            self.graph_db.restore_likes_snapshot(snapshot.likes())
+            restored.append('likes')
+        if self.graph_db.popularity is not None and \
+                usable(snapshot, 'popularity', self.markers['graph'], self.max_age):
+            self.graph_db.popularity.restore(*snapshot.popularity())
+            restored.append('popularity')
+        self.status.snapshot = snapshot.generation
+        return ', '.join(restored) or 'stale'
+
+    def _warm_vector_index(self):
+        if self.fma_db.feature_store is not None:
+            return 'feature store'
+        if self.fma_db._vector_index_loaded:
+            # tracks inserted since the snapshot was taken
+            self.fma_db.load_vector_index()
+            return 'snapshot'
+        self.fma_db.load_vector_index()
+        if not self.fma_db._vector_index_loaded:
+            raise RuntimeError("could not load the vector index")
+        return 'database'
+
+    def _warm_likes(self):
+        if not self.graph_db.cache_likes:
+            return 'disabled'
+        restored = self.graph_db.export_likes_snapshot() is not None
+        self.graph_db.retrieve_all_likes_data()
+        return 'snapshot' if restored else 'database'
+
+    def _warm_popularity(self):
+        if self.graph_db.popularity is None:
+            return 'disabled'
+        if self.graph_db.popularity.seeded:
+            return 'snapshot'
+        self.graph_db.most_popular_songs(1)
+        return 'database'
+
+    def _warm_item_cf(self):
+        if self.graph_db.item_cf is None:
+            return 'disabled'
+        self.graph_db.rebuild_item_cf()
+        return 'likes'
@@ -0,0 +1,220 @@
+import fnmatch
+import math
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalBackend:
+    """In-process LRU store with per-entry expiry."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        out = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                value, expires_at = entry
+                if expires_at is not None and expires_at <= now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                out[key] = value
+        return out
+
+    def set_many(self, items, ttl=None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (value, expires_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+SCAN_BATCH_SIZE = 1000
+
+
+class DictStore:
+    """Local stand-in for a shared key/value server (mget/set/delete/scan with expiry)."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def mget(self, keys):
+        now = time.time()
+        with self._lock:
+            out = []
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    del self._data[key]
+                    entry = None
+                out.append(None if entry is None else entry[0])
+            return out
+
+    def set(self, key, value, ex=None, px=None):
+        # ex in seconds or px in milliseconds, as redis takes them
+        expires_at = None if ex is None else time.time() + ex
+        if px is not None:
+            expires_at = time.time() + px / 1000.0
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def scan_iter(self, match=None, count=None):
+        with self._lock:
+            keys = list(self._data)
+        return iter([key for key in keys if match is None or fnmatch.fnmatchcase(key, match)])
+
+    def pipeline(self, transaction=True):
+        return DictPipeline(self)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DictPipeline:
+    """Buffers DictStore.set calls until execute(), like a redis pipeline."""
+
+    def __init__(self, store):
+        self.store = store
+        self._calls = []
+
+    def set(self, key, value, ex=None, px=None):
+        self._calls.append((key, value, ex, px))
+        return self
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [self.store.set(key, value, ex=ex, px=px) for key, value, ex, px in calls]
+
+
+class SharedBackend:
+    """Backend over a shared store client such as redis.Redis or DictStore.
+
+    Size bounds and eviction are left to the store's own policy.
+    """
+
+    def __init__(self, client, prefix='musiclib:'):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+
+    def __len__(self):
+        return 0
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: pickle.loads(value) for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items, ttl=None):
+        # one round trip for the batch; MSET cannot set an expiry
+        if not items:
+            return
+        # millisecond expiry keeps sub-second ttls, which ex would truncate to
+        # 0 and redis would reject
+        px = None if ttl is None else max(1, math.ceil(ttl * 1000))
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(self.prefix + key, pickle.dumps(value), px=px)
+        pipe.execute()
+
+    def delete_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        # only this cache's keys, the store may be shared with other data
+        batch = []
+        for key in self.client.scan_iter(match=self.prefix + '*', count=SCAN_BATCH_SIZE):
+            batch.append(key)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+
+class TrackCache:
+    """Read-through cache for per-track metadata, keyed by namespace and track id."""
+
+    def __init__(self, backend=None, ttl=3600):
+        self.backend = LocalBackend() if backend is None else backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(namespace, track_id):
+        return '{}:{}'.format(namespace, track_id)
+
+    def lookup(self, namespace, track_ids):
+        keys = {self._key(namespace, t): t for t in track_ids}
+        cached = self.backend.get_many(list(keys))
+        found = {keys[key]: value for key, value in cached.items()}
+        missing = [t for key, t in keys.items() if key not in cached]
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def store(self, namespace, loaded):
+        self.backend.set_many({self._key(namespace, t): v for t, v in loaded.items()}, self.ttl)
+
+    def get_many(self, namespace, track_ids, loader):
+        out, missing = self.lookup(namespace, track_ids)
+        if missing:
+            loaded = loader(missing)
+            self.store(namespace, loaded)
+            out.update(loaded)
+        return out
+
+    def invalidate(self, namespaces, track_ids):
+        self.backend.delete_many([self._key(ns, t) for ns in namespaces for t in track_ids])
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': self.backend.evictions,
+            'size': len(self.backend),
+        }
@@ -0,0 +1,337 @@
+import threading
+
+import numpy as np
+
+METRICS = ('euclidean', 'cosine', 'dot')
+
+
+def pairwise_distances(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    sq = (a * a).sum(axis=1)[:, None] + (b * b).sum(axis=1)[None, :] - 2.0 * (a @ b.T)
+    np.maximum(sq, 0.0, out=sq)
+    return np.sqrt(sq)
+
+
+def check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError("unknown metric {!r}, expected one of {}".format(metric, ', '.join(METRICS)))
+    return metric
+
+
+def block_scores(vectors, norms, query, query_norm, metric):
+    # lower is better for every metric: squared euclidean distance, cosine
+    # distance, or the negated dot product
+    dots = vectors @ query
+    if metric == 'euclidean':
+        return norms * norms - 2.0 * dots + query_norm * query_norm
+    if metric == 'dot':
+        return -dots
+    denom = norms * query_norm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.where(denom > 0, dots / denom, 0.0)
+    return 1.0 - cos
+
+
+def block_scores_many(vectors, norms, queries, query_norms, metric):
+    # block_scores for several queries at once, shaped (queries, rows)
+    dots = queries @ vectors.T
+    if metric == 'euclidean':
+        return (norms * norms)[None, :] - 2.0 * dots + (query_norms * query_norms)[:, None]
+    if metric == 'dot':
+        return -dots
+    denom = query_norms[:, None] * norms[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos = np.where(denom > 0, dots / denom, 0.0)
+    return 1.0 - cos
+
+
+def merge_neighbours(per_seed, k, metric='euclidean'):
+    """Union of per-seed neighbour lists, deduplicated on the best hit.
+
+    per_seed maps a seed track id to its [(id, title, score)] list, best
+    first. Tracks are ranked by their best position in any list, then by
+    score, so every seed contributes its nearest neighbours before any
+    seed's second choices. Returns [(id, title, score, seed)] for the k best
+    distinct tracks, seed being the list the track ranked best in.
+    """
+    best = {}
+    for seed, hits in per_seed.items():
+        for rank, (track_id, title, score) in enumerate(hits):
+            key = (rank, -score if metric == 'dot' else score)
+            current = best.get(track_id)
+            if current is None or key < current[0]:
+                best[track_id] = (key, title, score, seed)
+    merged = sorted(best.items(), key=lambda item: (item[1][0], item[0]))
+    return [(track_id, title, score, seed) for track_id, (_, title, score, seed) in merged[:k]]
+
+
+def output_score(score, metric):
+    if metric == 'euclidean':
+        return float(np.sqrt(max(score, 0.0)))
+    if metric == 'dot':
+        return float(-score)
+    return float(score)
+
+
+class VectorIndex:
+    """k-NN index over the track feature vectors.
+
+    An optional read-only base segment (a memory-mapped FeatureStore) is
+    searched together with an in-memory delta segment, where `add` puts new
+    tracks and updated vectors, so neither the catalogue nor the mapped file
+    is reloaded or copied. Search runs over blocks of rows to bound scratch
+    memory.
+    """
+
+    def __init__(self, dim=3, base=None, metric='euclidean', block_size=65536):
+        self.base = base
+        self.dim = dim if base is None else base.dim
+        self.metric = check_metric(metric)
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        # (ids, vectors, norms, titles, id2row) of the delta segment plus the
+        # base rows it shadows, swapped as one tuple so searches never see a
+        # half-applied add
+        self._state = (np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32),
+            np.empty(0, dtype=np.float32), {}, {}, np.empty(0, dtype=np.int64))
+
+    def __len__(self):
+        ids, shadowed = self._state[0], self._state[5]
+        return len(ids) + (0 if self.base is None else len(self.base) - len(shadowed))
+
+    def __contains__(self, track_id):
+        return track_id in self._state[4] or (self.base is not None and track_id in self.base)
+
+    @property
+    def max_id(self):
+        ids = self._state[0]
+        candidates = [int(ids.max())] if len(ids) else []
+        if self.base is not None and len(self.base):
+            candidates.append(self.base.max_id)
+        return max(candidates) if candidates else None
+
+    def add(self, rows):
+        rows = list(rows)
+        if not rows:
+            return 0
+        with self._lock:
+            ids, vectors, norms, titles, id2row, shadowed = self._state
+            new_ids, new_vectors = [], []
+            updates = {}
+            added = 0
+            titles = dict(titles)
+            for r in rows:
+                track_id, features = int(r[0]), r[2:2 + self.dim]
+                titles[track_id] = (r[1] or '').strip()
+                if track_id in id2row:
+                    updates[id2row[track_id]] = features
+                else:
+                    new_ids.append(track_id)
+                    new_vectors.append(features)
+
+            if updates:
+                vectors = vectors.copy()
+                for row, features in updates.items():
+                    vectors[row] = features
+            if new_ids:
+                id2row = dict(id2row)
+                for i, track_id in enumerate(new_ids):
+                    id2row[track_id] = len(ids) + i
+                ids = np.concatenate([ids, np.asarray(new_ids, dtype=np.int64)])
+                vectors = np.ascontiguousarray(np.vstack([vectors, np.asarray(new_vectors, dtype=np.float32)]))
+                added = len(new_ids)
+                if self.base is not None:
+                    base_rows, found = self.base.rows(new_ids)
+                    shadowed = np.union1d(shadowed, base_rows[found])
+                    added -= int(np.count_nonzero(found))
+            norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+            self._state = (ids, vectors, norms, titles, id2row, shadowed)
+            return added
+
+    def export(self):
+        """(ids, vectors, norms, titles) of the delta segment, for snapshot files."""
+        ids, vectors, norms, titles, id2row, shadowed = self._state
+        return ids, vectors, norms, [titles.get(int(t), '') for t in ids]
+
+    def restore(self, ids, vectors, norms, titles):
+        """Replace the delta segment with exported arrays, which may be memory-mapped."""
+        ids = np.asarray(ids, dtype=np.int64)
+        id_list = ids.tolist()
+        id2row = dict(zip(id_list, range(len(id_list))))
+        titles = dict(zip(id_list, titles))
+        shadowed = np.empty(0, dtype=np.int64)
+        if self.base is not None and len(ids):
+            base_rows, found = self.base.rows(ids)
+            shadowed = np.unique(base_rows[found])
+        with self._lock:
+            self._state = (ids, vectors, norms, titles, id2row, shadowed)
+
+    def vector(self, track_id):
+        ids, vectors, norms, titles, id2row, shadowed = self._state
+        row = id2row.get(track_id)
+        if row is not None:
+            return vectors[row]
+        if self.base is not None:
+            return self.base.vector(track_id)
+        return None
+
+    def vectors(self, track_ids):
+        """Vectors for track_ids as one float32 array, NaN rows for unknown ids."""
+        ids, vectors, norms, titles, id2row, shadowed = self._state
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        out = np.full((len(track_ids), self.dim), np.nan, dtype=np.float32)
+        if self.base is not None and len(self.base):
+            base_rows, found = self.base.rows(track_ids)
+            if found.any():
+                out[found] = self.base.vectors[base_rows[found]]
+        for i, track_id in enumerate(track_ids.tolist()):
+            row = id2row.get(track_id)
+            if row is not None:
+                out[i] = vectors[row]
+        return out
+
+    def title(self, track_id):
+        return self._state[3].get(track_id)
+
+    def _segment_candidates(self, ids, vectors, norms, query, query_norm, k, metric, masked_rows, rows=None):
+        # rows, when given, restricts the scan to those rows (a filter such as
+        # a genre), gathering only their vectors instead of masking the rest
+        if rows is not None:
+            rows = np.setdiff1d(rows, masked_rows)
+        out_scores, out_ids = [], []
+        for start in range(0, len(ids) if rows is None else len(rows), self.block_size):
+            if rows is None:
+                stop = min(start + self.block_size, len(ids))
+                block = slice(start, stop)
+                masked = masked_rows[(masked_rows >= start) & (masked_rows < stop)] - start
+            else:
+                block = rows[start:start + self.block_size]
+                masked = np.empty(0, dtype=np.int64)
+            scores = block_scores(np.asarray(vectors[block]), np.asarray(norms[block]), query, query_norm, metric)
+            scores[masked] = np.inf
+            n = min(k, len(scores))
+            top = np.argpartition(scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+            out_scores.append(scores[top])
+            out_ids.append(np.asarray(ids[block])[top])
+        return out_scores, out_ids
+
+    def search(self, query, k, exclude=(), metric=None, allowed=None):
+        """The k nearest tracks to query as [(id, title, score)].
+
+        allowed, a sorted array of track ids, limits the candidates to those
+        tracks while scanning, so a filter never leaves fewer than k results
+        when k allowed tracks exist.
+        """
+        metric = check_metric(metric or self.metric)
+        ids, vectors, norms, titles, id2row, shadowed = self._state
+        if k <= 0 or len(self) == 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        query_norm = np.float32(np.linalg.norm(query))
+        exclude = np.asarray(list(exclude), dtype=np.int64)
+        if allowed is not None:
+            allowed = np.asarray(allowed, dtype=np.int64)
+
+        scores, found_ids = [], []
+        if self.base is not None and len(self.base):
+            masked = shadowed
+            if len(exclude):
+                base_rows, found = self.base.rows(exclude)
+                masked = np.union1d(masked, base_rows[found])
+            rows = None
+            if allowed is not None:
+                base_rows, found = self.base.rows(allowed)
+                rows = base_rows[found]
+            s, i = self._segment_candidates(self.base.ids, self.base.vectors, self.base.norms, query, query_norm, k,
+                metric, masked, rows)
+            scores += s
+            found_ids += i
+        if len(ids):
+            masked = np.asarray([id2row[t] for t in exclude.tolist() if t in id2row], dtype=np.int64)
+            rows = None if allowed is None else np.flatnonzero(np.isin(ids, allowed))
+            s, i = self._segment_candidates(ids, vectors, norms, query, query_norm, k, metric, masked, rows)
+            scores += s
+            found_ids += i
+        if not scores:
+            return []
+
+        scores, found_ids = np.concatenate(scores), np.concatenate(found_ids)
+        keep = np.isfinite(scores)
+        scores, found_ids = scores[keep], found_ids[keep]
+        top = np.lexsort((found_ids, scores))[:k]
+        return [(int(found_ids[r]), titles.get(int(found_ids[r])), output_score(scores[r], metric)) for r in top]
+
+    def search_many(self, queries, k, exclude=(), metric=None):
+        """search for each row of queries, scoring every block against all of them at once."""
+        metric = check_metric(metric or self.metric)
+        ids, vectors, norms, titles, id2row, shadowed = self._state
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if k <= 0 or len(self) == 0 or not len(queries):
+            return [[] for _ in queries]
+        query_norms = np.linalg.norm(queries, axis=1).astype(np.float32)
+        exclude = np.asarray(list(exclude), dtype=np.int64)
+
+        segments = []
+        if self.base is not None and len(self.base):
+            masked = shadowed
+            if len(exclude):
+                base_rows, found = self.base.rows(exclude)
+                masked = np.union1d(masked, base_rows[found])
+            segments.append((self.base.ids, self.base.vectors, self.base.norms, masked))
+        if len(ids):
+            segments.append((ids, vectors, norms,
+                np.asarray([id2row[t] for t in exclude.tolist() if t in id2row], dtype=np.int64)))
+
+        scores, found_ids = [], []
+        for seg_ids, seg_vectors, seg_norms, masked_rows in segments:
+            for start in range(0, len(seg_ids), self.block_size):
+                stop = min(start + self.block_size, len(seg_ids))
+                block = block_scores_many(np.asarray(seg_vectors[start:stop]), np.asarray(seg_norms[start:stop]),
+                    queries, query_norms, metric)
+                masked = masked_rows[(masked_rows >= start) & (masked_rows < stop)] - start
+                block[:, masked] = np.inf
+                n = min(k, block.shape[1])
+                top = np.argpartition(block, n - 1, axis=1)[:, :n] if n < block.shape[1] else \
+                    np.broadcast_to(np.arange(block.shape[1]), block.shape)
+                scores.append(np.take_along_axis(block, top, axis=1))
+                found_ids.append(np.asarray(seg_ids[start:stop])[top])
+
+        scores, found_ids = np.concatenate(scores, axis=1), np.concatenate(found_ids, axis=1)
+        out = []
+        for row_scores, row_ids in zip(scores, found_ids):
+            keep = np.isfinite(row_scores)
+            row_scores, row_ids = row_scores[keep], row_ids[keep]
+            top = np.lexsort((row_ids, row_scores))[:k]
+            out.append([(int(row_ids[r]), titles.get(int(row_ids[r])), output_score(row_scores[r], metric))
+                for r in top])
+        return out
+
+    def most_similar_many(self, track_ids, k, mode='union', metric=None):
+        """Neighbours of several seed tracks, never returning a seed.
+
+        union: each seed's k nearest, merged with merge_neighbours into
+        [(id, title, score, seed)]. centroid: the k nearest to the mean of
+        the seed vectors, as [(id, title, score, None)]. Unknown seeds are
+        ignored.
+        """
+        if mode not in ('union', 'centroid'):
+            raise ValueError("unknown mode {!r}, expected union or centroid".format(mode))
+        metric = check_metric(metric or self.metric)
+        seeds = list(dict.fromkeys(int(t) for t in track_ids))
+        seed_vectors = self.vectors(seeds)
+        known = ~np.isnan(seed_vectors).any(axis=1)
+        seeds, seed_vectors = [t for t, ok in zip(seeds, known) if ok], seed_vectors[known]
+        if not seeds:
+            return []
+        if mode == 'centroid':
+            hits = self.search(seed_vectors.mean(axis=0), k, exclude=seeds, metric=metric)
+            return [(track_id, title, score, None) for track_id, title, score in hits]
+        per_seed = dict(zip(seeds, self.search_many(seed_vectors, k, exclude=seeds, metric=metric)))
+        return merge_neighbours(per_seed, k, metric)
+
+    def most_similar(self, track_id, k, metric=None, allowed=None):
+        query = self.vector(track_id)
+        if query is None:
+            return []
+        return self.search(query, k, exclude=(track_id,), metric=metric, allowed=allowed)
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+ACK_MODES = ('flush', 'enqueue')
+DEFAULT_MAX_ITEMS = 256
+DEFAULT_MAX_DELAY = 0.005
+DEFAULT_MAX_PENDING = 10000
+
+
+def check_ack(ack):
+    if ack not in ACK_MODES:
+        raise ValueError("ack must be one of {}, got {!r}".format(', '.join(ACK_MODES), ack))
+
+
+def log_flush_error(items, exception):
+    logging.error("write-behind flush of {n} items raised an error: \n {exception}".format(
+        n=len(items), exception=exception))
+
+
+class WriteBuffer:
+    """Write-behind queue group-committing items submitted from many threads.
+
+    A background thread drains the queue into a single flush(items) call once
+    max_items are waiting or the first of them has waited max_delay seconds;
+    flush returns one result per item. With ack='flush' submit blocks until
+    its batch has committed and returns the item's result, or raises the
+    batch's error. With ack='enqueue' it returns None as soon as the item is
+    queued: writes still pending when the process dies are lost, and failed
+    batches are only logged. At most max_pending items wait at once, after
+    which submit blocks.
+    """
+
+    def __init__(self, flush, max_items=DEFAULT_MAX_ITEMS, max_delay=DEFAULT_MAX_DELAY, ack='flush',
+            max_pending=DEFAULT_MAX_PENDING):
+        check_ack(ack)
+        self.flush = flush
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.ack = ack
+        self._queue = queue.Queue(max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='write-buffer', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        if self._closed:
+            raise RuntimeError("write buffer is closed")
+        future = Future() if self.ack == 'flush' else None
+        self._queue.put((item, future))
+        return None if future is None else future.result()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch, closing = [entry], False
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_items:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+            self._commit(batch)
+            if closing:
+                return
+
+    def _commit(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.flush(items)
+        except Exception as exception:
+            log_flush_error(items, exception)
+            for _, future in batch:
+                if future is not None:
+                    future.set_exception(exception)
+            return
+        for (_, future), result in zip(batch, results):
+            if future is not None:
+                future.set_result(result)
+
+    def close(self):
+        """Flush whatever is queued and stop the background thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+
+class AsyncWriteBuffer:
+    """asyncio counterpart of WriteBuffer; flush is a coroutine function.
+
+    The draining task is started by the first submit, on the running loop.
+    """
+
+    def __init__(self, flush, max_items=DEFAULT_MAX_ITEMS, max_delay=DEFAULT_MAX_DELAY, ack='flush',
+            max_pending=DEFAULT_MAX_PENDING):
+        check_ack(ack)
+        self.flush = flush
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.ack = ack
+        self.max_pending = max_pending
+        self._queue = None
+        self._task = None
+        self._closed = False
+
+    async def submit(self, item):
+        if self._closed:
+            raise RuntimeError("write buffer is closed")
+        if self._task is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future() if self.ack == 'flush' else None
+        await self._queue.put((item, future))
+        return None if future is None else await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            if entry is None:
+                return
+            batch, closing = [entry], False
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_items:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+            await self._commit(batch)
+            if closing:
+                return
+
+    async def _commit(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.flush(items)
+        except Exception as exception:
+            log_flush_error(items, exception)
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(exception)
+            return
+        for (_, future), result in zip(batch, results):
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        if not self._closed:
+            self._closed = True
+            if self._task is not None:
+                await self._queue.put(None)
+                await self._task